@@ -14,9 +14,9 @@ class DrugBankVocab:
     """Class to hold BioKG/DrugBank entities, relations and their triples.
 
     """
-    def __init__(self):
-        self.db_meta_path = 'drugbank/db_meta.txt'
-        self.db_ddi_path = 'drugbank/db_ddi.txt'
+    def __init__(self, db_meta_path='drugbank/db_meta.txt', db_ddi_path='drugbank/db_ddi.txt'):
+        self.db_meta_path = db_meta_path
+        self.db_ddi_path = db_ddi_path
 
     def build(self):
         """Parses drugbank/db_meta.txt and drugbank/db_ddi.txt files to build mappings between
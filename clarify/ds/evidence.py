@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import mmap
+import array
+import logging
+
+import numpy as np
+
+from clarify.ds.pairs import pack_pairs, unpack_pairs
+from clarify.utils import JsonlReader, file_fingerprint
+
+from typing import Generator, Iterable, List, Optional, Tuple
+
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+META_FILE = "meta.json"
+ENTITIES_FILE = "entities.txt"
+SENTENCES_FILE = "sentences.txt"
+
+
+class LineTable:
+    """Random access to the lines of a text file through an array of line offsets; the file is memory-mapped."""
+
+    def __init__(self, fname: str, offsets: np.ndarray):
+        self.fname = fname
+        self.offsets = offsets
+        self.mm = None
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> str:
+        if self.mm is None:
+            with open(self.fname, "rb") as rf:
+                self.mm = mmap.mmap(rf.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mm[self.offsets[idx]:self.offsets[idx + 1] - 1].decode("utf-8")
+
+    def __getstate__(self):
+        # Memory maps can not be pickled, each process opens its own
+        state = self.__dict__.copy()
+        state["mm"] = None
+        return state
+
+    @staticmethod
+    def write(fname: str, lines: Iterable[str]) -> np.ndarray:
+        offsets = [0]
+        with open(fname, "wb") as wf:
+            for line in lines:
+                data = (line + "\n").encode("utf-8")
+                wf.write(data)
+                offsets.append(offsets[-1] + len(data))
+        return np.array(offsets, dtype=np.int64)
+
+
+class EvidenceIndex:
+    """Inverted index from groups to the sentences of `linked_sentences_to_groups.jsonl` they appear in.
+
+    For each (src, tgt) group in the `p` or `n` groups of a sentence, the index holds a posting list of
+    (sentence ID, src span, tgt span), where the sentence ID is the line number in the aligned file. Postings are
+    sorted by packed group key (see `clarify.ds.pairs`), so looking up a group is a binary search. Entity texts
+    are stored sorted and sentences in a plain text file, both with line offsets, so that nothing has to be
+    loaded in memory to answer a query.
+
+    """
+
+    def __init__(self, dirname: str, mmap_mode: Optional[str] = "r"):
+        self.dirname = dirname
+
+        with open(os.path.join(dirname, META_FILE)) as rf:
+            self.meta = json.load(rf)
+
+        def load(name):
+            return np.load(os.path.join(dirname, name + ".npy"), mmap_mode=mmap_mode)
+
+        self.keys = load("keys")
+        self.ptr = load("ptr")
+        self.sent_ids = load("sent_ids")
+        self.spans = load("spans")
+        self.entities = LineTable(os.path.join(dirname, ENTITIES_FILE), load("entity_offsets"))
+        self.sentences = LineTable(os.path.join(dirname, SENTENCES_FILE), load("sentence_offsets"))
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def entity_id(self, text: str) -> int:
+        """Binary search of an entity text, returning its ID or -1 if it is not in the index."""
+        lo, hi = 0, len(self.entities)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entities[mid] < text:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.entities) and self.entities[lo] == text:
+            return lo
+        return -1
+
+    def postings(self, src: str, tgt: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the sentence IDs and the (src_start, src_end, tgt_start, tgt_end) spans for a group."""
+        src_id, tgt_id = self.entity_id(src), self.entity_id(tgt)
+        if src_id < 0 or tgt_id < 0:
+            return self.sent_ids[:0], self.spans[:0]
+        key = pack_pairs([src_id], [tgt_id])[0]
+        pos = int(np.searchsorted(self.keys, key))
+        if pos == len(self.keys) or self.keys[pos] != key:
+            return self.sent_ids[:0], self.spans[:0]
+        lo, hi = self.ptr[pos], self.ptr[pos + 1]
+        return self.sent_ids[lo:hi], self.spans[lo:hi]
+
+    def groups(self) -> Generator[Tuple[str, str], None, None]:
+        src_ids, tgt_ids = unpack_pairs(self.keys)
+        for src_id, tgt_id in zip(src_ids, tgt_ids):
+            yield self.entities[src_id], self.entities[tgt_id]
+
+    def iter_evidence(self, groups: Iterable[str]) -> Generator[Tuple[str, int, List[int], List[int]], None, None]:
+        """Yields (group, sentence ID, src span, tgt span) for each sentence of each "src\\ttgt" group."""
+        for group in groups:
+            src, tgt = group.split("\t")
+            sent_ids, spans = self.postings(src, tgt)
+            for sent_id, (src_start, src_end, tgt_start, tgt_end) in zip(sent_ids, spans):
+                yield group, int(sent_id), [int(src_start), int(src_end)], [int(tgt_start), int(tgt_end)]
+
+    @staticmethod
+    def build(aligned_fname: str, dirname: str) -> "EvidenceIndex":
+        """Builds the index from `linked_sentences_to_groups.jsonl` with a single pass, and saves it in `dirname`."""
+        os.makedirs(dirname, exist_ok=True)
+        # Written last, so an interrupted build is never taken for a complete index
+        if os.path.exists(os.path.join(dirname, META_FILE)):
+            os.remove(os.path.join(dirname, META_FILE))
+        logger.info("Building evidence index of `{}` ...".format(aligned_fname))
+
+        entity2idx = dict()
+        src_ids, tgt_ids, sent_ids = array.array("I"), array.array("I"), array.array("I")
+        spans = array.array("H")
+
+        def iter_sentences():
+            for sent_id, jdata in enumerate(JsonlReader(aligned_fname)):
+                if sent_id % 1000000 == 0 and sent_id != 0:
+                    logger.info("Indexed {} sentences".format(sent_id))
+                matches = jdata["matches"]
+                for group in jdata["groups"]["p"] + jdata["groups"]["n"]:
+                    src, tgt = group.split("\t")
+                    for text in (src, tgt):
+                        if text not in entity2idx:
+                            entity2idx[text] = len(entity2idx)
+                    src_ids.append(entity2idx[src])
+                    tgt_ids.append(entity2idx[tgt])
+                    sent_ids.append(sent_id)
+                    spans.extend(matches[src] + matches[tgt])
+                yield jdata["sent"]
+
+        sentence_offsets = LineTable.write(os.path.join(dirname, SENTENCES_FILE), iter_sentences())
+
+        # Entity IDs follow the lexicographic order of the texts, so that they can be binary searched
+        entities = sorted(entity2idx)
+        remap = np.zeros(len(entities), dtype=np.int64)
+        remap[[entity2idx[text] for text in entities]] = np.arange(len(entities))
+        del entity2idx
+        entity_offsets = LineTable.write(os.path.join(dirname, ENTITIES_FILE), entities)
+
+        keys = pack_pairs(remap[np.frombuffer(src_ids, dtype=np.uint32)],
+                          remap[np.frombuffer(tgt_ids, dtype=np.uint32)])
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        unique_keys, starts = np.unique(keys, return_index=True)
+
+        def save(name, data):
+            np.save(os.path.join(dirname, name + ".npy"), data)
+
+        save("keys", unique_keys)
+        save("ptr", np.append(starts, len(keys)).astype(np.int64))
+        save("sent_ids", np.frombuffer(sent_ids, dtype=np.uint32)[order])
+        save("spans", np.frombuffer(spans, dtype=np.uint16).reshape(-1, 4)[order])
+        save("entity_offsets", entity_offsets)
+        save("sentence_offsets", sentence_offsets)
+
+        meta = {
+            "aligned_fname": os.path.abspath(aligned_fname),
+            # Sentence IDs are line numbers in the aligned file, the index must be rebuilt when it changes
+            "aligned_fingerprint": file_fingerprint(aligned_fname),
+            "num_groups": len(unique_keys),
+            "num_postings": len(keys),
+            "num_sentences": len(sentence_offsets) - 1
+        }
+        with open(os.path.join(dirname, META_FILE), "w") as wf:
+            json.dump(meta, wf)
+
+        logger.info("Indexed {num_postings} postings of {num_groups} groups in {num_sentences} sentences".format(**meta))
+
+        return EvidenceIndex(dirname)
+
+
+def load_or_build_evidence_index(aligned_fname: str, dirname: str) -> EvidenceIndex:
+    """Loads the evidence index from `dirname` if it was built from the current `aligned_fname`, otherwise (re)builds
+    it from `aligned_fname`.
+
+    """
+    meta_fname = os.path.join(dirname, META_FILE)
+    if os.path.exists(meta_fname):
+        with open(meta_fname) as rf:
+            meta = json.load(rf)
+        if meta.get("aligned_fingerprint") == file_fingerprint(aligned_fname):
+            logger.info("Loading evidence index `{}` ...".format(dirname))
+            return EvidenceIndex(dirname)
+        logger.info("`{}` changed since the evidence index `{}` was built, rebuilding it".format(aligned_fname, dirname))
+    return EvidenceIndex.build(aligned_fname, dirname)
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import mmap
+import logging
+
+import numpy as np
+
+from typing import Dict, Generator, Tuple, Any
+
+from clarify.utils import JsonlReader
+
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+META_FILE = "meta.json"
+ENTITIES_FILE = "entities.txt"
+
+# Column name -> dtype; `offsets` has one entry per sentence, `match_ptr` one more than that (CSR-style
+# pointers into the match columns), and the `match_*` columns have one entry per match.
+COLUMNS = {
+    "offsets": np.int64,
+    "match_ptr": np.int64,
+    "match_entity": np.int32,
+    "match_start": np.uint16,
+    "match_end": np.uint16,
+}
+
+
+def column_fname(dirname: str, column: str) -> str:
+    return os.path.join(dirname, "{}.{}".format(column, np.dtype(COLUMNS[column]).name))
+
+
+class LinkedSentencesWriter:
+    """Writes linked sentences in a compact columnar format.
+
+    Instead of repeating the sentence and the surface form of every match (as in `umls_linked_sentences.jsonl`),
+    each sentence is stored as the byte offset of its line in the unique sentences file, and each match as an
+    (entity text ID, start, end) triple of integers. The output is a directory with one binary file per column,
+    the entity texts (one per line, the line number being the ID) and a small `meta.json`.
+
+    """
+
+    def __init__(self, output_dir: str, sents_fname: str, buffer_size: int = 100000):
+        self.output_dir = output_dir
+        self.sents_fname = sents_fname
+        self.buffer_size = buffer_size
+
+        os.makedirs(output_dir, exist_ok=True)
+        self.files = {column: open(column_fname(output_dir, column), "wb") for column in COLUMNS}
+        self.buffers = {column: list() for column in COLUMNS}
+        self.entity2idx = dict()
+        self.num_sentences = 0
+        self.num_matches = 0
+        self.buffers["match_ptr"].append(0)
+
+    def write(self, offset: int, text2span: Dict[str, Tuple[int, int]], sent: str = None):
+        # `sent` is not stored, it is read back from the unique sentences file
+        self.buffers["offsets"].append(offset)
+        for text, (start, end) in text2span.items():
+            if end > np.iinfo(COLUMNS["match_end"]).max:
+                raise ValueError("Span ({}, {}) does not fit in the `match_end` column".format(start, end))
+            if text not in self.entity2idx:
+                self.entity2idx[text] = len(self.entity2idx)
+            self.buffers["match_entity"].append(self.entity2idx[text])
+            self.buffers["match_start"].append(start)
+            self.buffers["match_end"].append(end)
+        self.num_sentences += 1
+        self.num_matches += len(text2span)
+        self.buffers["match_ptr"].append(self.num_matches)
+
+        if len(self.buffers["offsets"]) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        for column, buffer in self.buffers.items():
+            if buffer:
+                np.asarray(buffer, dtype=COLUMNS[column]).tofile(self.files[column])
+                buffer.clear()
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+
+        with open(os.path.join(self.output_dir, ENTITIES_FILE), "w", encoding="utf-8") as wf:
+            for text in sorted(self.entity2idx, key=self.entity2idx.get):
+                wf.write("{}\n".format(text))
+
+        meta = {
+            "sents_fname": os.path.abspath(self.sents_fname),
+            "num_sentences": self.num_sentences,
+            "num_matches": self.num_matches
+        }
+        with open(os.path.join(self.output_dir, META_FILE), "w") as wf:
+            json.dump(meta, wf)
+
+        logger.info("Wrote {} linked sentences with {} matches to `{}`".format(self.num_sentences, self.num_matches,
+                                                                               self.output_dir))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class LinkedSentencesJsonlWriter:
+    """Writes linked sentences as JSONL, with the same interface as `LinkedSentencesWriter`."""
+
+    def __init__(self, output_fname: str):
+        self.wf = open(output_fname, "w", encoding="utf-8", errors="ignore")
+
+    def write(self, offset: int, text2span: Dict[str, Tuple[int, int]], sent: str = None):
+        jdata = {"sent": sent, "matches": text2span}
+        self.wf.write(json.dumps(jdata) + "\n")
+
+    def close(self):
+        self.wf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class LinkedSentencesReader:
+    """Reads linked sentences written by `LinkedSentencesWriter`.
+
+    Columns are memory-mapped, and sentences are sliced out of the (memory-mapped) unique sentences file, so
+    iterating requires no JSON parsing. Iterating yields the same dicts as iterating over a `JsonlReader` of the
+    corresponding JSONL file, while `iter_records` yields the raw integer columns of each sentence.
+
+    """
+
+    def __init__(self, input_dir: str, sents_fname: str = None):
+        self.input_dir = input_dir
+
+        with open(os.path.join(input_dir, META_FILE)) as rf:
+            self.meta = json.load(rf)
+        self.sents_fname = sents_fname or self.meta["sents_fname"]
+
+        with open(os.path.join(input_dir, ENTITIES_FILE), encoding="utf-8") as rf:
+            self.entities = [line.rstrip("\n") for line in rf]
+
+        self.columns = dict()
+        for column, dtype in COLUMNS.items():
+            fname = column_fname(input_dir, column)
+            if os.path.getsize(fname) == 0:
+                self.columns[column] = np.zeros(0, dtype=dtype)
+            else:
+                self.columns[column] = np.memmap(fname, dtype=dtype, mode="r")
+
+    def __len__(self) -> int:
+        return self.meta["num_sentences"]
+
+    def iter_records(self) -> Generator[Tuple[int, np.ndarray, np.ndarray, np.ndarray], None, None]:
+        offsets = self.columns["offsets"]
+        match_ptr = self.columns["match_ptr"]
+
+        for idx in range(len(self)):
+            lo, hi = match_ptr[idx], match_ptr[idx + 1]
+            yield (int(offsets[idx]),
+                   self.columns["match_entity"][lo:hi],
+                   self.columns["match_start"][lo:hi],
+                   self.columns["match_end"][lo:hi])
+
+    def __iter__(self) -> Generator[Dict[str, Any], None, None]:
+        with open(self.sents_fname, "rb") as rf:
+            with mmap.mmap(rf.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for offset, entity_ids, starts, ends in self.iter_records():
+                    end = mm.find(b"\n", offset)
+                    line = mm[offset:end if end != -1 else len(mm)]
+                    sent = line.decode("utf-8", errors="ignore").strip()
+                    matches = {self.entities[e]: [int(s), int(t)] for e, s, t in zip(entity_ids, starts, ends)}
+                    yield {"sent": sent, "matches": matches}
+
+
+def open_linked_sentences_writer(output_fname: str, sents_fname: str, binary: bool = False):
+    """Returns a writer of linked sentences, in the columnar format if `binary` is set and as JSONL otherwise."""
+    if binary:
+        return LinkedSentencesWriter(output_fname, sents_fname)
+    return LinkedSentencesJsonlWriter(output_fname)
+
+
+def open_linked_sentences(path: str):
+    """Returns a reader over linked sentences, in either the JSONL or the columnar format."""
+    if os.path.isdir(path):
+        return LinkedSentencesReader(path)
+    return JsonlReader(path)
+
+
+def linked_sentences_to_jsonl(input_dir: str, output_fname: str) -> int:
+    """Converts linked sentences from the columnar format back to JSONL, returning the no. of converted lines."""
+    n = 0
+    with open(output_fname, "w", encoding="utf-8", errors="ignore") as wf:
+        for jdata in LinkedSentencesReader(input_dir):
+            wf.write(json.dumps(jdata) + "\n")
+            n += 1
+    return n
@@ -2,11 +2,14 @@
 
 import logging
 import collections
+import json
 import time
 
 from flashtext import KeywordProcessor
 
-from typing import Iterable
+from clarify.ds.linked import open_linked_sentences, open_linked_sentences_writer
+
+from typing import Iterable, Generator, Tuple, Dict, List, Optional
 
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -24,22 +27,27 @@ class ExactEntityLinking:
 
         logger.info("Took %d mins" % t)
 
-    def link(self, text: str):
-        spans = sorted(
-            [(start_span, end_span) for _, start_span, end_span in self.linker.extract_keywords(text, span_info=True)],
-            key=lambda span: span[0])
-        if not spans:
+    def link_keywords(self, text: str):
+        """Returns the (keyword, span) pairs of the filtered matches in `text`, or None if the sentence should be
+        skipped. The keyword is whatever was stored in the automaton for the match (the entity text by default).
+
+        """
+        matches = sorted(
+            [(keyword, (start_span, end_span))
+             for keyword, start_span, end_span in self.linker.extract_keywords(text, span_info=True)],
+            key=lambda match: match[1][0])
+        if not matches:
             return
 
         # Remove overlapping matches, if any
-        filtered_spans = list()
-        for i in range(1, len(spans)):
-            span_prev, span_next = spans[i - 1], spans[i]
+        filtered_matches = list()
+        for i in range(1, len(matches)):
+            span_prev, span_next = matches[i - 1][1], matches[i][1]
             if span_prev[1] < span_next[0]:
-                filtered_spans.append(spans[i])
-        spans = filtered_spans[:]
+                filtered_matches.append(matches[i])
+        matches = filtered_matches[:]
 
-        matches_texts = [text[s:e] for s, e in spans]
+        matches_texts = [text[s:e] for _, (s, e) in matches]
         # Check if any entity is present more than once, drop this sentence
         counts = collections.Counter(matches_texts)
         skip = False
@@ -51,6 +59,231 @@ class ExactEntityLinking:
         if skip:
             return
 
-        text2span = {matches_texts[i]: spans[i] for i in range(len(spans))}
+        return matches
+
+    def link(self, text: str):
+        matches = self.link_keywords(text)
+        if matches is None:
+            return
+
+        text2span = {text[s:e]: (s, e) for _, (s, e) in matches}
 
         return text2span
+
+
+class MultiSourceEntityLinking:
+    """Exact match entity linking against several vocabularies at once.
+
+    Each source (e.g. "umls", "drugbank") gets its own flashText automaton, and matches are filtered per source as
+    in `ExactEntityLinking`, so that a sentence is linked to each source exactly as if that source was linked
+    alone, while the corpus is read once for all of them.
+
+    """
+
+    def __init__(self, source_to_entities: Dict[str, Iterable[str]], case_sensitive: bool = True):
+        self.sources = sorted(source_to_entities.keys())
+        self.linkers = dict()
+        for source in self.sources:
+            logger.info("Building the automaton of `{}` ...".format(source))
+            self.linkers[source] = ExactEntityLinking(source_to_entities[source], case_sensitive)
+
+    def link_per_source(self, text: str) -> Dict[str, Dict[str, Tuple[int, int]]]:
+        """Returns the `text2span` dict of `ExactEntityLinking.link` of each source that does not skip `text`."""
+        linked = dict()
+        for source in self.sources:
+            text2span = self.linkers[source].link(text)
+            if text2span is not None:
+                linked[source] = text2span
+        return linked
+
+    def link_with_sources(self, text: str) -> Optional[Tuple[Dict[str, Tuple[int, int]], Dict[str, List[str]]]]:
+        """Returns the union of the `text2span` dicts of the sources, along with a dict mapping each matched text to
+        its sources, or None if every source skips `text`. Matches of different sources may overlap.
+
+        """
+        linked = self.link_per_source(text)
+        if not linked:
+            return
+
+        return self.merge_sources(linked)
+
+    @staticmethod
+    def merge_sources(linked: Dict[str, Dict[str, Tuple[int, int]]]) -> Tuple[Dict[str, Tuple[int, int]],
+                                                                              Dict[str, List[str]]]:
+        """Merges the per-source `text2span` dicts of `link_per_source` (see `link_with_sources`)."""
+        text2span = dict()
+        text2sources = collections.defaultdict(list)
+        for source, source_text2span in linked.items():
+            for match_text, span in source_text2span.items():
+                text2span.setdefault(match_text, span)
+                text2sources[match_text].append(source)
+
+        return text2span, dict(text2sources)
+
+    def link(self, text: str):
+        linked = self.link_with_sources(text)
+        if linked is None:
+            return
+
+        return linked[0]
+
+
+def iter_sentences(sents_fname: str,
+                   min_sent_char_len: int = 0,
+                   max_sent_char_len: int = None) -> Generator[Tuple[int, str], None, None]:
+    """Yields (byte offset of the line, sentence) pairs from a file with one sentence per line, skipping
+    empty sentences and sentences that are too short or too long.
+
+    """
+    offset = 0
+    with open(sents_fname, "rb") as rf:
+        for idx, line in enumerate(rf):
+            if idx % 1000000 == 0 and idx != 0:
+                logger.info("Checked {} sentences for entity linking".format(idx))
+            line_offset = offset
+            offset += len(line)
+            sent = line.decode("utf-8", errors="ignore").strip()
+            if not sent:
+                continue
+            # Skip short or very long sentences
+            if len(sent) < min_sent_char_len or (max_sent_char_len is not None and len(sent) > max_sent_char_len):
+                continue
+            yield line_offset, sent
+
+
+def link_sentences(linker: ExactEntityLinking,
+                   sents_fname: str,
+                   output_fname: str,
+                   min_sent_char_len: int = 0,
+                   max_sent_char_len: int = None,
+                   binary: bool = False):
+    """Links the sentences in `sents_fname`, writing them either as JSONL (one `{"sent": .., "matches": ..}` dict
+    per line) or, if `binary` is set, in the columnar format of `clarify.ds.linked` (`output_fname` is then a
+    directory).
+
+    """
+    t = time.time()
+
+    with open_linked_sentences_writer(output_fname, sents_fname, binary) as wf:
+        for offset, sent in iter_sentences(sents_fname, min_sent_char_len, max_sent_char_len):
+            text2span = linker.link(sent)
+            if text2span is None:
+                continue
+            wf.write(offset, text2span, sent)
+
+    t = (time.time() - t) // 60
+    logger.info("Took %d mins" % t)
+
+
+def link_sentences_multi(linker: MultiSourceEntityLinking,
+                         sents_fname: str,
+                         output_fnames: Dict[str, str] = None,
+                         combined_fname: str = None,
+                         min_sent_char_len: int = 0,
+                         max_sent_char_len: int = None,
+                         binary: bool = False):
+    """Links the sentences in `sents_fname` against all the sources of `linker` in a single pass.
+
+    For each source in `output_fnames`, the sentences linked to that source are written to the corresponding file,
+    in the same format as `link_sentences`, and the file is the same as linking that source alone with
+    `link_sentences`. If `combined_fname` is given, every sentence linked to some source is also written there as
+    JSONL, with the union of the matches of the sources (see `MultiSourceEntityLinking.link_with_sources`) and an
+    additional `sources` entry mapping each matched text to the list of sources it comes from.
+
+    """
+    t = time.time()
+    output_fnames = output_fnames or dict()
+
+    writers = {source: open_linked_sentences_writer(output_fname, sents_fname, binary)
+               for source, output_fname in output_fnames.items()}
+    combined_wf = open(combined_fname, "w", encoding="utf-8", errors="ignore") if combined_fname else None
+
+    for offset, sent in iter_sentences(sents_fname, min_sent_char_len, max_sent_char_len):
+        linked = linker.link_per_source(sent)
+        if not linked:
+            continue
+
+        for source, wf in writers.items():
+            if source in linked:
+                wf.write(offset, linked[source], sent)
+
+        if combined_wf is not None:
+            text2span, text2sources = linker.merge_sources(linked)
+            jdata = {"sent": sent, "matches": text2span, "sources": text2sources}
+            combined_wf.write(json.dumps(jdata) + "\n")
+
+    for wf in writers.values():
+        wf.close()
+    if combined_wf is not None:
+        combined_wf.close()
+
+    t = (time.time() - t) // 60
+    logger.info("Took %d mins" % t)
+
+
+def relink_sentences_delta(old_entities: Iterable[str],
+                           new_entities: Iterable[str],
+                           linked_fname: str,
+                           sents_fname: str,
+                           output_fname: str,
+                           min_sent_char_len: int = 0,
+                           max_sent_char_len: int = None,
+                           case_sensitive: bool = True,
+                           binary: bool = False) -> Dict[str, int]:
+    """Updates linked sentences after a vocabulary change, without re-linking the whole corpus.
+
+    Only the entity texts that were added or removed can change the outcome of linking a sentence, so the corpus
+    is scanned with a small automaton over those texts only. Sentences containing none of them keep their record
+    from `linked_fname` (in either format), while the others are re-linked against `new_entities`. The patched
+    output is written to `output_fname`, in the format given by `binary`.
+
+    Since records are matched to corpus sentences by text, `sents_fname` must hold unique sentences, and
+    `linked_fname` must have been linked from it with the same sentence length limits.
+
+    """
+    t = time.time()
+    old_entities, new_entities = set(old_entities), set(new_entities)
+    changed = old_entities.symmetric_difference(new_entities)
+
+    logger.info("{} entity texts added, {} removed".format(len(new_entities - old_entities),
+                                                           len(old_entities - new_entities)))
+
+    delta_linker = KeywordProcessor(case_sensitive=case_sensitive)
+    delta_linker.add_keywords_from_list(list(changed))
+
+    # The full linker is only needed (and built) if some sentence is affected
+    linker = None
+    stats = collections.Counter()
+
+    old_records = iter(open_linked_sentences(linked_fname))
+    old_jdata = next(old_records, None)
+
+    with open_linked_sentences_writer(output_fname, sents_fname, binary) as wf:
+        for offset, sent in iter_sentences(sents_fname, min_sent_char_len, max_sent_char_len):
+            old_matches = None
+            if old_jdata is not None and old_jdata["sent"] == sent:
+                old_matches = old_jdata["matches"]
+                old_jdata = next(old_records, None)
+
+            if changed and delta_linker.extract_keywords(sent):
+                stats["relinked"] += 1
+                if linker is None:
+                    linker = ExactEntityLinking(new_entities, case_sensitive)
+                text2span = linker.link(sent)
+            else:
+                text2span = old_matches
+
+            if text2span is None:
+                continue
+            stats["written"] += 1
+            wf.write(offset, text2span, sent)
+
+    if old_jdata is not None:
+        logger.warning("Some records of `{}` were not found in `{}`, starting from: {}".format(
+            linked_fname, sents_fname, old_jdata["sent"]))
+
+    t = (time.time() - t) // 60
+    logger.info("Re-linked {} sentences and wrote {} linked sentences. Took {} mins".format(
+        stats["relinked"], stats["written"], t))
+
+    return dict(stats)
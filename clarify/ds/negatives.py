@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+import array
+import random
+import logging
+
+import numpy as np
+
+from clarify.ds.pairs import GroupPairIndex, pack_pairs, unpack_pairs
+
+from typing import Any, Generator, Iterable, List, Optional, Set, Tuple, Union
+
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STRATEGIES = ("corrupt", "typed", "all")
+
+
+def pair_matrix(texts: List[str], groups_texts: Union[Set[str], GroupPairIndex]) -> np.ndarray:
+    """Returns the boolean matrix `m` where `m[i, j]` tells if (texts[i], texts[j]) is a KG group (i != j)."""
+    if isinstance(groups_texts, GroupPairIndex):
+        return groups_texts.pair_matrix(texts)
+
+    n = len(texts)
+    matrix = np.zeros((n, n), dtype=bool)
+    for i in range(n):
+        for j in range(n):
+            if i != j and "{}\t{}".format(texts[i], texts[j]) in groups_texts:
+                matrix[i, j] = True
+    return matrix
+
+
+class NegativeSampler:
+    """Candidate negative groups of a sentence, i.e. pairs of its matched entities that are not in the KG for any
+    relation, working on the matrix of KG pairs of the sentence (see `pair_matrix`).
+
+    Strategies:
+        - `corrupt`: for each positive group, with prob. 1/2, the source or the target entity is replaced by every
+          other entity of the sentence (hard negatives sharing the text evidence of a positive group);
+        - `typed`: same as `corrupt`, but the replacing entity must appear on the same side (source or target) of
+          some group of `pair_index`. UMLS semantic types are not part of the vocab, so the side an entity takes in
+          the KG is used as its type;
+        - `all`: every ordered pair of entities of the sentence that is not in the KG.
+
+    """
+
+    def __init__(self, strategy: str = "corrupt", pair_index: Optional[GroupPairIndex] = None):
+        if strategy not in STRATEGIES:
+            raise ValueError("Unknown negative sampling strategy `{}`, expected one of {}".format(strategy, STRATEGIES))
+        self.strategy = strategy
+        self.pair_index = pair_index
+
+        if strategy == "typed":
+            if pair_index is None:
+                raise ValueError("The `typed` strategy requires a `GroupPairIndex`")
+            src_ids, tgt_ids = unpack_pairs(pair_index.keys)
+            self.is_src = np.zeros(len(pair_index.entities), dtype=bool)
+            self.is_src[src_ids] = True
+            self.is_tgt = np.zeros(len(pair_index.entities), dtype=bool)
+            self.is_tgt[tgt_ids] = True
+
+    def candidates(self, texts: List[str], kg: np.ndarray, positives: List[Tuple[int, int]], rng=random) -> Set[str]:
+        """Returns the candidate negative groups, given the KG pair matrix `kg` of `texts` and the (src, tgt)
+        indices of the positive groups; `rng` decides the side to corrupt of each positive, in order.
+
+        """
+        n = len(texts)
+        not_kg = ~kg
+        np.fill_diagonal(not_kg, False)
+
+        if self.strategy == "all":
+            src_idx, tgt_idx = np.nonzero(not_kg)
+        else:
+            if not positives:
+                return set()
+            sides = np.array([rng.choice([0, 1]) for _ in positives], dtype=bool)
+            positives = np.array(positives, dtype=np.int64).reshape(-1, 2)
+
+            rhs_ok, lhs_ok = not_kg, not_kg
+            if self.strategy == "typed":
+                ids = self.pair_index.entity_ids(texts)
+                is_src = (ids >= 0) & self.is_src[np.maximum(ids, 0)]
+                is_tgt = (ids >= 0) & self.is_tgt[np.maximum(ids, 0)]
+                rhs_ok = not_kg & is_tgt[None, :]
+                lhs_ok = not_kg & is_src[:, None]
+
+            # rhs: (src, every other entity)
+            rhs = positives[~sides, 0]
+            rows, cols = np.nonzero(rhs_ok[rhs, :])
+            src_idx, tgt_idx = rhs[rows], cols
+
+            # lhs: (every other entity, tgt)
+            lhs = positives[sides, 1]
+            rows, cols = np.nonzero(lhs_ok[:, lhs].T)
+            src_idx, tgt_idx = np.concatenate([src_idx, cols]), np.concatenate([tgt_idx, lhs[rows]])
+
+        keys = np.unique(src_idx * n + tgt_idx)
+        return {"{}\t{}".format(texts[k // n], texts[k % n]) for k in keys}
+
+
+def reservoir_sample(iterable: Iterable[Any], k: int, rng=random) -> List[Any]:
+    """Uniformly samples `k` items of `iterable` in a single pass (all of them if there are fewer)."""
+    reservoir = list()
+    if k <= 0:
+        return reservoir
+    for idx, item in enumerate(iterable):
+        if idx < k:
+            reservoir.append(item)
+        else:
+            j = rng.randint(0, idx)
+            if j < k:
+                reservoir[j] = item
+    return reservoir
+
+
+class GroupSet:
+    """Set of "src\\ttgt" groups stored as packed pairs of interned entity IDs (see `clarify.ds.pairs`), using about
+    8 bytes per group instead of a Python string. Groups are buffered and deduplicated in batches.
+
+    """
+
+    def __init__(self, batch_size: int = 10000000):
+        self.batch_size = batch_size
+        self.entity2idx = dict()
+        self.entities = list()
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.buffer = array.array("Q")
+
+    def intern(self, text: str) -> int:
+        if text not in self.entity2idx:
+            self.entity2idx[text] = len(self.entities)
+            self.entities.append(text)
+        return self.entity2idx[text]
+
+    def update(self, groups: Iterable[str]):
+        for group in groups:
+            src, tgt = group.split("\t")
+            self.buffer.append((self.intern(src) << 32) | self.intern(tgt))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.keys = np.union1d(self.keys, np.frombuffer(self.buffer, dtype=np.uint64))
+            self.buffer = array.array("Q")
+
+    def __len__(self) -> int:
+        self.flush()
+        return len(self.keys)
+
+    def __iter__(self) -> Generator[str, None, None]:
+        self.flush()
+        src_ids, tgt_ids = unpack_pairs(self.keys)
+        for src_id, tgt_id in zip(src_ids, tgt_ids):
+            yield "{}\t{}".format(self.entities[src_id], self.entities[tgt_id])
+
+    def iter_within(self, entities: Set[str]) -> Generator[str, None, None]:
+        """Iterates over the groups whose source and target entities are both in `entities`."""
+        self.flush()
+        mask = np.array([entity in entities for entity in self.entities], dtype=bool)
+        src_ids, tgt_ids = unpack_pairs(self.keys)
+        keep = mask[src_ids] & mask[tgt_ids] if len(mask) else np.zeros(len(self.keys), dtype=bool)
+        for src_id, tgt_id in zip(src_ids[keep], tgt_ids[keep]):
+            yield "{}\t{}".format(self.entities[src_id], self.entities[tgt_id])
+
+    def __contains__(self, group: str) -> bool:
+        self.flush()
+        src, tgt = group.split("\t")
+        if src not in self.entity2idx or tgt not in self.entity2idx:
+            return False
+        key = pack_pairs([self.entity2idx[src]], [self.entity2idx[tgt]])[0]
+        pos = int(np.searchsorted(self.keys, key))
+        return pos < len(self.keys) and self.keys[pos] == key
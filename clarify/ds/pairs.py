@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+import os
+import logging
+
+import numpy as np
+
+from typing import Iterable, List, Set
+
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ENTITIES_FILE = "entities.txt"
+KEYS_FILE = "keys.npy"
+
+
+def pack_pairs(src_ids: np.ndarray, tgt_ids: np.ndarray) -> np.ndarray:
+    """Packs pairs of 32-bit entity IDs into 64-bit keys."""
+    return (np.asarray(src_ids, dtype=np.uint64) << np.uint64(32)) | np.asarray(tgt_ids, dtype=np.uint64)
+
+
+def unpack_pairs(keys: np.ndarray):
+    keys = np.asarray(keys, dtype=np.uint64)
+    return (keys >> np.uint64(32)).astype(np.int64), (keys & np.uint64(0xFFFFFFFF)).astype(np.int64)
+
+
+class GroupPairIndex:
+    """Compact set of (src entity text, tgt entity text) groups.
+
+    Entity texts are interned to integer IDs, and each group is packed into a 64-bit key; keys are kept in a sorted
+    NumPy array, so membership tests are vectorized binary searches. This replaces the set of "src\\ttgt" strings
+    built by `get_groups_texts_from_umls_vocab` at a fraction of its memory, and can be saved and memory-mapped.
+
+    """
+
+    def __init__(self, entities: List[str], keys: np.ndarray):
+        self.entities = entities
+        self.entity2idx = {entity: idx for idx, entity in enumerate(entities)}
+        self.keys = keys
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def entity_ids(self, texts: Iterable[str]) -> np.ndarray:
+        """Maps entity texts to their IDs, with -1 for texts that are not in any group."""
+        return np.array([self.entity2idx.get(text, -1) for text in texts], dtype=np.int64)
+
+    def contains_ids(self, src_ids: np.ndarray, tgt_ids: np.ndarray) -> np.ndarray:
+        """Vectorized membership test for (src, tgt) pairs of entity IDs; negative IDs are never contained."""
+        src_ids, tgt_ids = np.asarray(src_ids), np.asarray(tgt_ids)
+        valid = (src_ids >= 0) & (tgt_ids >= 0)
+        if len(self.keys) == 0:
+            return np.zeros_like(valid)
+        keys = pack_pairs(np.where(valid, src_ids, 0), np.where(valid, tgt_ids, 0))
+        pos = np.searchsorted(self.keys, keys)
+        pos[pos == len(self.keys)] = 0
+        return valid & (self.keys[pos] == keys)
+
+    def __contains__(self, group: str) -> bool:
+        src, tgt = group.split("\t")
+        return bool(self.contains_ids(self.entity_ids([src]), self.entity_ids([tgt]))[0])
+
+    def pair_matrix(self, texts: List[str]) -> np.ndarray:
+        """Returns the boolean matrix `m` where `m[i, j]` tells if (texts[i], texts[j]) is in the index (i != j)."""
+        ids = self.entity_ids(texts)
+        n = len(texts)
+        src_idx, tgt_idx = np.nonzero(~np.eye(n, dtype=bool))
+        matrix = np.zeros((n, n), dtype=bool)
+        matrix[src_idx, tgt_idx] = self.contains_ids(ids[src_idx], ids[tgt_idx])
+        return matrix
+
+    def common_groups(self, texts: List[str]) -> Set[str]:
+        """Returns the groups, among all the permutations of size 2 of `texts`, that are in the index."""
+        src_idx, tgt_idx = np.nonzero(self.pair_matrix(texts))
+        return {"{}\t{}".format(texts[i], texts[j]) for i, j in zip(src_idx, tgt_idx)}
+
+    def intersection(self, groups: Iterable[str]) -> Set[str]:
+        """Same as `set.intersection` on a set of "src\\ttgt" strings."""
+        groups = list(groups)
+        pairs = [group.split("\t") for group in groups]
+        found = self.contains_ids(self.entity_ids(p[0] for p in pairs), self.entity_ids(p[1] for p in pairs))
+        return {group for group, f in zip(groups, found) if f}
+
+    @staticmethod
+    def from_umls_vocab(uv, batch_size: int = 10000000) -> "GroupPairIndex":
+        """Builds the index of all textual combinations of the CUI groups in `uv.relation_text_to_groups`."""
+        cui_groups = set()
+        for groups in uv.relation_text_to_groups.values():
+            cui_groups.update(groups)
+
+        logger.info("Interning entity texts of {} CUI groups ...".format(len(cui_groups)))
+
+        cui2idx = dict()
+        entity2idx = dict()
+        cui_ptr = [0]
+        cui_texts = list()
+
+        def intern_cui(cui):
+            if cui not in cui2idx:
+                cui2idx[cui] = len(cui2idx)
+                for text in sorted(uv.cui_to_entity_texts.get(cui, ())):
+                    if text not in entity2idx:
+                        entity2idx[text] = len(entity2idx)
+                    cui_texts.append(entity2idx[text])
+                cui_ptr.append(len(cui_texts))
+            return cui2idx[cui]
+
+        group_src = np.array([intern_cui(src) for src, _ in cui_groups], dtype=np.int64)
+        group_tgt = np.array([intern_cui(tgt) for _, tgt in cui_groups], dtype=np.int64)
+        cui_ptr = np.array(cui_ptr, dtype=np.int64)
+        cui_texts = np.array(cui_texts, dtype=np.int64)
+        del cui_groups
+
+        if len(entity2idx) > np.iinfo(np.uint32).max:
+            raise ValueError("Too many entity texts ({}) for 32-bit IDs".format(len(entity2idx)))
+
+        # Each CUI group (c1, c2) expands to |texts(c1)| x |texts(c2)| textual groups
+        num_src_texts = cui_ptr[group_src + 1] - cui_ptr[group_src]
+        num_tgt_texts = cui_ptr[group_tgt + 1] - cui_ptr[group_tgt]
+        counts = num_src_texts * num_tgt_texts
+        ends = np.cumsum(counts)
+
+        logger.info("Collecting {} textual combinations of CUI groups ...".format(int(ends[-1]) if len(ends) else 0))
+
+        # Keys of each batch, deduplicated once all batches are collected rather than merged at each batch
+        batch_keys = [np.zeros(0, dtype=np.uint64)]
+        num_keys = 0
+        lo = 0
+        while lo < len(counts):
+            # Take as many groups as fit in a batch (at least one)
+            base = ends[lo - 1] if lo > 0 else 0
+            hi = max(int(np.searchsorted(ends, base + batch_size, side="right")), lo + 1)
+
+            g = np.repeat(np.arange(lo, hi), counts[lo:hi])
+            k = np.arange(len(g)) - np.repeat(ends[lo:hi] - counts[lo:hi] - base, counts[lo:hi])
+            src_texts = cui_texts[cui_ptr[group_src[g]] + k // num_tgt_texts[g]]
+            tgt_texts = cui_texts[cui_ptr[group_tgt[g]] + k % num_tgt_texts[g]]
+
+            batch_keys.append(np.unique(pack_pairs(src_texts, tgt_texts)))
+            num_keys += len(batch_keys[-1])
+            logger.info("Parsed {} groups of {} ({} textual groups)".format(hi, len(counts), num_keys))
+            lo = hi
+
+        keys = np.unique(np.concatenate(batch_keys))
+        del batch_keys
+
+        entities = sorted(entity2idx, key=entity2idx.get)
+        logger.info("Collected {} unique tuples of (src_entity_text, tgt_entity_text) type.".format(len(keys)))
+
+        return GroupPairIndex(entities, keys)
+
+    def save(self, dirname: str):
+        os.makedirs(dirname, exist_ok=True)
+        with open(os.path.join(dirname, ENTITIES_FILE), "w", encoding="utf-8") as wf:
+            for entity in self.entities:
+                wf.write("{}\n".format(entity))
+        np.save(os.path.join(dirname, KEYS_FILE), self.keys)
+
+    @staticmethod
+    def load(dirname: str, mmap: bool = True) -> "GroupPairIndex":
+        with open(os.path.join(dirname, ENTITIES_FILE), encoding="utf-8") as rf:
+            entities = [line.rstrip("\n") for line in rf]
+        keys = np.load(os.path.join(dirname, KEYS_FILE), mmap_mode="r" if mmap else None)
+        return GroupPairIndex(entities, keys)
+
+
+def load_or_build_group_pair_index(uv, dirname: str) -> GroupPairIndex:
+    """Loads the group pair index from `dirname` if it was saved before, otherwise builds it from `uv` and saves it."""
+    if os.path.exists(os.path.join(dirname, KEYS_FILE)):
+        logger.info("Loading group pair index `{}` ...".format(dirname))
+        return GroupPairIndex.load(dirname)
+
+    index = GroupPairIndex.from_umls_vocab(uv)
+    logger.info("Saving group pair index at `{}` ...".format(dirname))
+    index.save(dirname)
+    return index
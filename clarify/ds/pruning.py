@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import random
+import logging
+import collections
+
+import numpy as np
+
+import config
+
+from clarify.ds.pairs import pack_pairs, unpack_pairs
+from clarify.ds.negatives import GroupSet, reservoir_sample
+from clarify.utils import file_fingerprint
+
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+META_FILE = "meta.json"
+ENTITIES_FILE = "entities.txt"
+RELATIONS_FILE = "relations.txt"
+
+
+def map_relations_to_groups(uv, pos_groups: Iterable[str]) -> Dict[str, Set[str]]:
+    """Maps each relation of the KG to the positive textual groups it holds for."""
+    # Only the groups with evidence matter, so instead of expanding every CUI group of the KG into its textual
+    # groups, we go the other way round: each positive textual group is mapped to the CUI groups it can come from
+    # (by means of `uv.entity_text_to_cuis`), and only those are looked up among the groups of each relation.
+    logger.info("Mapping groups texts to CUI groups ...")
+    cui_group_to_groups_texts = collections.defaultdict(set)
+
+    for group_text in pos_groups:
+        src, tgt = group_text.split("\t")
+        for cui_src in uv.entity_text_to_cuis.get(src, ()):
+            for cui_tgt in uv.entity_text_to_cuis.get(tgt, ()):
+                cui_group_to_groups_texts[(cui_src, cui_tgt)].add(group_text)
+
+    logger.info("Mapping relations to groups texts ({} candidate CUI groups) ...".format(len(cui_group_to_groups_texts)))
+    relation_text_to_groups_texts = collections.defaultdict(set)
+    candidate_cui_groups = set(cui_group_to_groups_texts.keys())
+
+    for relation_text, groups in uv.relation_text_to_groups.items():
+        # Set intersection iterates over the smaller of the two
+        for group in candidate_cui_groups.intersection(groups):
+            relation_text_to_groups_texts[relation_text].update(cui_group_to_groups_texts[group])
+
+    return relation_text_to_groups_texts
+
+
+class PruningIndex:
+    """Relations, positive groups and candidate negative groups before pruning, as integer arrays.
+
+    Relations are mapped to the sorted IDs of their groups (CSR-style `rel_ptr` / `rel_groups`), and groups, positive
+    and negative, are packed pairs of entity IDs (see `clarify.ds.pairs`). Negative groups whose entities are not
+    in any positive group are dropped, since they can never be kept. Applying the relation pruning thresholds is
+    then a few vectorized operations, so they can be explored (`report`) without re-running the splits stage.
+
+    """
+
+    def __init__(self, entities: List[str], relations: List[str], group_keys: np.ndarray, rel_ptr: np.ndarray,
+                 rel_groups: np.ndarray, neg_keys: np.ndarray):
+        self.entities = entities
+        self.relations = relations
+        self.group_keys = group_keys
+        self.rel_ptr = rel_ptr
+        self.rel_groups = rel_groups
+        self.neg_keys = neg_keys
+
+    @staticmethod
+    def build(uv, pos_groups: Iterable[str], neg_groups: Iterable[str]) -> "PruningIndex":
+        relation_text_to_groups_texts = map_relations_to_groups(uv, pos_groups)
+
+        entities = sorted({entity for groups in relation_text_to_groups_texts.values()
+                           for group in groups for entity in group.split("\t")})
+        entity2idx = {entity: idx for idx, entity in enumerate(entities)}
+
+        def keys_of(groups):
+            pairs = [group.split("\t") for group in groups]
+            return pack_pairs([entity2idx[src] for src, _ in pairs], [entity2idx[tgt] for _, tgt in pairs])
+
+        group_keys = np.unique(np.concatenate(
+            [keys_of(groups) for groups in relation_text_to_groups_texts.values()] + [np.zeros(0, dtype=np.uint64)]
+        ))
+
+        relations = sorted(relation_text_to_groups_texts)
+        rel_groups = [np.searchsorted(group_keys, np.sort(keys_of(relation_text_to_groups_texts[r]))) for r in relations]
+        rel_ptr = np.cumsum([0] + [len(g) for g in rel_groups]).astype(np.int64)
+        rel_groups = np.concatenate(rel_groups + [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+
+        if isinstance(neg_groups, GroupSet):
+            neg_groups = neg_groups.iter_within(entity2idx)
+        neg_keys = np.unique(keys_of(group for group in neg_groups
+                                     if all(entity in entity2idx for entity in group.split("\t"))))
+
+        logger.info("Indexed {} relations with {} positive and {} candidate negative groups over {} entities".format(
+            len(relations), len(group_keys), len(neg_keys), len(entities)))
+
+        return PruningIndex(entities, relations, group_keys, rel_ptr, rel_groups, neg_keys)
+
+    def select(self, min_rel_group: int, max_rel_group: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Returns the IDs of the relations within the thresholds, of their groups, the mask of the entities of these
+        groups, and the IDs of the negative groups within these entities.
+
+        """
+        counts = np.diff(self.rel_ptr)
+        rel_mask = (counts >= min_rel_group) & (counts <= max_rel_group)
+        rel_ids = np.nonzero(rel_mask)[0]
+
+        group_ids = np.unique(self.rel_groups[np.repeat(rel_mask, counts)])
+
+        entity_mask = np.zeros(len(self.entities), dtype=bool)
+        src_ids, tgt_ids = unpack_pairs(self.group_keys[group_ids])
+        entity_mask[src_ids] = True
+        entity_mask[tgt_ids] = True
+
+        neg_src_ids, neg_tgt_ids = unpack_pairs(self.neg_keys)
+        neg_ids = np.nonzero(entity_mask[neg_src_ids] & entity_mask[neg_tgt_ids])[0]
+
+        return rel_ids, group_ids, entity_mask, neg_ids
+
+    def report(self, min_rel_group: int, max_rel_group: int, na_ratio: float = 0.7,
+               bag_size: int = None) -> Dict[str, Any]:
+        """Estimates the size of the dataset for the given thresholds, before filtering groups without evidence."""
+        bag_size = bag_size or config.bag_size
+        rel_ids, group_ids, entity_mask, neg_ids = self.select(min_rel_group, max_rel_group)
+        counts = np.diff(self.rel_ptr)
+
+        num_na = min(int(len(group_ids) * na_ratio), len(neg_ids))
+        num_triples = int(counts[rel_ids].sum()) + num_na
+
+        return dict(
+            num_relations=len(rel_ids),
+            num_positive_groups=len(group_ids),
+            num_negative_groups=num_na,
+            num_triples=num_triples,
+            num_entities=int(entity_mask.sum()),
+            # K-tag bags, one per group (S-tag has up to one per direction)
+            est_num_bags=len(group_ids) + num_na,
+            est_num_sents=(len(group_ids) + num_na) * bag_size,
+        )
+
+    def relation_counts(self) -> Dict[str, int]:
+        return dict(zip(self.relations, np.diff(self.rel_ptr).tolist()))
+
+    def triples(self, min_rel_group: int = 10, max_rel_group: int = 1500, na_ratio: float = 0.7,
+                seed: int = None) -> List[Tuple[str, str, str]]:
+        """Returns the triples of the relations within the thresholds, and `na_ratio` times as many NA triples
+        (uniformly sampled among the negative groups of their entities) as positive groups.
+
+        """
+        logger.info("No. of relations before pruning: {}".format(len(self.relations)))
+        logger.info("Relations not matching the criterion of min, max group sizes of {} and {}.".format(min_rel_group,
+                                                                                                        max_rel_group))
+        rel_ids, group_ids, entity_mask, neg_ids = self.select(min_rel_group, max_rel_group)
+
+        logger.info("No. of relations after pruning: {}".format(len(rel_ids)))
+        logger.info("Updated no. of positive groups after pruning: {}".format(len(group_ids)))
+        logger.info("No. of entities: {}".format(int(entity_mask.sum())))
+
+        # Negative examples are used for NA / Other relation, which is just another class.
+        # To avoid training too much on NA relation, we uniformly sample (in a single pass
+        # over the negative groups of positive entities) `na_ratio` times as many groups as positive groups.
+        rng = random.Random(config.SEED if seed is None else seed)
+        neg_ids = reservoir_sample(neg_ids.tolist(), int(len(group_ids) * na_ratio), rng)
+
+        logger.info("Updated no. of negative groups after pruning groups that are not in positive entities and taking "
+                    "{} times the positive groups: {}".format(na_ratio, len(neg_ids)))
+
+        def texts(keys):
+            src_ids, tgt_ids = unpack_pairs(keys)
+            return [(self.entities[s], self.entities[t]) for s, t in zip(src_ids, tgt_ids)]
+
+        # Collect triples now
+        triples = list()
+        for r in rel_ids:
+            relation = self.relations[r]
+            for src, tgt in texts(self.group_keys[self.rel_groups[self.rel_ptr[r]:self.rel_ptr[r + 1]]]):
+                triples.append((src, relation, tgt))
+        for src, tgt in texts(self.neg_keys[np.array(neg_ids, dtype=np.int64)]):
+            triples.append((src, "NA", tgt))
+
+        logger.info(" *** No. of triples (including NA) *** : {}".format(len(triples)))
+
+        return triples
+
+    def save(self, dirname: str, sources: Optional[Dict[str, str]] = None):
+        """Saves the index in `dirname`, with the fingerprints of the `sources` files (name -> file name) it was built
+        from, see `is_current`.
+
+        """
+        os.makedirs(dirname, exist_ok=True)
+        if os.path.exists(os.path.join(dirname, META_FILE)):
+            os.remove(os.path.join(dirname, META_FILE))
+        for fname, lines in [(ENTITIES_FILE, self.entities), (RELATIONS_FILE, self.relations)]:
+            with open(os.path.join(dirname, fname), "w", encoding="utf-8") as wf:
+                for line in lines:
+                    wf.write("{}\n".format(line))
+        for name in ("group_keys", "rel_ptr", "rel_groups", "neg_keys"):
+            np.save(os.path.join(dirname, name + ".npy"), getattr(self, name))
+        # Written last, marks the index as complete
+        with open(os.path.join(dirname, META_FILE), "w") as wf:
+            json.dump({"num_relations": len(self.relations), "num_groups": len(self.group_keys),
+                       "num_negative_groups": len(self.neg_keys),
+                       "sources": {name: file_fingerprint(fname) for name, fname in (sources or dict()).items()}}, wf)
+
+    @staticmethod
+    def is_current(dirname: str, sources: Dict[str, str]) -> bool:
+        """Tells if the index in `dirname` is complete and was built from the current version of each of the
+        `sources` files (name -> file name).
+
+        """
+        meta_fname = os.path.join(dirname, META_FILE)
+        if not os.path.exists(meta_fname):
+            return False
+        with open(meta_fname) as rf:
+            built_sources = json.load(rf).get("sources", dict())
+        changed = sorted(name for name, fname in sources.items()
+                         if not os.path.exists(fname) or built_sources.get(name) != file_fingerprint(fname))
+        if changed:
+            logger.info("Pruning index `{}` was built from other versions of {}, rebuilding it".format(
+                dirname, ", ".join(sources[name] for name in changed)))
+            return False
+        return True
+
+    @staticmethod
+    def load(dirname: str) -> "PruningIndex":
+        def read_lines(fname):
+            with open(os.path.join(dirname, fname), encoding="utf-8") as rf:
+                return [line.rstrip("\n") for line in rf]
+
+        arrays = [np.load(os.path.join(dirname, name + ".npy"))
+                  for name in ("group_keys", "rel_ptr", "rel_groups", "neg_keys")]
+        return PruningIndex(read_lines(ENTITIES_FILE), read_lines(RELATIONS_FILE), *arrays)
+
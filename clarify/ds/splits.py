@@ -1,21 +1,27 @@
 # -*- coding: utf-8 -*-
 
+import os
 import logging
 import collections
 import numpy as np
-import itertools
 import json
 import config
 import random
-
-from tqdm import tqdm
+import hashlib
 
 from clarify.ds.umls import UMLSVocab
-from clarify.utils import JsonlReader
+from clarify.ds.linked import open_linked_sentences
+from clarify.ds.linking import ExactEntityLinking, iter_sentences
+from clarify.ds.pairs import GroupPairIndex
+from clarify.ds.evidence import EvidenceIndex
+from clarify.ds.negatives import NegativeSampler, GroupSet, pair_matrix
+from clarify.ds.pruning import PruningIndex
+from clarify.utils import JsonlReader, TriplesReader, iter_chunks, ordered_imap, shard_fname, manifest_fname, \
+    write_manifest, file_fingerprint
 
 from sklearn.model_selection import train_test_split
 
-from typing import Set, Tuple, List, Dict, Any
+from typing import Set, Tuple, List, Dict, Any, Optional, Union, Generator, Iterable
 
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -64,83 +70,172 @@ def get_groups_texts_from_umls_vocab(uv: UMLSVocab) -> Set[str]:
         # also, each pair is not a Tuple[str, str], but it's a string with a \t separating the two surface forms
 
     # NOTE: this consumes a LOT of memory (~18 GB)! (clearing up memory takes around half an hour)
+    # See `clarify.ds.pairs.GroupPairIndex` for a compact alternative.
     logger.info("Collected {} unique tuples of (src_entity_text, tgt_entity_text) type.".format(len(groups_texts)))
 
     return groups_texts
 
 
-def align_groups_to_sentences(groups_texts: Set[str], jsonl_fname: str, output_fname: str) -> Tuple[Set[str], Set[str]]:
-    jr = JsonlReader(jsonl_fname)
+def sentence_rng(sent: str, seed: int = 0) -> random.Random:
+    """Returns a random number generator seeded from the hash of a sentence, so that sampling for a sentence does
+    not depend on which (or how many) sentences were processed before it.
+
+    """
+    shash = hashlib.sha256("{}\t{}".format(seed, sent).encode("utf-8")).digest()
+    return random.Random(int.from_bytes(shash[:8], "little"))
+
+
+def align_sentence(matches: Dict[str, Any],
+                   groups_texts: Union[Set[str], GroupPairIndex],
+                   rng=random,
+                   max_matches: Optional[int] = None,
+                   sampler: Optional[NegativeSampler] = None) -> Dict[str, List[str]]:
+    """Aligns the entities matched in a sentence to the KG groups, returning a dict with positive (`p`) and
+    negative (`n`) groups for the sentence. Only sentences with both positive and negative groups are kept as
+    evidence, but the positive groups of the others still count as aligned.
+
+    `groups_texts` is either a set of "src\ttgt" strings or a `GroupPairIndex`, and `rng` is used for the random
+    choices (the global `random` module by default). If `max_matches` is set, only the first `max_matches`
+    matches of the sentence (in text order) are paired. Negative groups are drawn by `sampler` (the `corrupt`
+    strategy by default, see `clarify.ds.negatives.NegativeSampler`).
+
+    """
+    texts = list(matches.keys())
+    if max_matches is not None and len(texts) > max_matches:
+        texts = sorted(texts, key=lambda text: matches[text][0])[:max_matches]
+
+    # Since `groups_texts` contain all possible groups that can exist
+    # in the UMLS KG, for some relation, the matrix of matched permuted
+    # groups that are in this set efficiently yields groups which
+    # **do exist in KG for some relation and have matching sentences**.
+    kg = pair_matrix(texts, groups_texts)
+
+    # We use sentence level noise, i.e., for the given sentence the
+    # common groups represent positive groups, while the negative
+    # samples are groups of the sentence that **must not be in KG for any
+    # relation** (like open-world assumption), by default hard negatives
+    # corrupting one side of a positive group (see `NegativeSampler`).
+
+    # Groups are visited in sorted order, so that the random choices only depend on `rng`
+    positives = sorted(zip(*np.nonzero(kg)), key=lambda ij: "{}\t{}".format(texts[ij[0]], texts[ij[1]]))
+    output = {"p": ["{}\t{}".format(texts[i], texts[j]) for i, j in positives]}
+
+    sampler = sampler or _default_sampler
+    no = sorted(sampler.candidates(texts, kg, positives, rng))
+    if output["p"] and no:
+        rng.shuffle(no)
+        # Keep number of negative groups at most as positives
+        no = no[:len(output["p"])]
+    output["n"] = no
+
+    return output
+
+
+_default_sampler = NegativeSampler("corrupt")
+
+
+# State shared (read-only) by the alignment workers, set by `_init_align`
+_align_state = dict()
+
+
+def _init_align(groups_texts: Union[Set[str], GroupPairIndex],
+                seed: int,
+                max_matches: Optional[int],
+                linker: Optional[ExactEntityLinking] = None,
+                sampler: Optional[NegativeSampler] = None):
+    _align_state["groups_texts"] = groups_texts
+    _align_state["seed"] = seed
+    _align_state["max_matches"] = max_matches
+    _align_state["linker"] = linker
+    _align_state["sampler"] = sampler
+
+
+def _align_jdata(jdata: Dict[str, Any]) -> Tuple[Optional[str], List[str], List[str]]:
+    output = align_sentence(jdata["matches"], _align_state["groups_texts"],
+                            sentence_rng(jdata["sent"], _align_state["seed"]), _align_state["max_matches"],
+                            _align_state["sampler"])
+    if output["p"] and output["n"]:
+        jdata["groups"] = output
+        return json.dumps(jdata), output["p"], output["n"]
+    return None, output["p"], output["n"]
+
+
+def _align_chunk(chunk: List[Union[str, Dict[str, Any]]]) -> List[Tuple[Optional[str], List[str], List[str]]]:
+    # JSONL lines are parsed here, in the workers
+    return [_align_jdata(json.loads(jdata) if isinstance(jdata, str) else jdata) for jdata in chunk]
+
+
+def _link_and_align_chunk(chunk: List[Tuple[int, str]]) -> List[Tuple[Optional[str], List[str], List[str]]]:
+    linker = _align_state["linker"]
+
+    results = list()
+    for _, sent in chunk:
+        text2span = linker.link(sent)
+        if text2span is None:
+            continue
+        results.append(_align_jdata({"sent": sent, "matches": text2span}))
+
+    return results
+
+
+def alignment_meta_fname(aligned_fname: str) -> str:
+    return os.path.splitext(aligned_fname)[0] + ".meta.json"
+
+
+def alignment_options(negative_strategy: str = "corrupt", max_matches: Optional[int] = None) -> Dict[str, Any]:
+    """Options of the alignment the aligned file depends on, recorded next to it (see `check_alignment_options`)."""
+    return {"negative_strategy": negative_strategy, "max_matches_per_sentence": max_matches}
+
+
+def check_alignment_options(aligned_fname: str, options: Dict[str, Any]):
+    """Raises a `ValueError` if the aligned file was written with other `options` (see `alignment_options`), since it
+    is reused as long as it exists. Files written before the options were recorded, or modified since, are only
+    warned about.
+
+    """
+    meta_fname = alignment_meta_fname(aligned_fname)
+    meta = None
+    if os.path.exists(meta_fname):
+        with open(meta_fname) as rf:
+            meta = json.load(rf)
+    if meta is None or meta["fingerprint"] != file_fingerprint(aligned_fname):
+        logger.warning("The alignment options of `{}` are unknown, delete it to align sentences again if {} changed "
+                       "since it was written".format(aligned_fname, ", ".join(options)))
+        return
+
+    changed = sorted(key for key in options if meta["options"].get(key) != options[key])
+    if changed:
+        raise ValueError("`{}` was aligned with {}, delete it to align sentences again with {}".format(
+            aligned_fname, ", ".join("{}={}".format(key, meta["options"].get(key)) for key in changed),
+            ", ".join("{}={}".format(key, options[key]) for key in changed)))
+
+
+def _write_aligned(results_iter, output_fname: str, options: Dict[str, Any]) -> Tuple[Set[str], GroupSet]:
+    # The options are written last, once the aligned file is complete
+    meta_fname = alignment_meta_fname(output_fname)
+    if os.path.exists(meta_fname):
+        os.remove(meta_fname)
 
-    logger.info("Aligning texts (sentences) to groups ...")
     pos_groups = set()
-    neg_groups = set()
+    # Negative groups largely outnumber the positive ones, they are stored as packed integer pairs
+    neg_groups = GroupSet()
+
+    num_aligned = 0
 
     with open(output_fname, "w", encoding="utf-8", errors="ignore") as wf:
+        for results in results_iter:
+            if (num_aligned + len(results)) // 1000000 > num_aligned // 1000000:
+                logger.info("Processed {} tagged sentences".format(num_aligned + len(results)))
+            num_aligned += len(results)
 
-        for idx, jdata in enumerate(jr):
-            if idx % 1000000 == 0 and idx != 0:
-                logger.info("Processed {} tagged sentences".format(idx))
-
-            # Permutations of size for matched entities in a sentence
-            matched_perms = set(itertools.permutations(jdata['matches'].keys(), 2))
-
-            # Left-hand-side (lhs) <==> right-hand-side (rhs)
-            lhs2rhs = collections.defaultdict(list)
-            rhs2lhs = collections.defaultdict(list)
-
-            for group in matched_perms:
-                src, tgt = group
-                lhs2rhs[src].append(tgt)
-                rhs2lhs[tgt].append(src)
-
-            # Since `groups_texts` contain all possible groups that can exist
-            # in the UMLS KG, for some relation, the intersection of this set
-            # with matched permuted groups efficiently yields groups which
-            # **do exist in KG for some relation and have matching sentences**.
-            matched_perms = {"\t".join(m) for m in matched_perms}
-            common = groups_texts.intersection(matched_perms)
-
-            # We use sentence level noise, i.e., for the given sentence the
-            # common groups represent positive groups, while the negative
-            # samples can be generated as follows (like open-world assumption):
-            #
-            # For a +ve group, with prob. 1/2, remove the left (src) or right
-            # (tgt) entity and replace with N entities such that the negative
-            # group (e_orig, e_replaced) [for rhs] / (e_replaced, e_orig) [for lhs]
-            # **must not be in KG for any relation**. This technique can possibly be
-            # seen as creating hard negatives for same text evidence.
-
-            output = {"p": set(), "n": set()}
-
-            for group in common:
-                pos_groups.add(group)
-                src, tgt = group.split("\t")
-                output["p"].add(group)
-                # Choose left or right side to corrupt
-                lhs_or_rhs = random.choice([0, 1])
-
-                if lhs_or_rhs == 0:
-                    for corrupt_tgt in lhs2rhs[src]:
-                        negative_group = "{}\t{}".format(src, corrupt_tgt)
-                        if negative_group not in common:
-                            output["n"].add(negative_group)
-                else:
-                    for corrupt_src in rhs2lhs[tgt]:
-                        negative_group = "{}\t{}".format(corrupt_src, tgt)
-                        if negative_group not in common:
-                            output["n"].add(negative_group)
-
-            if output["p"] and output["n"]:
-                no = list(output["n"])
-                random.shuffle(no)
-                # Keep number of negative groups at most as positives
-                no = no[:len(output["p"])]
-                output["n"] = no
-                output["p"] = list(output["p"])
-                neg_groups.update(no)
-                jdata["groups"] = output
-                wf.write(json.dumps(jdata) + "\n")
+            for line, p, n in results:
+                pos_groups.update(p)
+                if line is not None:
+                    neg_groups.update(n)
+                    wf.write(line + "\n")
+
+    with open(meta_fname, "w") as wf:
+        json.dump({"options": options, "fingerprint": file_fingerprint(output_fname)}, wf, indent=2)
 
     # There will be lot of negative groups, so we will remove them next!
     logger.info("Collected {} positive and {} negative groups.".format(len(pos_groups), len(neg_groups)))
@@ -148,108 +243,114 @@ def align_groups_to_sentences(groups_texts: Set[str], jsonl_fname: str, output_f
     return pos_groups, neg_groups
 
 
-def pruned_triples(uv: UMLSVocab,
-                   pos_groups: Set[str],
-                   neg_groups: Set[str],
-                   min_rel_group: int = 10,
-                   max_rel_group: int = 1500) -> List[Tuple[str, str, str]]:
-    logger.info("Mapping CUI groups to relations ...")
-    group_to_relation_texts = collections.defaultdict(list)
+def align_groups_to_sentences(groups_texts: Union[Set[str], GroupPairIndex],
+                              jsonl_fname: str,
+                              output_fname: str,
+                              workers: int = 1,
+                              chunk_size: int = 10000,
+                              seed: int = 0,
+                              max_matches: Optional[int] = None,
+                              sampler: Optional[NegativeSampler] = None) -> Tuple[Set[str], GroupSet]:
+    """Aligns linked sentences to the KG groups, writing the sentences with positive and negative groups to
+    `output_fname` (`linked_sentences_to_groups.jsonl`).
 
-    for relation_text, groups in tqdm(uv.relation_text_to_groups.items()):
-        for group in tqdm(groups, leave=False):
-            group_to_relation_texts[group].append(relation_text)
+    Chunks of sentences are processed by `workers` processes sharing `groups_texts`. The random choices for each
+    sentence are seeded from its hash (and `seed`), so the output is the same for any number of workers.
 
-    logger.info("Mapping relations to groups texts ...")
-    relation_text_to_groups_texts = collections.defaultdict(set)
+    """
+    logger.info("Aligning texts (sentences) to groups with {} workers ...".format(workers))
 
-    for idx, (group, relation_texts) in enumerate(group_to_relation_texts.items()):
-        if idx % 1000000 == 0 and idx != 0:
-            logger.info("Mapped from {} groups".format(idx))
+    # `jsonl_fname` can also be a directory with linked sentences in the columnar format
+    if os.path.isdir(jsonl_fname):
+        records = open_linked_sentences(jsonl_fname)
+    else:
+        records = JsonlReader(jsonl_fname).iter_lines()
 
-        cui_src, cui_tgt = group
-        local_groups = set()
-        cui_src_texts = uv.cui_to_entity_texts[cui_src]
-        cui_tgt_texts = uv.cui_to_entity_texts[cui_tgt]
+    chunks = iter_chunks(records, chunk_size)
+    results_iter = ordered_imap(_align_chunk, chunks, workers=workers,
+                                initializer=_init_align, initargs=(groups_texts, seed, max_matches, None, sampler))
 
-        for l1i in cui_src_texts:
-            local_groups.update(list(zip([l1i] * len(cui_tgt_texts), cui_tgt_texts)))
+    return _write_aligned(results_iter, output_fname,
+                          alignment_options((sampler or _default_sampler).strategy, max_matches))
 
-        for lg in local_groups:
-            if "\t".join(lg) in pos_groups:
-                for relation_text in relation_texts:
-                    relation_text_to_groups_texts[relation_text].add("\t".join(lg))
 
-    logger.info("No. of relations before pruning: {}".format(len(relation_text_to_groups_texts)))
+def link_and_align_sentences(linker: ExactEntityLinking,
+                             groups_texts: Union[Set[str], GroupPairIndex],
+                             sents_fname: str,
+                             output_fname: str,
+                             min_sent_char_len: int = 0,
+                             max_sent_char_len: int = None,
+                             workers: int = 1,
+                             chunk_size: int = 10000,
+                             seed: int = 0,
+                             max_matches: Optional[int] = None,
+                             sampler: Optional[NegativeSampler] = None) -> Tuple[Set[str], GroupSet]:
+    """Links the sentences in `sents_fname` and aligns them to the KG groups in the same pass, writing
+    `linked_sentences_to_groups.jsonl` directly (i.e. `link_sentences` followed by `align_groups_to_sentences`,
+    without the intermediate linked sentences file).
 
-    # Prune relations based on the group size
-    relations_to_del = list()
-    for relation_text, groups_texts in relation_text_to_groups_texts.items():
-        if (len(groups_texts) < min_rel_group) or (len(groups_texts) > max_rel_group):
-            relations_to_del.append(relation_text)
+    Chunks of sentences are processed by `workers` processes sharing the linker and `groups_texts`. The random
+    choices for each sentence are seeded from its hash (and `seed`), so the output does not depend on `workers`.
 
-    logger.info("Relations not matching the criterion of min, max group sizes of {} and {}.".format(min_rel_group,
-                                                                                                    max_rel_group))
-    for r in relations_to_del:
-        del relation_text_to_groups_texts[r]
+    """
+    logger.info("Linking and aligning texts (sentences) to groups with {} workers ...".format(workers))
 
-    logger.info("No. of relations after pruning: {}".format(len(relation_text_to_groups_texts)))
+    chunks = iter_chunks(iter_sentences(sents_fname, min_sent_char_len, max_sent_char_len), chunk_size)
+    results_iter = ordered_imap(_link_and_align_chunk, chunks, workers=workers,
+                                initializer=_init_align, initargs=(groups_texts, seed, max_matches, linker, sampler))
 
-    # Update positive groups
-    new_pos_groups = set()
-    entities = set()
-    for relation_text, groups_texts in relation_text_to_groups_texts.items():
-        for group_text in groups_texts:
-            new_pos_groups.add(group_text)
-            entities.update(group_text.split("\t"))
+    return _write_aligned(results_iter, output_fname,
+                          alignment_options((sampler or _default_sampler).strategy, max_matches))
 
-    logger.info("Updated no. of positive groups after pruning: {}".format(len(new_pos_groups)))
-    logger.info("No. of entities: {}".format(len(entities)))
 
-    # Update negative groups
+def pruned_triples(uv: UMLSVocab,
+                   pos_groups: Set[str],
+                   neg_groups: Iterable[str],
+                   min_rel_group: int = 10,
+                   max_rel_group: int = 1500,
+                   na_ratio: float = 0.7,
+                   seed: int = None) -> List[Tuple[str, str, str]]:
+    """Returns the triples of the relations with between `min_rel_group` and `max_rel_group` positive groups,
+    plus `na_ratio` times as many NA triples as positive groups, see `clarify.ds.pruning.PruningIndex`.
 
-    # 1) We apply the constraint that the negative groups must have positive
-    # triples entities only
-    new_neg_groups = set()
+    """
+    return PruningIndex.build(uv, pos_groups, neg_groups).triples(min_rel_group, max_rel_group, na_ratio, seed)
 
-    for negative_group in neg_groups:
-        src, tgt = negative_group.split("\t")
-        if (src in entities) and (tgt in entities):
-            new_neg_groups.add(negative_group)
 
-    logger.info("[1] Updated no. of negative groups after pruning groups that are not in positive entities: {}".format(len(new_neg_groups)))
+def iter_evidence_from_aligned_file(candid_groups: Set[str],
+                                    aligned_fname: str = None) -> Generator[Tuple[str, int, str, List[int], List[int]], None, None]:
+    """Scans the aligned file, yielding (group, sentence ID, sentence, src span, tgt span) for each of the
+    `candid_groups` found in the `p` or `n` groups of a sentence. The sentence ID is its line number in the file,
+    as in `clarify.ds.evidence.EvidenceIndex`.
 
-    # 2) Negative examples are used for NA / Other relation, which is just another class.
-    # To avoid training too much on NA relation, we make a simple choice randomly taking
-    # the same number of groups as largest group size positive class.
-    max_pos_group_size = max([len(v) for v in relation_text_to_groups_texts.values()])
-    new_neg_groups = list(new_neg_groups)
-    random.shuffle(new_neg_groups)
-    # CHECK: Using 70% of positive groups to form negative groups
-    new_neg_groups = new_neg_groups[:int(len(new_pos_groups) * 0.7)]
+    """
+    # config.groups_linked_sents_file -> linked_sentences_to_groups.jsonl
+    #   {"sent": .., "matches": .., "groups": {"p": ["a\tb", "c\td", ..], "n": ..}}
 
-    logger.info("[2] Updated no. of negative groups after taking 70 percent more than positive groups: {}".format(
-        len(new_neg_groups)))
+    jr = JsonlReader(aligned_fname or config.groups_linked_sents_file)
 
-    relation_text_to_groups_texts["NA"] = new_neg_groups
+    for idx, jdata in enumerate(jr):
+        if idx % 1000000 == 0 and idx != 0:
+            logger.info("Processed {} lines for linking to triples".format(idx))
+        common = candid_groups.intersection(jdata["groups"]["p"] + jdata["groups"]["n"])
 
-    # Collect triples now
-    triples = set()
-    for r, groups in relation_text_to_groups_texts.items():
-        for group in groups:
+        # common: set of groups appearing either in "p" or "n"
+        #   note: "p" and "n" are two lists of tab-divided entity pairs
+
+        for group in common:
             src, tgt = group.split("\t")
-            triples.add((src, r, tgt))
-    triples = list(triples)
+            yield group, idx, jdata["sent"], jdata["matches"][src], jdata["matches"][tgt]
 
-    logger.info(" *** No. of triples (including NA) *** : {}".format(len(triples)))
 
-    return triples
+def collect_group_evidence(triples: Iterable[Tuple[str, str, str]],
+                           evidence_index: Optional[EvidenceIndex] = None):
+    """Collects the evidence of each group of the triples, either by scanning `linked_sentences_to_groups.jsonl`
+    or, if given, from the posting lists of `evidence_index`. This does not depend on the tagging scheme.
 
+    Returns a dict mapping the groups with evidence to their relations, and a dict mapping them to lists of
+    (sentence ID, src span, tgt span). Sentence IDs are line numbers in `linked_sentences_to_groups.jsonl`.
 
-def filter_triples_with_evidence(triples: List[Tuple[str, str, str]],
-                                 max_bag_size: int = 32,
-                                 k_tag: bool = True,
-                                 expand_rels: bool = False) -> Tuple[Set[Tuple[str, str, str]], Dict[str, Dict[str, Any]]]:
+    """
     group_to_relation_texts = collections.defaultdict(set)
 
     for ei, rj, ek in triples:
@@ -258,57 +359,87 @@ def filter_triples_with_evidence(triples: List[Tuple[str, str, str]],
 
     # group_to_relation_text: dict "source\ttarget" -> {'r1', 'r2', ..} (all in surface forms)
 
-    # config.groups_linked_sents_file -> linked_sentences_to_groups.jsonl
-    #   {"sent": .., "matches": .., "groups": {"p": ["a\tb", "c\td", ..], "n": ..}}
-
-    jr = JsonlReader(config.groups_linked_sents_file)
-
-    group_to_data = collections.defaultdict(list)
     candid_groups = set(group_to_relation_texts.keys())
 
-    for idx, jdata in enumerate(jr):
-        if idx % 1000000 == 0 and idx != 0:
-            logger.info("Processed {} lines for linking to triples".format(idx))
-        common = candid_groups.intersection(jdata["groups"]["p"] + jdata["groups"]["n"])
+    if evidence_index is not None:
+        evidence = evidence_index.iter_evidence(candid_groups)
+    else:
+        evidence = ((group, sent_id, src_span, tgt_span)
+                    for group, sent_id, _, src_span, tgt_span in iter_evidence_from_aligned_file(candid_groups))
 
-        # common: set of groups appearing either in "p" or "n"
-        #   note: "p" and "n" are two lists of tab-divided entity pairs
+    group_to_evidence = collections.defaultdict(list)
 
-        if not common:
+    for group, sent_id, src_span, tgt_span in evidence:
+        # Overlapping mentions should not happen, but to be on safe side
+        if not (src_span[1] < tgt_span[0] or src_span[0] > tgt_span[1]):
             continue
+        group_to_evidence[group].append((sent_id, src_span, tgt_span))
 
-        for group in common:
-            src, tgt = group.split("\t")
-            src_span = jdata["matches"][src]
-            tgt_span = jdata["matches"][tgt]
-            sent = jdata["sent"]
-            sent = sent.replace("$", "")
-            sent = sent.replace("^", "")
-            
-            # for each pair in common, annotate the source and the target entitiy in the sentence, based on the
-            # match coordinates
+    group_to_relation_texts = {group: group_to_relation_texts[group] for group in group_to_evidence}
+
+    return group_to_relation_texts, dict(group_to_evidence)
+
+
+def mark_sentence(sent: str, e1: str, e2: str, e1_span: List[int], e2_span: List[int]) -> str:
+    """Annotates the sentence by replacing the mentions at `e1_span` and `e2_span` with `$e1$` and `^e2^`. Marker
+    characters are replaced by spaces in the rest of the sentence and in the entities, while the spans remain
+    offsets in the original sentence, so that the annotated sentence has the tokens of the sentence without its
+    marker tokens (as encoded by create-features-cli.py with the fast tokenizer).
+
+    """
+    def strip(text: str) -> str:
+        return text.replace("$", " ").replace("^", " ")
+
+    e1, e2 = strip(e1), strip(e2)
+    if e1_span[1] < e2_span[0]:
+        return (strip(sent[:e1_span[0]]) + "$" + e1 + "$" + strip(sent[e1_span[1]:e2_span[0]]) + "^" + e2 + "^" +
+                strip(sent[e2_span[1]:]))
+    else:
+        return (strip(sent[:e2_span[0]]) + "^" + e2 + "^" + strip(sent[e2_span[1]:e1_span[0]]) + "$" + e1 + "$" +
+                strip(sent[e1_span[1]:]))
+
+
+def bag_sentences(line: Dict[str, Any], sentences) -> List[str]:
+    """Returns the annotated sentences of the bag of a line of the split files, looking up sentence IDs in
+    `sentences` (e.g. `EvidenceIndex.sentences`).
+
+    """
+    src, tgt = line["group"]
+    e1 = line.get("e1") or src
+    e2 = line.get("e2") or tgt
+    return [mark_sentence(sentences[sent_id], e1, e2, [e1_start, e1_end], [e2_start, e2_end])
+            for sent_id, e1_start, e1_end, e2_start, e2_end in line["sentences"]]
 
+
+def build_bags(group_to_relation_texts: Dict[str, Set[str]],
+               group_to_evidence: Dict[str, List[Tuple[int, List[int], List[int]]]],
+               max_bag_size: int = 32,
+               k_tag: bool = True,
+               expand_rels: bool = False) -> Dict[str, Dict[str, Any]]:
+    """Builds the bags of each group for a given tagging scheme.
+
+    Sentences are not annotated here: each entry of a bag is (sentence ID, e1 start, e1 end, e2 start, e2 end),
+    where e1 is the entity to be marked with `$` and e2 the one to be marked with `^` (see `bag_sentences`).
+
+    """
+    group_to_data = dict()
+
+    for group, evidence in group_to_evidence.items():
+        group_to_data[group] = collections.defaultdict(list)
+
+        for sent_id, src_span, tgt_span in evidence:
             # src entity mentioned before tgt entity
             if src_span[1] < tgt_span[0]:
-                sent = sent[:src_span[0]] + "$" + src + "$" + sent[src_span[1]:tgt_span[0]] + "^" + tgt + "^" + sent[tgt_span[1]:]
                 rel_dir = 1
-            # tgt entity mentioned before src entity
-            elif src_span[0] > tgt_span[1]:
-                if k_tag:
-                    sent = sent[:tgt_span[0]] + "^" + tgt + "^" + sent[tgt_span[1]:src_span[0]] + "$" + src + "$" + sent[src_span[1]:]
-                else:
-                    sent = sent[:tgt_span[0]] + "$" + tgt + "$" + sent[tgt_span[1]:src_span[0]] + "^" + src + "^" + sent[src_span[1]:]
-                rel_dir = -1
-            # Should not happen, but to be on safe side
+                e1_span, e2_span = src_span, tgt_span
+            # tgt entity mentioned before src entity, marked first with S-tag, and e1 of the bag with expanded
+            # relations (see below)
             else:
-                continue
-
-            if group not in group_to_data:
-                group_to_data[group] = collections.defaultdict(list)
-
-            group_to_data[group][rel_dir].append(sent)
+                rel_dir = -1
+                e1_span, e2_span = (src_span, tgt_span) if k_tag and not expand_rels else (tgt_span, src_span)
+            group_to_data[group][rel_dir].append([sent_id] + list(e1_span) + list(e2_span))
 
-            # group_to_data -- group: rel_dir: annotated sentence
+            # group_to_data -- group: rel_dir: bag entry
 
     # Adjust bag sizes
     new_group_to_data = dict()
@@ -345,49 +476,184 @@ def filter_triples_with_evidence(triples: List[Tuple[str, str, str]],
                 "relations": group_to_relation_texts[group],
                 "bag": bag
             }
-    group_to_data = new_group_to_data
 
-    filtered_triples = set()
-    for group in group_to_data:
-        src, tgt, _ = group.split("\t")
-        for relation in group_to_data[group]["relations"]:
-            filtered_triples.add((src, relation, tgt))
+    return new_group_to_data
+
+
+def filter_triples_with_evidence(triples: List[Tuple[str, str, str]],
+                                 max_bag_size: int = 32,
+                                 k_tag: bool = True,
+                                 expand_rels: bool = False,
+                                 evidence_index: Optional[EvidenceIndex] = None) -> Tuple[Set[Tuple[str, str, str]], Dict[str, Dict[str, Any]]]:
+    """Collects bags of evidence sentences for the triples, see `collect_group_evidence` and `build_bags`."""
+    group_to_relation_texts, group_to_evidence = collect_group_evidence(triples, evidence_index)
+    group_to_data = build_bags(group_to_relation_texts, group_to_evidence, max_bag_size, k_tag, expand_rels)
+
+    return group_triples(group_to_relation_texts), group_to_data
 
-    return filtered_triples, group_to_data
 
+def group_triples(group_to_relation_texts: Dict[str, Set[str]]) -> Set[Tuple[str, str, str]]:
+    """Returns the (src, relation, tgt) triples of the groups."""
+    triples = set()
+    for group, relations in group_to_relation_texts.items():
+        src, tgt = group.split("\t")
+        for relation in relations:
+            triples.add((src, relation, tgt))
+    return triples
 
-def remove_overlapping_sents(train_lines, test_lines):
-    test_sentences = set()
-    for line in test_lines:
-        test_sentences.update({s.replace("$", "").replace("^", "") for s in line["sentences"]})
 
-    new_train_lines = list()
+def canonical_params(aligned_fname: str, umls_vocab_fname: str) -> Dict[str, Any]:
+    """Returns the configuration the canonical dataset is built with, and the fingerprints of the aligned file the
+    evidence index is built from and of the UMLS vocab the relations of the groups come from (the pruning index is
+    built from both), see `canonical_dataset_is_current`. The alignment options must match those of the aligned
+    file (see `check_alignment_options`).
+
+    """
+    return {
+        "min_rel_group": config.min_rel_group,
+        "max_rel_group": config.max_rel_group,
+        "na_ratio": config.na_ratio,
+        "SEED": config.SEED,
+        "split_mode": config.split_mode,
+        "negative_strategy": config.negative_strategy,
+        "max_matches_per_sentence": config.max_matches_per_sentence,
+        "aligned_fingerprint": file_fingerprint(aligned_fname) if os.path.exists(aligned_fname) else None,
+        "umls_vocab_fingerprint": file_fingerprint(umls_vocab_fname)
+    }
+
+
+def canonical_dataset_is_current(dirname: str, params: Dict[str, Any]) -> bool:
+    """Tells if the canonical dataset in `dirname` is complete and was built with `params`."""
+    meta_fname = os.path.join(dirname, "meta.json")
+    if not os.path.exists(meta_fname):
+        return False
+    with open(meta_fname) as rf:
+        meta = json.load(rf)
+    built_params = meta.get("params", dict())
+    changed = sorted(key for key in params if built_params.get(key) != params[key])
+    if changed:
+        logger.info("Canonical dataset `{}` was built with other values of {}, rebuilding it".format(
+            dirname, ", ".join(changed)))
+        return False
+    return True
+
+
+def write_canonical_dataset(dirname: str,
+                            splits: Dict[str, List[Tuple[str, str, str]]],
+                            group_to_relation_texts: Dict[str, Set[str]],
+                            group_to_evidence: Dict[str, List[Tuple[int, List[int], List[int]]]],
+                            evidence_index_dir: str,
+                            params: Dict[str, Any] = None):
+    """Writes the tag-agnostic output of the splits stage: the triples of each split, and the relations and
+    evidence (sentence IDs in the evidence index, with src and tgt spans) of each group. Every tagging scheme
+    (k-tag, s-tag, expanded relations) can then be derived with `build_bags`. `params` (see `canonical_params`)
+    are recorded, so that the dataset is rebuilt when they change.
+
+    """
+    os.makedirs(dirname, exist_ok=True)
+    if os.path.exists(os.path.join(dirname, "meta.json")):
+        os.remove(os.path.join(dirname, "meta.json"))
+
+    for split, triples in splits.items():
+        with open(os.path.join(dirname, "{}_triples.tsv".format(split)), "w") as wf:
+            for ei, rj, ek in triples:
+                wf.write("{}\t{}\t{}\n".format(ei, rj, ek))
+
+    with open(os.path.join(dirname, "evidence.jsonl"), "w") as wf:
+        for group, evidence in group_to_evidence.items():
+            wf.write(json.dumps({
+                "group": group.split("\t"),
+                "relations": sorted(group_to_relation_texts[group]),
+                "evidence": [[sent_id] + list(src_span) + list(tgt_span) for sent_id, src_span, tgt_span in evidence]
+            }) + "\n")
+
+    # Written last, marks the dataset as complete
+    with open(os.path.join(dirname, "meta.json"), "w") as wf:
+        json.dump({"splits": sorted(splits), "evidence_index_dir": os.path.abspath(evidence_index_dir),
+                   "params": params or dict()}, wf)
+
+
+def load_canonical_dataset(dirname: str) -> Dict[str, Any]:
+    """Loads the output of `write_canonical_dataset`."""
+    with open(os.path.join(dirname, "meta.json")) as rf:
+        meta = json.load(rf)
+
+    splits = dict()
+    for split in meta["splits"]:
+        splits[split] = [tuple(triple) for triple in TriplesReader(os.path.join(dirname, "{}_triples.tsv".format(split)))]
+
+    group_to_relation_texts = dict()
+    group_to_evidence = dict()
+    for jdata in JsonlReader(os.path.join(dirname, "evidence.jsonl")):
+        group = "\t".join(jdata["group"])
+        group_to_relation_texts[group] = set(jdata["relations"])
+        group_to_evidence[group] = [(e[0], e[1:3], e[3:5]) for e in jdata["evidence"]]
+
+    return {
+        "splits": splits,
+        "group_to_relation_texts": group_to_relation_texts,
+        "group_to_evidence": group_to_evidence,
+        "evidence_index_dir": meta["evidence_index_dir"]
+    }
+
+
+def heldout_sentence_ids(*heldout_lines: Iterable[Dict[str, Any]]) -> np.ndarray:
+    """Returns the sorted unique sentence IDs of the bags of the held-out (dev, test, ..) lines."""
+    return np.unique(np.fromiter(
+        (entry[0] for lines in heldout_lines for line in lines for entry in line["sentences"]), dtype=np.int64
+    ))
+
+
+def remove_overlapping_sents(train_lines: Iterable[Dict[str, Any]],
+                             heldout_ids: np.ndarray,
+                             bag_size: int = None,
+                             seed: int = None) -> Generator[Dict[str, Any], None, None]:
+    """Removes the sentences of the held-out lines (`heldout_ids`, see `heldout_sentence_ids`) from the bags of the
+    training lines, in a single pass, and drops the training lines whose bags end up empty. Lines are streamed.
+
+    Bags that lost sentences are padded back to `bag_size` with a generator seeded from the group, the direction
+    and `seed`, so the output does not depend on global random state.
+
+    """
+    bag_size = bag_size or config.bag_size
+    seed = config.SEED if seed is None else seed
+
+    removed_ids = set()
+    num_removed = 0
+    num_lines = 0
+    num_kept = 0
 
     for line in train_lines:
-        new_sents = list()
-        for sent in line["sentences"]:
-            temp_sent = sent.replace("$", "").replace("^", "")
-            if temp_sent not in test_sentences:
-                new_sents.append(sent)
-        if not new_sents:
+        num_lines += 1
+        bag = line["sentences"]
+        ids = np.fromiter((entry[0] for entry in bag), dtype=np.int64, count=len(bag))
+        # Membership is a binary search in the sorted held-out IDs
+        pos = np.searchsorted(heldout_ids, ids)
+        pos[pos == len(heldout_ids)] = 0
+        overlap = heldout_ids[pos] == ids if len(heldout_ids) else np.zeros(len(ids), dtype=bool)
+
+        if not overlap.any():
+            num_kept += 1
+            yield line
             continue
-        bag = new_sents
-        if len(bag) > config.bag_size:
-            bag = random.sample(bag, config.bag_size)
-        else:
-            idxs = list(np.random.choice(list(range(len(bag))), config.bag_size - len(bag)))
-            bag = bag + [bag[i] for i in idxs]
-        line["sentences"] = bag
-        new_train_lines.append(line)
 
-    new_triples = set()
+        num_removed += int(overlap.sum())
+        removed_ids.update(ids[overlap].tolist())
+        bag = [entry for entry, o in zip(bag, overlap) if not o]
+        if not bag:
+            continue
 
-    for line in new_train_lines:
-        src, tgt = line["group"]
-        relation = line["relation"]
-        new_triples.add((src, relation, tgt))
+        rng = sentence_rng("{}\t{}\t{}".format(line["group"][0], line["group"][1], line["reldir"]), seed)
+        if len(bag) > bag_size:
+            bag = rng.sample(bag, bag_size)
+        else:
+            bag = bag + rng.choices(bag, k=bag_size - len(bag))
+        line["sentences"] = bag
+        num_kept += 1
+        yield line
 
-    return new_train_lines, new_triples
+    logger.info(" *** Removed {} overlapping bag entries ({} unique sentences) and {} of {} bags from training "
+                "*** ".format(num_removed, len(removed_ids), num_lines - num_kept, num_lines))
 
 
 def create_data_split(triples: Set[Tuple[str, str, str]]) -> Tuple[List[Tuple[str, str, str]], List[Tuple[str, str, str]], List[Tuple[str, str, str]]]:
@@ -410,11 +676,61 @@ def create_data_split(triples: Set[Tuple[str, str, str]]) -> Tuple[List[Tuple[st
     return train_triples, dev_triples, test_triples
 
 
-def split_lines(triples: List[Tuple[str, str, str]], group_to_data) -> List[Dict[str, Any]]:
+def hash_split(src: str, tgt: str, seed: int = 0, test_size: float = 0.2, dev_size: float = 0.1) -> str:
+    """Assigns the (src, tgt) group to "train", "dev" or "test" from the hash of the group and `seed`.
+
+    The hash is mapped to [0, 1) and split in ranges with the same proportions as `create_data_split` (`dev_size`
+    being a fraction of train + dev), so each relation is split in these proportions in expectation. The
+    assignment of a group never depends on the other groups.
+
+    """
+    ghash = hashlib.sha256("{}\t{}\t{}".format(seed, src, tgt).encode("utf-8")).digest()
+    u = int.from_bytes(ghash[:8], "little") / 2 ** 64
+    if u < test_size:
+        return "test"
+    if u < test_size + (1 - test_size) * dev_size:
+        return "dev"
+    return "train"
+
+
+def hash_data_split(triples: Iterable[Tuple[str, str, str]],
+                    seed: int = None) -> Tuple[List[Tuple[str, str, str]], List[Tuple[str, str, str]], List[Tuple[str, str, str]]]:
+    """Alternative to `create_data_split`, assigning triples with `hash_split` in a single pass. Splits are stable
+    when triples are added, and all the triples of a group end up in the same split. Since relations are not
+    stratified, the relations without dev or test triples are reported.
+
+    """
+    seed = config.SEED if seed is None else seed
+    splits = {"train": list(), "dev": list(), "test": list()}
+    relation_counts = collections.defaultdict(collections.Counter)
+
+    for triple in triples:
+        split = hash_split(triple[0], triple[2], seed)
+        splits[split].append(triple)
+        relation_counts[triple[1]][split] += 1
+
+    # Relations are only split in the expected proportions on average, small ones may miss a split
+    missing = collections.defaultdict(list)
+    for relation, counts in sorted(relation_counts.items()):
+        logger.info("{}: train={}, dev={}, test={}".format(relation, counts["train"], counts["dev"], counts["test"]))
+        for split in ("dev", "test"):
+            if counts[split] == 0:
+                missing[split].append(relation)
+    for split, relations in missing.items():
+        logger.warning("{} relations have no {} triples: {}".format(len(relations), split, ", ".join(relations)))
+
+    logger.info(" *** Train triples : {} *** ".format(len(splits["train"])))
+    logger.info(" *** Dev triples : {} *** ".format(len(splits["dev"])))
+    logger.info(" *** Test triples : {} *** ".format(len(splits["test"])))
+
+    return splits["train"], splits["dev"], splits["test"]
+
+
+def split_lines(triples: List[Tuple[str, str, str]], group_to_data) -> Generator[Dict[str, Any], None, None]:
+    """Yields the lines of the split file of `triples`, one per relation of each group (and direction)."""
     groups = set()
     for ei, _, ek in triples:
         groups.add("{}\t{}".format(ei, ek))
-    lines = list()
     for group in groups:
         src, tgt = group.split("\t")
         if config.expand_rels or not config.k_tag:
@@ -433,28 +749,87 @@ def split_lines(triples: List[Tuple[str, str, str]], group_to_data) -> List[Dict
                         relation += "(e1,e2)"
                     else:  # src = e2, tgt = e1
                         relation += "(e2,e1)"
-                lines.append({
+                yield {
                     "group": (src, tgt),
                     "relation": relation,
                     "sentences": data["bag"],
                     "e1": data.get("e1", None), "e2": data.get("e2", None),
                     "reldir": rel_dir
-                })
-    return lines
+                }
 
 
-def report_data_stats(lines, triples):
-    stats = dict(
-        num_of_groups=len(lines),
-        num_of_sents=sum(len(line["sentences"]) for line in lines),
-        num_of_triples=len(triples)
-    )
-    for k, v in stats.items():
-        logger.info(" *** {} : {} *** ".format(k, v))
+class SplitStats:
+    """Statistics of the lines of a split file, counted as they are streamed through `track`, with their
+    (src, relation, tgt) triples and their (e1, relation, e2) triples (for expanded relations).
+
+    """
+
+    def __init__(self):
+        self.num_of_groups = 0
+        self.num_of_sents = 0
+        self.triples = set()
+        self.entity_triples = set()
+
+    def track(self, lines: Iterable[Dict[str, Any]]) -> Generator[Dict[str, Any], None, None]:
+        for line in lines:
+            self.num_of_groups += 1
+            self.num_of_sents += len(line["sentences"])
+            self.triples.add((line["group"][0], line["relation"], line["group"][1]))
+            self.entity_triples.add((line["e1"], line["relation"], line["e2"]))
+            yield line
+
+    def report(self, triples: Set[Tuple[str, str, str]]):
+        stats = dict(
+            num_of_groups=self.num_of_groups,
+            num_of_sents=self.num_of_sents,
+            num_of_triples=len(triples)
+        )
+        for k, v in stats.items():
+            logger.info(" *** {} : {} *** ".format(k, v))
 
 
 def write_final_jsonl_file(lines, output_fname):
+    # Remove the manifest of a previous sharded output, if any, so readers pick up the single file
+    if os.path.exists(manifest_fname(output_fname)):
+        os.remove(manifest_fname(output_fname))
+    # Shuffled in memory, see `write_sharded_jsonl_file` to stream large splits
+    lines = list(lines)
     random.shuffle(lines)
     with open(output_fname, "w") as wf:
         for line in lines:
             wf.write(json.dumps(line) + "\n")
+
+
+def write_sharded_jsonl_file(lines: Iterable[Dict[str, Any]], output_fname: str, num_shards: int, seed: int = None):
+    """Streaming alternative to `write_final_jsonl_file`, writing `num_shards` shuffled shards and a manifest.
+
+    Lines are first spread over the shards at random (in temporary files), then each shard is shuffled on its own,
+    so only one shard is held in memory at a time. The result is a uniform shuffle of all the lines.
+
+    """
+    seed = config.SEED if seed is None else seed
+    rng = random.Random(seed)
+    shard_fnames = [shard_fname(output_fname, idx, num_shards) for idx in range(num_shards)]
+
+    # A stale manifest would point readers to shards being rewritten
+    if os.path.exists(manifest_fname(output_fname)):
+        os.remove(manifest_fname(output_fname))
+
+    tmp_files = [open(f + ".tmp", "w") for f in shard_fnames]
+    for line in lines:
+        tmp_files[rng.randrange(num_shards)].write(json.dumps(line) + "\n")
+    for f in tmp_files:
+        f.close()
+
+    num_lines = list()
+    for fname in shard_fnames:
+        with open(fname + ".tmp") as rf:
+            shard = rf.readlines()
+        rng.shuffle(shard)
+        with open(fname, "w") as wf:
+            wf.writelines(shard)
+        os.remove(fname + ".tmp")
+        num_lines.append(len(shard))
+
+    write_manifest(output_fname, shard_fnames, num_lines, seed=seed)
+    logger.info("Wrote {} lines in {} shards of `{}`".format(sum(num_lines), num_shards, output_fname))
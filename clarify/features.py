@@ -0,0 +1,658 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import logging
+
+import numpy as np
+import torch
+
+from torch.utils.data import Dataset, Sampler
+
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+META_FILE = "meta.json"
+
+# Column name -> dtype; the `*_ids` columns have `max_seq_length` entries per row (unique sentence), `lengths` one
+# per row, `spans` four per row (see `entity_spans`), `rows` one per sentence of each bag (index into the rows),
+# `bag_ptr` one more than the no. of bags (CSR-style pointers into `rows`), and the other columns one per bag.
+COLUMNS = {
+    "input_ids": np.uint16,
+    "entity_ids": np.int8,
+    "lengths": np.int16,
+    "spans": np.int16,
+    "rows": np.int32,
+    "bag_ptr": np.int64,
+    "labels": np.int32,
+    "groups": np.int32,
+    "rel_dirs": np.int8,
+}
+
+
+# Columns of `SentenceTokens`; `ids` and `offsets` (start, end character offsets) have one entry per token of all the
+# sentences, `ptr` one more than the no. of sentences (CSR-style pointers into the tokens), and `sent_ids` one per
+# sentence, in increasing order.
+SENTENCE_COLUMNS = {
+    "ids": np.int32,
+    "offsets": np.int32,
+    "ptr": np.int64,
+    "sent_ids": np.int64,
+}
+
+
+def column_fname(dirname: str, column: str, columns: Dict[str, Any] = None) -> str:
+    columns = columns or COLUMNS
+    return os.path.join(dirname, "{}.{}".format(column, np.dtype(columns[column]).name))
+
+
+def read_column(dirname: str, column: str, columns: Dict[str, Any] = None, shape: Tuple[int, ...] = (-1,)) -> np.ndarray:
+    """Memory-maps a column file (files of empty columns can not be memory-mapped)."""
+    columns = columns or COLUMNS
+    fname = column_fname(dirname, column, columns)
+    if os.path.getsize(fname) == 0:
+        data = np.zeros(0, dtype=columns[column])
+    else:
+        data = np.memmap(fname, dtype=columns[column], mode="r")
+    return data.reshape(shape)
+
+
+def to_numpy(x) -> np.ndarray:
+    return x.numpy() if torch.is_tensor(x) else np.asarray(x)
+
+
+def entity_spans(entity_ids: np.ndarray) -> np.ndarray:
+    """Returns the (e1 start, e1 end, e2 start, e2 end) token offsets of the entities of each row (last axis) of
+    `entity_ids`, whose tokens are contiguous; (0, 0) for a missing entity.
+
+    """
+    entity_ids = np.asarray(entity_ids)
+    length = entity_ids.shape[-1]
+    spans = list()
+    for entity in (1, 2):
+        is_entity = entity_ids == entity
+        found = is_entity.any(axis=-1)
+        start = is_entity.argmax(axis=-1)
+        end = length - is_entity[..., ::-1].argmax(axis=-1)
+        spans.extend([np.where(found, start, 0), np.where(found, end, 0)])
+    return np.stack(spans, axis=-1).astype(np.int64)
+
+
+def row_keys(texts: Iterable[str]) -> np.ndarray:
+    """Stable 64-bit keys of rows, from texts identifying them (e.g. the sentence ID and entity spans)."""
+    return np.array([int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+                     for text in texts], dtype=np.uint64)
+
+
+class RowIndex:
+    """Map of 64-bit row keys (see `row_keys`) to row indices.
+
+    Keys and rows are kept in sorted NumPy arrays (16 bytes per row), where the latest ones, held in a dict, are
+    merged in batches. Lookups are vectorized binary searches.
+
+    """
+
+    MISSING = -2
+
+    def __init__(self, batch_size: int = 1000000):
+        self.batch_size = batch_size
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.rows = np.zeros(0, dtype=np.int64)
+        self.pending = dict()
+
+    def __len__(self) -> int:
+        return len(self.keys) + len(self.pending)
+
+    def lookup(self, keys: np.ndarray) -> np.ndarray:
+        """Returns the rows of `keys`, `RowIndex.MISSING` for the keys that are not in the index."""
+        keys = np.asarray(keys, dtype=np.uint64)
+        rows = np.full(len(keys), self.MISSING, dtype=np.int64)
+        if len(self.keys):
+            pos = np.searchsorted(self.keys, keys)
+            pos[pos == len(self.keys)] = 0
+            found = self.keys[pos] == keys
+            rows[found] = self.rows[pos[found]]
+        if self.pending:
+            for idx in np.nonzero(rows == self.MISSING)[0]:
+                rows[idx] = self.pending.get(int(keys[idx]), self.MISSING)
+        return rows
+
+    def update(self, keys: np.ndarray, rows: np.ndarray):
+        """Adds keys that are not in the index yet."""
+        self.pending.update(zip(np.asarray(keys, dtype=np.uint64).tolist(), np.asarray(rows).tolist()))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            keys = np.concatenate([self.keys, np.fromiter(self.pending.keys(), dtype=np.uint64, count=len(self.pending))])
+            rows = np.concatenate([self.rows, np.fromiter(self.pending.values(), dtype=np.int64, count=len(self.pending))])
+            order = np.argsort(keys, kind="stable")
+            self.keys, self.rows = keys[order], rows[order]
+            self.pending = dict()
+
+
+class RowCache:
+    """Persistent table of encoded rows, addressed by keys of their content (see `row_keys`).
+
+    Keys are meant to cover everything a row depends on (e.g. the sentence, entity spans, tokenizer and
+    `max_seq_length`), so that rows cached by a previous run can be reused as they are when the split files
+    change, and only new rows have to be encoded. Rows that could not be encoded are cached with a length of 0. The
+    table is append-only; files are truncated to the rows of the last `close` when opened, and reset if they were
+    written for another `max_seq_length`.
+
+    """
+
+    def __init__(self, dirname: str, max_seq_length: int):
+        self.dirname = dirname
+        self.max_seq_length = max_seq_length
+        self.columns = {"keys": np.uint64, "input_ids": COLUMNS["input_ids"], "entity_ids": COLUMNS["entity_ids"],
+                        "lengths": COLUMNS["lengths"]}
+        self.row_size = {"keys": 1, "input_ids": max_seq_length, "entity_ids": max_seq_length, "lengths": 1}
+
+        num_rows = 0
+        meta_fname = os.path.join(dirname, META_FILE)
+        if os.path.exists(meta_fname):
+            with open(meta_fname) as rf:
+                meta = json.load(rf)
+            if meta["max_seq_length"] == max_seq_length:
+                num_rows = meta["num_rows"]
+            else:
+                logger.info("Resetting row cache `{}` written for `max_seq_length` {}".format(dirname,
+                                                                                            meta["max_seq_length"]))
+
+        os.makedirs(dirname, exist_ok=True)
+        self.files = dict()
+        for column, dtype in self.columns.items():
+            fname = column_fname(dirname, column, self.columns)
+            self.files[column] = open(fname, "r+b" if os.path.exists(fname) else "w+b")
+            self.files[column].truncate(num_rows * self.row_size[column] * np.dtype(dtype).itemsize)
+            self.files[column].seek(0, os.SEEK_END)
+
+        self.num_rows = num_rows
+        self.maps = None
+        self.index = RowIndex()
+        if num_rows:
+            keys = read_column(dirname, "keys", self.columns)
+            order = np.argsort(keys, kind="stable")
+            self.index.keys, self.index.rows = np.asarray(keys[order]), order.astype(np.int64)
+
+        logger.info("Opened row cache `{}` with {} rows".format(dirname, num_rows))
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+    def lookup(self, keys: np.ndarray) -> np.ndarray:
+        return self.index.lookup(keys)
+
+    def add(self, keys: np.ndarray, input_ids: np.ndarray, entity_ids: np.ndarray, lengths: np.ndarray,
+            ok: np.ndarray):
+        """Adds rows whose keys are not in the cache yet."""
+        lengths = np.where(ok, lengths, 0)
+        for column, data in (("keys", keys), ("input_ids", input_ids), ("entity_ids", entity_ids),
+                             ("lengths", lengths)):
+            np.asarray(data).astype(self.columns[column]).tofile(self.files[column])
+
+        self.index.update(keys, self.num_rows + np.arange(len(keys)))
+        self.num_rows += len(keys)
+
+    def get(self, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Returns the input IDs, entity IDs and lengths of rows, and whether they could be encoded."""
+        if self.maps is None or (len(rows) and rows.max() >= len(self.maps["keys"])):
+            # Rows added since the files were mapped
+            for f in self.files.values():
+                f.flush()
+            self.maps = {column: read_column(self.dirname, column, self.columns,
+                                             (-1, self.max_seq_length) if self.row_size[column] > 1 else (-1,))
+                         for column in ("keys", "input_ids", "entity_ids", "lengths")}
+        lengths = self.maps["lengths"][rows]
+        return self.maps["input_ids"][rows], self.maps["entity_ids"][rows], lengths, lengths > 0
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.maps = None
+        with open(os.path.join(self.dirname, META_FILE), "w") as wf:
+            json.dump({"max_seq_length": self.max_seq_length, "num_rows": self.num_rows}, wf)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FeatureStoreWriter:
+    """Writes features in compact binary columns, appending them as they are created.
+
+    Compared to `torch.save` of the list of feature dicts, token IDs are stored as uint16 and entity IDs as int8
+    (instead of int64 and float32), and the attention mask of each sentence as its length. Bags are padded by
+    repeating sentences, and a sentence can be in the bags of several relations, so sentences are stored once in a
+    table of unique rows, and each bag as the indices of its rows. The output is a directory with one file per
+    column and a small `meta.json`, read back with `FeatureStore`.
+
+    """
+
+    def __init__(self, output_dir: str, max_seq_length: int, buffer_size: int = 10000):
+        self.output_dir = output_dir
+        self.max_seq_length = max_seq_length
+        self.buffer_size = buffer_size
+
+        os.makedirs(output_dir, exist_ok=True)
+        if os.path.exists(os.path.join(output_dir, META_FILE)):
+            os.remove(os.path.join(output_dir, META_FILE))
+        self.files = {column: open(column_fname(output_dir, column), "wb") for column in COLUMNS}
+        self.buffers = {column: list() for column in COLUMNS}
+        # Key of each row added with `add_rows` -> row index, or -1 if the row can not be used
+        self.row_index = RowIndex()
+        self.num_bags = 0
+        self.num_rows = 0
+        self.num_entries = 0
+        self.has_rel_dir = None
+        self.buffers["bag_ptr"].append(np.zeros(1, dtype=np.int64))
+
+    def add_rows(self, keys: Optional[np.ndarray], input_ids: np.ndarray, entity_ids: np.ndarray, lengths: np.ndarray,
+                 ok: Optional[np.ndarray] = None) -> np.ndarray:
+        """Adds rows to the table, where `ok` tells which rows can be used. Returns the indices of the rows (-1 for
+        the unusable ones), also recorded in `row_index` under `keys` unless `keys` is None.
+
+        """
+        input_ids, entity_ids, lengths = to_numpy(input_ids), to_numpy(entity_ids), to_numpy(lengths)
+        ok = np.ones(len(input_ids), dtype=bool) if ok is None else np.asarray(ok, dtype=bool)
+
+        if input_ids[ok].max(initial=0) > np.iinfo(COLUMNS["input_ids"]).max:
+            raise ValueError("Token IDs do not fit in the `input_ids` column")
+
+        rows = np.full(len(input_ids), -1, dtype=np.int64)
+        rows[ok] = self.num_rows + np.arange(int(ok.sum()))
+        if keys is not None:
+            self.row_index.update(keys, rows)
+
+        self.num_rows += int(ok.sum())
+        if self.num_rows > np.iinfo(COLUMNS["rows"]).max:
+            raise ValueError("Too many rows for the `rows` column")
+
+        self.buffers["input_ids"].append(input_ids[ok].astype(COLUMNS["input_ids"]))
+        self.buffers["entity_ids"].append(entity_ids[ok].astype(COLUMNS["entity_ids"]))
+        self.buffers["lengths"].append(lengths[ok].astype(COLUMNS["lengths"]))
+        self.buffers["spans"].append(entity_spans(entity_ids[ok]).astype(COLUMNS["spans"]))
+
+        return rows
+
+    def add_bag(self, rows: List[int], label: int, group: Tuple[int, int], rel_dir: Optional[int] = None):
+        """Adds a bag made of rows of the table."""
+        has_rel_dir = rel_dir is not None
+        if self.has_rel_dir is None:
+            self.has_rel_dir = has_rel_dir
+        elif self.has_rel_dir != has_rel_dir:
+            raise ValueError("Either all or none of the features must have a `rel_dir`")
+
+        self.num_entries += len(rows)
+        self.num_bags += 1
+
+        self.buffers["rows"].append(np.array(rows, dtype=COLUMNS["rows"]))
+        self.buffers["bag_ptr"].append(np.array([self.num_entries], dtype=COLUMNS["bag_ptr"]))
+        self.buffers["labels"].append(np.array([label], dtype=COLUMNS["labels"]))
+        self.buffers["groups"].append(np.array(group, dtype=COLUMNS["groups"]))
+        self.buffers["rel_dirs"].append(np.array([-1 if rel_dir is None else rel_dir], dtype=COLUMNS["rel_dirs"]))
+
+        if len(self.buffers["labels"]) >= self.buffer_size:
+            self.flush()
+
+    def add(self, feature: Dict[str, Any]):
+        """Adds a feature dict (as created for `torch.save`), storing the repeated sentences of its bag once."""
+        input_ids = to_numpy(feature["input_ids"])
+        entity_ids = to_numpy(feature["entity_ids"])
+        attention_mask = to_numpy(feature["attention_mask"])
+
+        lengths = attention_mask.sum(axis=1)
+        if not (attention_mask == (np.arange(attention_mask.shape[1])[None, :] < lengths[:, None])).all():
+            raise ValueError("Only right-padded sentences can be stored (attention masks are stored as lengths)")
+
+        _, first, inverse = np.unique(np.concatenate([input_ids, entity_ids], axis=1), axis=0,
+                                      return_index=True, return_inverse=True)
+        rows = self.add_rows(None, input_ids[first], entity_ids[first], lengths[first])
+
+        self.add_bag(rows[inverse.ravel()].tolist(), feature["label"], feature["group"], feature.get("rel_dir"))
+
+    def flush(self):
+        for column, buffer in self.buffers.items():
+            if buffer:
+                np.concatenate([b.ravel() for b in buffer]).tofile(self.files[column])
+                buffer.clear()
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+
+        meta = {
+            "max_seq_length": self.max_seq_length,
+            "num_bags": self.num_bags,
+            "num_rows": self.num_rows,
+            "num_entries": self.num_entries,
+            "has_rel_dir": bool(self.has_rel_dir),
+            "has_spans": True
+        }
+        with open(os.path.join(self.output_dir, META_FILE), "w") as wf:
+            json.dump(meta, wf)
+
+        logger.info("Wrote {} bags with {} sentences ({} unique) to `{}`".format(
+            self.num_bags, self.num_entries, self.num_rows, self.output_dir))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FeatureStore(Dataset):
+    """Dataset over the features written by `FeatureStoreWriter`.
+
+    Columns are memory-mapped, so opening the store reads nothing but `meta.json`, and forked DataLoader workers
+    share the pages of the same files. Items are (rows, group, label[, rel_dir]), where `rows` are the indices of
+    the sentences of the bag in the table of unique rows; `collate` gathers the rows of a batch and returns the same
+    batch as the `TensorDataset` built from the list of features: (input_ids, entity_ids, attention_mask, groups,
+    labels[, rel_dirs][, entity_spans]), all int64. Use it as the `collate_fn` of the DataLoader. With
+    `dynamic_padding`, sentences are padded to the longest one of the batch instead of `max_seq_length`.
+
+    With `packing` > 0, the distinct sentences of a batch are packed in rows of `packing` tokens (see `gather_packed`)
+    and batches are (input_ids, entity_ids, segment_ids, groups, labels[, rel_dirs], entity_spans, packed_index).
+
+    """
+
+    def __init__(self, input_dir: str, dynamic_padding: bool = False, packing: int = 0):
+        self.input_dir = input_dir
+        self.dynamic_padding = dynamic_padding
+        self.packing = packing
+
+        with open(os.path.join(input_dir, META_FILE)) as rf:
+            self.meta = json.load(rf)
+
+        if packing and (packing < self.meta["max_seq_length"] or not self.meta.get("has_spans")):
+            raise ValueError("Packing requires rows of at least `max_seq_length` ({}) tokens and a store with entity "
+                             "spans".format(self.meta["max_seq_length"]))
+
+        self.columns = None
+        self.positions = np.arange(self.meta["max_seq_length"])
+
+    def open(self):
+        shapes = {"input_ids": (-1, self.meta["max_seq_length"]), "entity_ids": (-1, self.meta["max_seq_length"]),
+                  "spans": (-1, 4), "groups": (-1, 2)}
+        # Stores written before entity spans were added have no `spans` column
+        self.columns = {column: read_column(self.input_dir, column, shape=shapes.get(column, (-1,)))
+                        for column in COLUMNS if column != "spans" or self.meta.get("has_spans")}
+
+    def __getstate__(self):
+        # Memory maps are not pickled, each process opens its own
+        state = self.__dict__.copy()
+        state["columns"] = None
+        return state
+
+    def __len__(self) -> int:
+        return self.meta["num_bags"]
+
+    def bag_lengths(self) -> np.ndarray:
+        """Returns the length of the longest sentence of each bag."""
+        if self.columns is None:
+            self.open()
+        columns = self.columns
+
+        lengths = columns["lengths"][columns["rows"]]
+        if len(lengths) == 0:
+            return np.zeros(len(self), dtype=np.int64)
+        # Bags are never empty, so each bag is reduced over its own rows
+        return np.maximum.reduceat(lengths, columns["bag_ptr"][:-1]).astype(np.int64)
+
+    def __getitem__(self, idx: int) -> Tuple[torch.Tensor, ...]:
+        if self.columns is None:
+            self.open()
+        columns = self.columns
+
+        lo, hi = columns["bag_ptr"][idx], columns["bag_ptr"][idx + 1]
+        item = (
+            torch.from_numpy(columns["rows"][lo:hi].astype(np.int64)),
+            torch.from_numpy(columns["groups"][idx].astype(np.int64)),
+            torch.tensor(int(columns["labels"][idx]), dtype=torch.long),
+        )
+        if self.meta["has_rel_dir"]:
+            item += (torch.tensor(int(columns["rel_dirs"][idx]), dtype=torch.long),)
+
+        return item
+
+    def gather(self, rows: np.ndarray) -> Tuple[torch.Tensor, ...]:
+        """Returns the input IDs, entity IDs and attention masks of `rows` (of any shape), and their entity spans if
+        the store has them, as int64 tensors.
+
+        """
+        if self.columns is None:
+            self.open()
+        columns = self.columns
+
+        # Each distinct row is read once, in the order of the files
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        inverse = inverse.reshape(rows.shape)
+        lengths = columns["lengths"][unique_rows]
+        width = max(int(lengths.max(initial=0)), 1) if self.dynamic_padding else len(self.positions)
+
+        tensors = (
+            torch.from_numpy(columns["input_ids"][unique_rows, :width].astype(np.int64)[inverse]),
+            torch.from_numpy(columns["entity_ids"][unique_rows, :width].astype(np.int64)[inverse]),
+            torch.from_numpy((self.positions[None, :width] < lengths[:, None]).astype(np.int64)[inverse]),
+        )
+        if "spans" in columns:
+            tensors += (torch.from_numpy(columns["spans"][unique_rows].astype(np.int64)[inverse]),)
+        return tensors
+
+    def gather_packed(self, rows: np.ndarray) -> Tuple[torch.Tensor, ...]:
+        """Packs the distinct sentences of `rows` (of any shape) in rows of `packing` tokens (see `pack_lengths`).
+
+        Returns the input IDs, entity IDs and segment IDs of the packed rows (R x `packing`), where the segment ID of
+        each token tells which sentence it belongs to (0 for padding), the entity spans of `rows` (relative to their
+        sentence) and the (packed row, offset) of each sentence of `rows`, as int64 tensors.
+
+        """
+        if self.columns is None:
+            self.open()
+        columns = self.columns
+
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        inverse = inverse.reshape(rows.shape)
+        lengths = columns["lengths"][unique_rows].astype(np.int64)
+        packed_rows, offsets = pack_lengths(lengths, self.packing)
+        num_packed = int(packed_rows.max(initial=-1)) + 1
+
+        # Each token of each sentence, and where it goes in the packed rows
+        sentence = np.repeat(np.arange(len(unique_rows)), lengths)
+        position = np.arange(len(sentence)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        packed_row, packed_position = packed_rows[sentence], offsets[sentence] + position
+
+        packed = list()
+        for column in ("input_ids", "entity_ids"):
+            values = np.zeros((num_packed, self.packing), dtype=np.int64)
+            values[packed_row, packed_position] = columns[column][unique_rows][sentence, position]
+            packed.append(torch.from_numpy(values))
+        segment_ids = np.zeros((num_packed, self.packing), dtype=np.int64)
+        segment_ids[packed_row, packed_position] = sentence + 1
+        packed.append(torch.from_numpy(segment_ids))
+
+        packed.append(torch.from_numpy(columns["spans"][unique_rows].astype(np.int64)[inverse]))
+        packed.append(torch.from_numpy(np.stack([packed_rows, offsets], axis=-1)[inverse]))
+        return tuple(packed)
+
+    def collate(self, items: List[Tuple[torch.Tensor, ...]]) -> Tuple[torch.Tensor, ...]:
+        rows, *others = zip(*items)
+        rows = torch.stack(rows).numpy()
+        if self.packing:
+            input_ids, entity_ids, segment_ids, *packed = self.gather_packed(rows)
+            return (input_ids, entity_ids, segment_ids) + tuple(torch.stack(other) for other in others) + tuple(packed)
+        input_ids, entity_ids, attention_mask, *spans = self.gather(rows)
+        # Entity spans come last, so that the other tensors keep their position in the batch
+        return (input_ids, entity_ids, attention_mask) + tuple(torch.stack(other) for other in others) + tuple(spans)
+
+
+def pack_lengths(lengths: np.ndarray, width: int) -> Tuple[np.ndarray, np.ndarray]:
+    """First-fit decreasing packing of sequences of `lengths` (at most `width`) in rows of `width` tokens. Returns
+    the row and the offset in the row of each sequence.
+
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    rows = np.zeros(len(lengths), dtype=np.int64)
+    offsets = np.zeros(len(lengths), dtype=np.int64)
+    # Tokens used in each row so far
+    used = list()
+    for idx in np.argsort(-lengths, kind="stable"):
+        length = lengths[idx]
+        row = next((row for row, size in enumerate(used) if size + length <= width), len(used))
+        if row == len(used):
+            used.append(0)
+        rows[idx], offsets[idx] = row, used[row]
+        used[row] += length
+    return rows, offsets
+
+
+def trim_padding(batch: Tuple[torch.Tensor, ...]) -> Tuple[torch.Tensor, ...]:
+    """Trims the input IDs, entity IDs and attention masks (the first three tensors) of a batch of right-padded
+    sentences to the longest sentence of the batch.
+
+    """
+    input_ids, entity_ids, attention_mask, *others = batch
+    width = max(int(attention_mask.sum(-1).max()), 1)
+    return (input_ids[..., :width], entity_ids[..., :width], attention_mask[..., :width]) + tuple(others)
+
+
+class BucketBatchSampler(Sampler):
+    """Batches of bags of similar lengths, so that dynamic padding leaves little padding in each batch.
+
+    Bags are shuffled, then split in buckets of `bucket_size` batches, each of which is sorted by bag length before
+    being split in batches; batches are then shuffled again, so that consecutive batches have unrelated lengths.
+    Random permutations come from torch, as with `RandomSampler`. With `bucket_size=0` and `shuffle=False`, all the
+    bags are sorted by length.
+
+    """
+
+    def __init__(self, lengths: np.ndarray, batch_size: int, bucket_size: int = 100, shuffle: bool = True):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+
+    def __len__(self) -> int:
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self) -> Iterator[List[int]]:
+        n = len(self.lengths)
+        order = torch.randperm(n).numpy() if self.shuffle else np.arange(n)
+
+        batches = list()
+        step = self.batch_size * self.bucket_size if self.bucket_size > 0 else max(n, 1)
+        for lo in range(0, n, step):
+            bucket = order[lo:lo + step]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            batches.extend(bucket[i:i + self.batch_size].tolist() for i in range(0, len(bucket), self.batch_size))
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return iter(batches)
+
+
+class SentenceTokensWriter:
+    """Writes the tokens of sentences, with their character offsets, to be read with `SentenceTokens`.
+
+    Sentences are tokenized without special tokens, truncation or padding, so that the rows of any (e1, e2) pair of
+    a sentence can be made from its tokens, by inserting the entity markers at the tokens of the entity spans.
+
+    """
+
+    def __init__(self, output_dir: str, **meta):
+        self.output_dir = output_dir
+        self.meta = meta
+
+        os.makedirs(output_dir, exist_ok=True)
+        if os.path.exists(os.path.join(output_dir, META_FILE)):
+            os.remove(os.path.join(output_dir, META_FILE))
+        self.files = {column: open(column_fname(output_dir, column, SENTENCE_COLUMNS), "wb")
+                      for column in SENTENCE_COLUMNS}
+        self.num_sentences = 0
+        self.num_tokens = 0
+        self.last_sent_id = -1
+        np.zeros(1, dtype=SENTENCE_COLUMNS["ptr"]).tofile(self.files["ptr"])
+
+    def add(self, sent_ids: np.ndarray, ids: np.ndarray, offsets: np.ndarray, lengths: np.ndarray):
+        """Adds sentences given their IDs (increasing, and greater than those added before), the concatenated token
+        IDs and (start, end) offsets of their tokens, and their no. of tokens.
+
+        """
+        sent_ids = np.asarray(sent_ids, dtype=SENTENCE_COLUMNS["sent_ids"])
+        if len(sent_ids) == 0:
+            return
+        if sent_ids[0] <= self.last_sent_id or (np.diff(sent_ids) <= 0).any():
+            raise ValueError("Sentence IDs must be added in increasing order")
+
+        np.asarray(ids, dtype=SENTENCE_COLUMNS["ids"]).tofile(self.files["ids"])
+        np.asarray(offsets, dtype=SENTENCE_COLUMNS["offsets"]).tofile(self.files["offsets"])
+        (self.num_tokens + np.cumsum(lengths)).astype(SENTENCE_COLUMNS["ptr"]).tofile(self.files["ptr"])
+        sent_ids.tofile(self.files["sent_ids"])
+
+        self.num_sentences += len(sent_ids)
+        self.num_tokens += int(np.sum(lengths))
+        self.last_sent_id = int(sent_ids[-1])
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+        meta = dict(self.meta, num_sentences=self.num_sentences, num_tokens=self.num_tokens)
+        with open(os.path.join(self.output_dir, META_FILE), "w") as wf:
+            json.dump(meta, wf)
+
+        logger.info("Wrote {} tokens of {} sentences to `{}`".format(self.num_tokens, self.num_sentences,
+                                                                      self.output_dir))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SentenceTokens:
+    """Memory-mapped tokens of the sentences written by `SentenceTokensWriter`, looked up by sentence ID."""
+
+    def __init__(self, input_dir: str):
+        self.input_dir = input_dir
+
+        with open(os.path.join(input_dir, META_FILE)) as rf:
+            self.meta = json.load(rf)
+
+        self.columns = None
+
+    def open(self):
+        shapes = {"offsets": (-1, 2)}
+        self.columns = {column: read_column(self.input_dir, column, SENTENCE_COLUMNS, shapes.get(column, (-1,)))
+                        for column in SENTENCE_COLUMNS}
+
+    def __getstate__(self):
+        # Memory maps are not pickled, each process opens its own
+        state = self.__dict__.copy()
+        state["columns"] = None
+        return state
+
+    def __len__(self) -> int:
+        return self.meta["num_sentences"]
+
+    def __getitem__(self, sent_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the token IDs and the (start, end) character offsets of the tokens of a sentence."""
+        if self.columns is None:
+            self.open()
+        columns = self.columns
+
+        pos = int(np.searchsorted(columns["sent_ids"], sent_id))
+        if pos == len(columns["sent_ids"]) or columns["sent_ids"][pos] != sent_id:
+            raise KeyError(sent_id)
+        lo, hi = columns["ptr"][pos], columns["ptr"][pos + 1]
+        return columns["ids"][lo:hi], columns["offsets"][lo:hi]
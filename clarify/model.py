@@ -38,34 +38,96 @@ class BertForDistantRE(PreTrainedModel):
             logits = logits.diagonal(dim1=1, dim2=2) # B x C
         return logits
     
+    @staticmethod
+    def mask_mean(sequence_output, entity_ids, entity):
+        """Mean of the hidden states of the tokens whose entity ID is `entity`, masking the whole sequences."""
+        mask = (entity_ids == entity).float() # N x L
+        e = sequence_output * mask.unsqueeze(-1) # N x L x H
+        return e.sum(1) / mask.sum(1).unsqueeze(-1) # Empty sequences will have all NaNs
+    
+    @staticmethod
+    def span_mean(sequence_output, start, end, rows=None):
+        """Mean of the hidden states of the tokens in [start, end) of each sequence, gathering only those tokens.
+        Sequence `i` is in row `rows[i]` of `sequence_output` if given (packed sequences), otherwise in row `i`.
+        
+        """
+        _, L, H = sequence_output.shape
+        start, end = start.reshape(-1), end.reshape(-1)
+        N = len(start)
+        rows = torch.arange(N, device=start.device) if rows is None else rows.reshape(-1)
+        lengths = (end - start).clamp(min=0)
+        seq_idx = torch.repeat_interleave(torch.arange(N, device=lengths.device), lengths) # T (no. of entity tokens)
+        # Position of each entity token within its span
+        offsets = torch.arange(len(seq_idx), device=lengths.device)
+        offsets = offsets - torch.repeat_interleave(lengths.cumsum(0) - lengths, lengths)
+        tokens = sequence_output.reshape(-1, H)[rows[seq_idx] * L + start[seq_idx] + offsets] # T x H
+        sums = sequence_output.new_zeros(N, H).index_add_(0, seq_idx, tokens) # N x H
+        return sums / lengths.unsqueeze(-1).to(sums.dtype) # Empty sequences will have all NaNs, as with the masks
+    
+    def encode_packed(self, input_ids, segment_ids, packed_index):
+        """Encodes rows of several packed sentences, where `segment_ids` tells which sentence each token belongs to
+        (0 for padding): tokens only attend to the tokens of their sentence, and positions restart at each sentence.
+        Returns the outputs of BERT, with the pooled [CLS] of each sentence (at `packed_index`) as pooled output.
+        
+        """
+        R, P = segment_ids.shape
+        same_segment = segment_ids.unsqueeze(-1) == segment_ids.unsqueeze(-2) # R x P x P, block-diagonal
+        attention_mask = torch.zeros(same_segment.shape, dtype=self.dtype, device=segment_ids.device)
+        attention_mask = attention_mask.masked_fill(~same_segment, torch.finfo(self.dtype).min).unsqueeze(1)
+        
+        # Position of each token in its sentence: distance to the last segment start
+        positions = torch.arange(P, device=segment_ids.device).expand(R, P)
+        is_start = torch.ones_like(same_segment[:, 0])
+        is_start[:, 1:] = segment_ids[:, 1:] != segment_ids[:, :-1]
+        position_ids = positions - (positions * is_start).cummax(-1)[0]
+        
+        outputs = self.bert(input_ids, attention_mask=attention_mask, position_ids=position_ids)
+        sequence_output = outputs[0]
+        cls_output = sequence_output[packed_index[..., 0].reshape(-1), packed_index[..., 1].reshape(-1)] # N x H
+        return (sequence_output, self.bert.pooler(cls_output.unsqueeze(1))) + tuple(outputs[2:])
+    
     def forward(self,
                 input_ids,
                 entity_ids=None,
                 attention_mask=None,
                 labels=None,
-                is_train=True):
+                is_train=True,
+                entity_spans=None,
+                packed_index=None):
         ## PART-I: Encode the sequence with BERT
-        B, G, L = input_ids.shape
-        
-        input_ids = input_ids.view(B*G, -1)
-        attention_mask = attention_mask = attention_mask.view(B*G, -1)
-        
-        outputs = self.bert(input_ids, attention_mask=attention_mask)
+        rows = None
+        if packed_index is not None:
+            # Sentences packed in rows (see `clarify.features.FeatureStore.gather_packed`), `attention_mask` holds
+            # segment IDs and `packed_index` the (row, offset) of each sentence, B x G x 2
+            if entity_spans is None:
+                raise ValueError("Packed sentences require entity spans")
+            B, G = packed_index.shape[:2]
+            outputs = self.encode_packed(input_ids, attention_mask, packed_index)
+            rows, starts = packed_index[..., 0], packed_index[..., 1].unsqueeze(-1)
+            entity_spans = entity_spans + starts # Spans in the packed rows
+        else:
+            B, G, L = input_ids.shape
+            
+            input_ids = input_ids.view(B*G, -1)
+            attention_mask = attention_mask = attention_mask.view(B*G, -1)
+            
+            outputs = self.bert(input_ids, attention_mask=attention_mask)
         sequence_output, pooled_output = outputs[0], outputs[1]
         
-        sequence_output = sequence_output.view(B, G, L, -1).clone() # B x G x L x H
-        pooled_output = pooled_output.view(B, G, -1).clone() # B x G x H
+        pooled_output = pooled_output.view(B, G, -1) # B x G x H
         
         ## PART-II: Get e1 and e2 hidden representations
-        e1_mask = (entity_ids == 1).float() # locations of e1 entity
-        e1 = sequence_output * e1_mask.unsqueeze(-1) # B x G x L x H
-        e1 = e1.sum(2) / e1_mask.sum(2).unsqueeze(-1) # Empty sequences will have all zeros
-        e1 = self.We(self.dropout(self.act(e1))) # B x G x H
+        if entity_spans is not None:
+            # (e1 start, e1 end, e2 start, e2 end) token offsets, B x G x 4: only the entity tokens are gathered
+            e1 = self.span_mean(sequence_output, entity_spans[..., 0], entity_spans[..., 1], rows).view(B, G, -1)
+            e2 = self.span_mean(sequence_output, entity_spans[..., 2], entity_spans[..., 3], rows).view(B, G, -1)
+        else:
+            # Locations of e1 and e2 entities
+            entity_ids = entity_ids.view(B * G, L)
+            e1 = self.mask_mean(sequence_output, entity_ids, 1).view(B, G, -1)
+            e2 = self.mask_mean(sequence_output, entity_ids, 2).view(B, G, -1)
         
-        # Similarly for e2 entity
-        e2_mask = (entity_ids == 2).float()
-        e2 = sequence_output * e2_mask.unsqueeze(-1)
-        e2 = e2.sum(2) / e2_mask.sum(2).unsqueeze(-1)
+        e1 = self.We(self.dropout(self.act(e1))) # B x G x H
         e2 = self.We(self.dropout(self.act(e2))) # B x G x H
         
         # PART-III: Average bag aggregation and relation classifier
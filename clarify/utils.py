@@ -1,8 +1,14 @@
 # -*- coding:utf-8 -*-
 
+import os
 import json
+import itertools
+import collections
+import multiprocessing
 
-from typing import Dict, Generator, Tuple, Any
+from concurrent.futures import ProcessPoolExecutor
+
+from typing import Dict, Generator, Tuple, Any, Callable, Iterable, List
 
 try:
     from apex import amp  # noqa: F401
@@ -31,13 +37,17 @@ class JsonlReader:
     def __init__(self, fname: str):
         self.fname = fname
     
-    def __iter__(self) -> Generator[Any, None, None]:
+    def iter_lines(self) -> Generator[str, None, None]:
         with open(self.fname, encoding="utf-8", errors="ignore") as rf:
             for jsonl in rf:
                 jsonl = jsonl.strip()
                 if not jsonl:
                     continue
-                yield json.loads(jsonl)
+                yield jsonl
+
+    def __iter__(self) -> Generator[Any, None, None]:
+        for jsonl in self.iter_lines():
+            yield json.loads(jsonl)
 
 
 class TriplesReader:
@@ -83,3 +93,78 @@ def read_entities(entities_file: str) -> Dict[str, int]:
             entity2idx[entity] = idx
             idx += 1
     return entity2idx
+
+
+def shard_fname(fname: str, idx: int, num_shards: int) -> str:
+    """E.g. `pubmed_train.txt` -> `pubmed_train-00001-of-00008.txt`."""
+    base, ext = os.path.splitext(fname)
+    return "{}-{:05d}-of-{:05d}{}".format(base, idx, num_shards, ext)
+
+
+def manifest_fname(fname: str) -> str:
+    return os.path.splitext(fname)[0] + ".manifest.json"
+
+
+def write_manifest(fname: str, shard_fnames: List[str], num_lines: List[int], **kwargs):
+    """Writes the manifest of a file written as shards, listing the shards (relative to its directory)."""
+    manifest = dict(shards=[os.path.basename(f) for f in shard_fnames], num_lines=num_lines, **kwargs)
+    with open(manifest_fname(fname), "w") as wf:
+        json.dump(manifest, wf, indent=2)
+
+
+def sharded_files(fname: str) -> List[str]:
+    """Returns the shards of `fname` listed in its manifest, or `[fname]` if it was not written as shards."""
+    if not os.path.exists(manifest_fname(fname)):
+        return [fname]
+    with open(manifest_fname(fname)) as rf:
+        manifest = json.load(rf)
+    return [os.path.join(os.path.dirname(fname), f) for f in manifest["shards"]]
+
+
+def file_fingerprint(fname: str) -> Dict[str, int]:
+    """Size and modification time of a file, kept by what is built from it to tell when it has changed."""
+    stat = os.stat(fname)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def iter_chunks(iterable: Iterable[Any], chunk_size: int) -> Generator[List[Any], None, None]:
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def ordered_imap(func: Callable[[Any], Any],
+                 iterable: Iterable[Any],
+                 workers: int = 1,
+                 max_pending: int = None,
+                 initializer: Callable = None,
+                 initargs: Tuple = ()) -> Generator[Any, None, None]:
+    """Lazily maps `func` over `iterable` with a pool of `workers` processes, yielding results in input order.
+
+    Unlike `executor.map`, at most `max_pending` tasks are in flight at any time, so that the input is never fully
+    materialized. Workers are forked, hence large read-only objects passed through `initargs` are shared with the
+    parent (copy-on-write) rather than pickled. With `workers <= 1` everything runs in the current process.
+
+    """
+    if workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for item in iterable:
+            yield func(item)
+        return
+
+    max_pending = max_pending or 2 * workers
+    mp_context = multiprocessing.get_context("fork")
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context,
+                             initializer=initializer, initargs=initargs) as executor:
+        pending = collections.deque()
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
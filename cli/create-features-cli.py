@@ -1,18 +1,24 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import torch
+import numpy as np
 
+import array
 import logging
 import config
-import functools
 import copy
+import itertools
 
-from transformers import BertTokenizer
-from concurrent.futures import ProcessPoolExecutor
-from clarify.utils import JsonlReader, read_entities, read_relations
+from transformers import BertTokenizer, BertTokenizerFast
+from clarify.utils import JsonlReader, read_entities, read_relations, sharded_files, shard_fname, manifest_fname, \
+    write_manifest, iter_chunks, ordered_imap
+from clarify.ds.evidence import EvidenceIndex
+from clarify.ds.splits import bag_sentences
+from clarify.features import FeatureStoreWriter, RowCache, RowIndex, SentenceTokens, SentenceTokensWriter, row_keys
 
-from typing import Dict, Tuple
+from typing import Any, Dict, Generator, Iterable, List, Mapping, Tuple, Union
 
 import torch.multiprocessing
 torch.multiprocessing.set_sharing_strategy('file_system')
@@ -20,6 +26,45 @@ torch.multiprocessing.set_sharing_strategy('file_system')
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Lines of the split file per task of the workers, with the slow tokenizer
+LINES_PER_CHUNK = 500
+
+# Evidence sentences of the bags, looked up by sentence ID (set per process, see `init_sentences`)
+_sentences = None
+# Tokenizer, mappings and options of `create_features` (set per worker, see `init_worker`)
+_options = None
+
+
+def init_sentences(evidence_index_dir: str):
+    global _sentences
+    _sentences = EvidenceIndex(evidence_index_dir).sentences
+
+
+def init_worker(evidence_index_dir: str, options: Dict[str, Any]):
+    global _options
+    init_sentences(evidence_index_dir)
+    _options = options
+
+
+def row_signature(tokenizer: BertTokenizerFast,
+                  max_seq_length: int = 128,
+                  e1_tok: str = "$",
+                  e2_tok: str = "^",
+                  entity_start: bool = False) -> str:
+    """Everything but the bag entry an encoded row depends on."""
+    return "\t".join(map(str, [type(tokenizer).__name__, tokenizer.name_or_path, len(tokenizer),
+                                getattr(tokenizer, "do_lower_case", None), max_seq_length, e1_tok, e2_tok,
+                                entity_start]))
+
+
+def content_keys(entries: Iterable[Tuple[int, int, int, int, int]], signature: str) -> np.ndarray:
+    """Keys of the rows of bag entries, from the text of their sentence, their entity spans and `signature` (see
+    `row_signature`), so that they do not depend on sentence IDs, which change when the evidence index is rebuilt.
+
+    """
+    return row_keys("{}\t{}\t{}".format(signature, "\t".join(map(str, entry[1:])), _sentences[entry[0]])
+                    for entry in entries)
+
 
 def tokenize_jsonl(jsonl: Dict[str, Tuple[str, str]],
                    tokenizer: BertTokenizer,
@@ -36,7 +81,8 @@ def tokenize_jsonl(jsonl: Dict[str, Tuple[str, str]],
     entity_ids = list()
     attention_mask = list()
     
-    for sent in jsonl["sentences"]:
+    # Bags hold sentence IDs and entity spans, entity markers are inserted here
+    for sent in bag_sentences(jsonl, _sentences):
         encoded = tokenizer.encode_plus(sent, max_length=max_seq_length, return_tensors='pt', padding='max_length', truncation=True)
 
         input_ids_i = encoded["input_ids"] # [..., :max_seq_length]
@@ -90,8 +136,350 @@ def tokenize_jsonl(jsonl: Dict[str, Tuple[str, str]],
     return features
 
 
-def load_tokenizer(do_lower_case: bool = False) -> BertTokenizer:
-    return BertTokenizer.from_pretrained(config.pretrained_model_dir, do_lower_case=do_lower_case)
+def tokenize_raw_sentences(sents: List[str], tokenizer: BertTokenizerFast) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Tokenizes sentences without special tokens, truncation or padding, in one call of the fast tokenizer.
+    Returns the token IDs and the (start, end) character offsets of the tokens of all the sentences, concatenated,
+    and the no. of tokens of each sentence.
+
+    """
+    # The Rust tokenizer is called directly, converting its output through `tokenizer(..)` takes longer than encoding
+    backend = tokenizer.backend_tokenizer
+    backend.no_truncation()
+    backend.no_padding()
+    encodings = backend.encode_batch(sents, add_special_tokens=False)
+
+    lengths = np.array([len(encoding.ids) for encoding in encodings], dtype=np.int64)
+    ids = np.fromiter(itertools.chain.from_iterable(encoding.ids for encoding in encodings), dtype=np.int64,
+                      count=int(lengths.sum()))
+    offsets = np.fromiter(itertools.chain.from_iterable(itertools.chain.from_iterable(encoding.offsets)
+                                                        for encoding in encodings),
+                          dtype=np.int64, count=2 * int(lengths.sum())).reshape(-1, 2)
+    return ids, offsets, lengths
+
+
+def tokenize_chunk_sentences(sent_ids: Iterable[int],
+                             tokenizer: BertTokenizerFast) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+    """Tokenizes the distinct sentences of `sent_ids`, when their tokens were not written beforehand with
+    `build_sentence_tokens`. Returns the same mapping as `SentenceTokens`.
+
+    """
+    sent_ids = sorted(set(sent_ids))
+    ids, offsets, lengths = tokenize_raw_sentences([_sentences[sent_id] for sent_id in sent_ids], tokenizer)
+    ptr = np.cumsum(np.append(0, lengths))
+    return {sent_id: (ids[ptr[idx]:ptr[idx + 1]], offsets[ptr[idx]:ptr[idx + 1]]) for idx, sent_id in enumerate(sent_ids)}
+
+
+def encode_entries(entries: List[Tuple[int, int, int, int, int]],
+                   sentence_tokens: Mapping[int, Tuple[np.ndarray, np.ndarray]],
+                   tokenizer: BertTokenizerFast,
+                   max_seq_length: int = 128,
+                   e1_tok: str = "$",
+                   e2_tok: str = "^",
+                   entity_start: bool = False) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Encodes bag entries (sentence ID, e1 start, e1 end, e2 start, e2 end) from the tokens of their sentences, by
+    inserting the entity markers around the tokens of the entity spans (which gives the same tokens as encoding the
+    sentences annotated by `mark_sentence`, except that mentions are not replaced by the entity texts). Returns
+    the input IDs, entity IDs and attention masks, and whether each entry could be encoded.
+
+    Since the markers are placed before truncation, a sentence longer than `max_seq_length` is truncated around
+    its entities instead of at its end, when they are close enough to fit.
+
+    """
+    e1_id, e2_id = tokenizer.convert_tokens_to_ids(e1_tok), tokenizer.convert_tokens_to_ids(e2_tok)
+    cls_id, sep_id, pad_id = tokenizer.cls_token_id, tokenizer.sep_token_id, tokenizer.pad_token_id
+    window = max_seq_length - 2
+
+    input_ids = np.full((len(entries), max_seq_length), pad_id, dtype=np.int64)
+    entity_ids = np.zeros((len(entries), max_seq_length), dtype=np.float32)
+    attention_mask = np.zeros((len(entries), max_seq_length), dtype=np.int64)
+    ok = np.zeros(len(entries), dtype=bool)
+
+    for idx, (sent_id, e1_start, e1_end, e2_start, e2_end) in enumerate(entries):
+        ids, offsets = sentence_tokens[sent_id]
+        # Marker characters are removed from the sentences (see `mark_sentence`)
+        keep = (ids != e1_id) & (ids != e2_id)
+        ids, offsets = ids[keep], offsets[keep]
+
+        # Tokens overlapping the character spans
+        e1_lo, e1_hi = np.searchsorted(offsets[:, 1], e1_start, "right"), np.searchsorted(offsets[:, 0], e1_end)
+        e2_lo, e2_hi = np.searchsorted(offsets[:, 1], e2_start, "right"), np.searchsorted(offsets[:, 0], e2_end)
+        if e1_lo >= e1_hi or e2_lo >= e2_hi or (e1_lo < e2_hi and e2_lo < e1_hi):
+            continue
+
+        # Positions of the opening and closing markers once inserted
+        if e1_lo < e2_lo:
+            tokens = [ids[:e1_lo], [e1_id], ids[e1_lo:e1_hi], [e1_id], ids[e1_hi:e2_lo],
+                      [e2_id], ids[e2_lo:e2_hi], [e2_id], ids[e2_hi:]]
+            e1_pos, e2_pos = (e1_lo, e1_hi + 1), (e2_lo + 2, e2_hi + 3)
+        else:
+            tokens = [ids[:e2_lo], [e2_id], ids[e2_lo:e2_hi], [e2_id], ids[e2_hi:e1_lo],
+                      [e1_id], ids[e1_lo:e1_hi], [e1_id], ids[e1_hi:]]
+            e1_pos, e2_pos = (e1_lo + 2, e1_hi + 3), (e2_lo, e2_hi + 1)
+        tokens = np.concatenate(tokens)
+
+        first, last = min(e1_pos[0], e2_pos[0]), max(e1_pos[1], e2_pos[1])
+        if last - first + 1 > window:
+            continue
+        # Keeps the beginning of the sentence, unless the last marker would be cut
+        offset = max(0, last + 1 - window)
+        tokens = tokens[offset:offset + window]
+
+        length = len(tokens) + 2
+        input_ids[idx, :length] = np.concatenate([[cls_id], tokens, [sep_id]])
+        attention_mask[idx, :length] = 1
+        # Positions in the row, after [CLS]
+        e1_pos, e2_pos = [p + 1 - offset for p in e1_pos], [p + 1 - offset for p in e2_pos]
+        if entity_start:
+            entity_ids[idx, e1_pos[0]] = 1
+            entity_ids[idx, e2_pos[0]] = 2
+        else:
+            entity_ids[idx, e1_pos[0] + 1:e1_pos[1]] = 1
+            entity_ids[idx, e2_pos[0] + 1:e2_pos[1]] = 2
+        ok[idx] = True
+
+    return input_ids, entity_ids, attention_mask, ok
+
+
+def tokenize_jsonl_batch(jsonls: List[Dict[str, Tuple[str, str]]],
+                         tokenizer: BertTokenizerFast,
+                         entity2idx: Dict[str, int],
+                         relation2idx: Dict[str, int],
+                         max_seq_length: int = 128,
+                         e1_tok: str = "$",
+                         e2_tok: str = "^",
+                         entity_start: bool = False,
+                         sentence_tokens: SentenceTokens = None):
+    """Same as `tokenize_jsonl` for a list of lines, with each distinct sentence of their bags tokenized once (or
+    read from `sentence_tokens`), and the entity markers of each bag entry inserted at token level (see
+    `encode_entries`).
+
+    """
+    entries = [tuple(entry) for jsonl in jsonls for entry in jsonl["sentences"]]
+    if not entries:
+        return []
+    if sentence_tokens is None:
+        sentence_tokens = tokenize_chunk_sentences((entry[0] for entry in entries), tokenizer)
+
+    # Bags are padded by repeating sentences, each distinct entry is encoded once
+    entry2row = dict()
+    rows = np.array([entry2row.setdefault(entry, len(entry2row)) for entry in entries], dtype=np.int64)
+    input_ids, entity_ids, attention_mask, ok = [x[rows] for x in encode_entries(
+        list(entry2row), sentence_tokens, tokenizer, max_seq_length, e1_tok, e2_tok, entity_start
+    )]
+    bounds = np.cumsum([0] + [len(jsonl["sentences"]) for jsonl in jsonls])
+
+    features = list()
+    for idx, jsonl in enumerate(jsonls):
+        lo, hi = bounds[idx], bounds[idx + 1]
+        # Can happen when entities are too far apart to fit in `max_seq_length` tokens, ignore such bags
+        if lo == hi or not ok[lo:hi].all():
+            continue
+
+        src, tgt = jsonl["group"]
+        feature = dict(
+            input_ids=torch.from_numpy(input_ids[lo:hi].copy()),
+            entity_ids=torch.from_numpy(entity_ids[lo:hi].copy()),
+            attention_mask=torch.from_numpy(attention_mask[lo:hi].copy()),
+            label=relation2idx[jsonl["relation"]],
+            group=(entity2idx[src], entity2idx[tgt]),
+        )
+        if config.expand_rels or not config.k_tag:
+            # 0 = src "before" tgt; 1 = tgt "before" src
+            feature["rel_dir"] = 0 if jsonl["reldir"] == 1 else 1
+        features.append(feature)
+
+    return features
+
+
+def encode_jsonl_batch(jsonls: List[Dict[str, Tuple[str, str]]],
+                       tokenizer: BertTokenizerFast,
+                       entity2idx: Dict[str, int],
+                       relation2idx: Dict[str, int],
+                       max_seq_length: int = 128,
+                       e1_tok: str = "$",
+                       e2_tok: str = "^",
+                       entity_start: bool = False,
+                       sentence_tokens: SentenceTokens = None,
+                       bag_keys: np.ndarray = None,
+                       new_keys: np.ndarray = None) -> Dict[str, np.ndarray]:
+    """Same as `tokenize_jsonl_batch`, but returns bags as the keys of their entries (see `content_keys`) with the
+    rows encoded once per key, to be added to a feature store with `write_encoded_batch`. The keys of the entries
+    are computed unless given as `bag_keys`, and only the rows of `new_keys` are encoded if given (see
+    `dispatch_chunks`).
+
+    """
+    entries, bag_sizes = list(), list()
+    labels, groups, rel_dirs = list(), list(), list()
+    for jsonl in jsonls:
+        src, tgt = jsonl["group"]
+        entries.extend(tuple(entry) for entry in jsonl["sentences"])
+        bag_sizes.append(len(jsonl["sentences"]))
+        labels.append(relation2idx[jsonl["relation"]])
+        groups.append((entity2idx[src], entity2idx[tgt]))
+        if config.expand_rels or not config.k_tag:
+            # 0 = src "before" tgt; 1 = tgt "before" src
+            rel_dirs.append(0 if jsonl["reldir"] == 1 else 1)
+
+    if bag_keys is None:
+        bag_keys = content_keys(entries, row_signature(tokenizer, max_seq_length, e1_tok, e2_tok, entity_start))
+    keys, first = unique_keys(bag_keys)
+    if new_keys is not None:
+        new = np.isin(keys, new_keys)
+        keys, first = keys[new], first[new]
+
+    new_entries = [entries[idx] for idx in first]
+    if sentence_tokens is None:
+        sentence_tokens = tokenize_chunk_sentences((entry[0] for entry in new_entries), tokenizer)
+    input_ids, entity_ids, attention_mask, ok = encode_entries(
+        new_entries, sentence_tokens, tokenizer, max_seq_length, e1_tok, e2_tok, entity_start
+    )
+
+    return dict(
+        keys=keys,
+        input_ids=input_ids,
+        entity_ids=entity_ids,
+        lengths=attention_mask.sum(axis=1),
+        ok=ok,
+        bag_keys=bag_keys,
+        bag_ptr=np.cumsum([0] + bag_sizes),
+        labels=np.array(labels, dtype=np.int64),
+        groups=np.array(groups, dtype=np.int64).reshape(-1, 2),
+        rel_dirs=np.array(rel_dirs, dtype=np.int64) if rel_dirs else None,
+    )
+
+
+def unique_keys(keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the distinct keys and the index of their first occurrence, in order of first occurrence (so that the
+    rows of a bag are close to each other in the store).
+
+    """
+    keys, first = np.unique(keys, return_index=True)
+    order = np.argsort(first)
+    return keys[order], first[order]
+
+
+def dispatch_chunks(chunks: Iterable[List[Dict[str, Tuple[str, str]]]],
+                    signature: str,
+                    known: Tuple[RowIndex, ...] = ()) -> Generator[Tuple[Any, np.ndarray, np.ndarray], None, None]:
+    """Yields the chunks of split lines with the keys of their entries (see `content_keys`) and the keys of the rows
+    to encode: those that are neither in any of the `known` indices nor in a previous chunk. Runs in the main
+    process, so that a row repeated across chunks is encoded once whatever the no. of workers.
+
+    """
+    dispatched = RowIndex()
+    for jsonls in chunks:
+        entries = [tuple(entry) for jsonl in jsonls for entry in jsonl["sentences"]]
+        bag_keys = content_keys(entries, signature)
+        keys, _ = unique_keys(bag_keys)
+        for row_index in known + (dispatched,):
+            keys = keys[row_index.lookup(keys) == RowIndex.MISSING]
+        dispatched.update(keys, np.zeros(len(keys), dtype=np.int64))
+        yield jsonls, bag_keys, keys
+
+
+def write_encoded_batch(writer: FeatureStoreWriter, batch: Dict[str, np.ndarray], row_cache: RowCache = None) -> int:
+    """Adds the rows and bags of a batch returned by `encode_jsonl_batch` to `writer`, taking the rows that were not
+    encoded from `row_cache`, and adding those that were to it. Returns the no. of bags added.
+
+    Batches must be added in the order of `dispatch_chunks`, since the rows left to a previous chunk are looked up
+    in `writer`.
+
+    """
+    keys, _ = unique_keys(batch["bag_keys"])
+    keys = keys[writer.row_index.lookup(keys) == RowIndex.MISSING]
+
+    if row_cache is not None:
+        cached = row_cache.lookup(keys)
+        hit = cached != RowIndex.MISSING
+        writer.add_rows(keys[hit], *row_cache.get(cached[hit]))
+        keys = keys[~hit]
+
+    # The other rows were encoded with this batch
+    order = np.argsort(batch["keys"])
+    pos = order[np.searchsorted(batch["keys"], keys, sorter=order)] if len(keys) else np.zeros(0, dtype=np.int64)
+    encoded = [batch[column][pos] for column in ("input_ids", "entity_ids", "lengths", "ok")]
+    writer.add_rows(keys, *encoded)
+    if row_cache is not None:
+        row_cache.add(keys, *encoded)
+
+    rows = writer.row_index.lookup(batch["bag_keys"])
+    bag_ptr = batch["bag_ptr"]
+
+    num_bags = 0
+    for idx in range(len(batch["labels"])):
+        rows_i = rows[bag_ptr[idx]:bag_ptr[idx + 1]]
+        # Can happen when entities are too far apart to fit in `max_seq_length` tokens, ignore such bags
+        if len(rows_i) == 0 or rows_i.min() < 0:
+            continue
+
+        rel_dir = None if batch["rel_dirs"] is None else int(batch["rel_dirs"][idx])
+        writer.add_bag(rows_i.tolist(), int(batch["labels"][idx]), tuple(batch["groups"][idx].tolist()), rel_dir)
+        num_bags += 1
+
+    return num_bags
+
+
+def _tokenize_chunk(jsonls: List[Dict[str, Tuple[str, str]]]) -> List[Dict[str, Any]]:
+    kwargs = {k: _options[k] for k in ("tokenizer", "entity2idx", "relation2idx", "max_seq_length", "e1_tok",
+                                        "e2_tok", "entity_start")}
+    if _options["batch_size"] > 0:
+        return tokenize_jsonl_batch(jsonls, sentence_tokens=_options["sentence_tokens"], **kwargs)
+    return [feature for jsonl in jsonls for feature in tokenize_jsonl(jsonl, **kwargs)]
+
+
+def _encode_chunk(task: Tuple[List[Dict[str, Tuple[str, str]]], np.ndarray, np.ndarray]) -> Dict[str, np.ndarray]:
+    jsonls, bag_keys, new_keys = task
+    kwargs = {k: _options[k] for k in ("tokenizer", "entity2idx", "relation2idx", "max_seq_length", "e1_tok",
+                                        "e2_tok", "entity_start")}
+    return encode_jsonl_batch(jsonls, sentence_tokens=_options["sentence_tokens"], bag_keys=bag_keys,
+                              new_keys=new_keys, **kwargs)
+
+
+def _tokenize_sentences_chunk(sent_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    return (sent_ids,) + tokenize_raw_sentences([_sentences[sent_id] for sent_id in sent_ids], _options["tokenizer"])
+
+
+def build_sentence_tokens(jsonl_fnames: List[str],
+                          tokenizer: BertTokenizerFast,
+                          output_dir: str,
+                          evidence_index_dir: str = None,
+                          workers: int = 1,
+                          chunk_size: int = 10000,
+                          row_cache: RowCache = None,
+                          signature: str = None) -> SentenceTokens:
+    """Tokenizes, once, each distinct sentence of the bags of the split files (see `SentenceTokens`), skipping the
+    sentences whose entries all have their rows in `row_cache` (see `row_signature`).
+
+    """
+    evidence_index_dir = evidence_index_dir or config.evidence_index_dir
+    if row_cache is not None:
+        init_sentences(evidence_index_dir)
+
+    sent_ids = array.array("q")
+    for jsonl_fname in jsonl_fnames:
+        for jsonls in iter_chunks(JsonlReader(jsonl_fname), 1000):
+            entries = list({tuple(entry) for jsonl in jsonls for entry in jsonl["sentences"]})
+            if row_cache is not None and entries:
+                missing = row_cache.lookup(content_keys(entries, signature)) == RowIndex.MISSING
+                entries = [entry for entry, m in zip(entries, missing) if m]
+            sent_ids.extend(entry[0] for entry in entries)
+    sent_ids = np.unique(np.frombuffer(sent_ids, dtype=np.int64))
+    logger.info("Tokenizing {} distinct sentences ...".format(len(sent_ids)))
+
+    chunks = (sent_ids[lo:lo + chunk_size] for lo in range(0, len(sent_ids), chunk_size))
+    results = ordered_imap(_tokenize_sentences_chunk, chunks, workers=workers, initializer=init_worker,
+                           initargs=(evidence_index_dir, dict(tokenizer=tokenizer)))
+
+    with SentenceTokensWriter(output_dir, tokenizer=tokenizer.name_or_path) as writer:
+        for result in results:
+            writer.add(*result)
+
+    return SentenceTokens(output_dir)
+
+
+def load_tokenizer(do_lower_case: bool = False, fast: bool = False) -> Union[BertTokenizer, BertTokenizerFast]:
+    tokenizer_class = BertTokenizerFast if fast else BertTokenizer
+    return tokenizer_class.from_pretrained(config.pretrained_model_dir, do_lower_case=do_lower_case)
 
 
 def create_features(jsonl_fname: str,
@@ -102,53 +490,132 @@ def create_features(jsonl_fname: str,
                     max_seq_length: int = 128,
                     e1_tok: str = "$",
                     e2_tok: str = "^",
-                    entity_start: bool = False):
-    jr = list(iter(JsonlReader(jsonl_fname)))
+                    entity_start: bool = False,
+                    evidence_index_dir: str = None,
+                    batch_size: int = 0,
+                    writer: FeatureStoreWriter = None,
+                    workers: int = 1,
+                    sentence_tokens: SentenceTokens = None,
+                    row_cache: RowCache = None) -> int:
+    """Creates the features of a split file, saved at `output_fname` with `torch.save`, or added to `writer` if
+    given. Returns the no. of features.
+
+    The split file is read lazily, in chunks of `batch_size` lines (`tokenizer` must then be a fast tokenizer) or of
+    `LINES_PER_CHUNK` lines with the slow tokenizer, encoded by `workers` processes with at most `2 * workers`
+    chunks in flight. The tokenizer and the mappings are set once per worker (see `init_worker`). With `writer`,
+    each chunk is added to the store as soon as it is encoded, so memory does not grow with the split file. With
+    the fast tokenizer, sentences are read from `sentence_tokens` if given (see `build_sentence_tokens`),
+    otherwise tokenized once per chunk, and rows are taken from `row_cache` (with `writer`) when they were encoded
+    by a previous run. The rows to encode are assigned to chunks before they are dispatched to the workers (see
+    `dispatch_chunks`), so that each distinct row is encoded once.
+
+    """
+    evidence_index_dir = evidence_index_dir or config.evidence_index_dir
+    options = dict(tokenizer=tokenizer, entity2idx=entity2idx, relation2idx=relation2idx,
+                   max_seq_length=max_seq_length, e1_tok=e1_tok, e2_tok=e2_tok, entity_start=entity_start,
+                   batch_size=batch_size, sentence_tokens=sentence_tokens)
+    # Bags are stored as rows of unique sentences with the fast tokenizer, otherwise feature dicts are created
+    encode = writer is not None and batch_size > 0
+
+    chunks = iter_chunks(JsonlReader(jsonl_fname), batch_size if batch_size > 0 else LINES_PER_CHUNK)
+    if encode:
+        init_sentences(evidence_index_dir)
+        known = (writer.row_index,) + ((row_cache.index,) if row_cache is not None else ())
+        chunks = dispatch_chunks(chunks, row_signature(tokenizer, max_seq_length, e1_tok, e2_tok, entity_start), known)
+    results = ordered_imap(_encode_chunk if encode else _tokenize_chunk, chunks, workers=workers,
+                           initializer=init_worker, initargs=(evidence_index_dir, options))
+
     features = list()
-    serial = False
-    
-    if serial:
-        for idx, jsonl in enumerate(jr):
-            if idx % 10000 == 0 and idx != 0:
-                logger.info("Created {} features".format(idx))
-            
-            features.extend(tokenize_jsonl(
-                jsonl, tokenizer, entity2idx, relation2idx,
-                max_seq_length, e1_tok, e2_tok, entity_start
-            ))
-    else:
-        func = functools.partial(
-            tokenize_jsonl, tokenizer=tokenizer, entity2idx=entity2idx, 
-            relation2idx=relation2idx, max_seq_length=max_seq_length, 
-            e1_tok=e1_tok, e2_tok=e2_tok, entity_start=entity_start
-        )
-        with ProcessPoolExecutor(max_workers=8) as executor:
-            for idx, features_idx in enumerate(executor.map(func, jr, chunksize=500)):
-                if idx % 10000 == 0 and idx != 0:
-                    logger.info("Created {} features".format(idx))
-                if features_idx is None:
-                    continue
-                features.extend(copy.deepcopy(features_idx))
-    
-    torch.save(features, output_fname)
+    num_features = 0
+    for idx, result in enumerate(results):
+        if idx % 50 == 0 and idx != 0:
+            logger.info("Created {} features".format(num_features))
+
+        if encode:
+            num_features += write_encoded_batch(writer, result, row_cache)
+            continue
+
+        num_features += len(result)
+        if writer is not None:
+            for feature in result:
+                writer.add(feature)
+        elif workers > 1:
+            # Tensors of the workers are received in shared memory (see `set_sharing_strategy`), copies release it
+            features.extend(copy.deepcopy(result))
+        else:
+            features.extend(result)
+
+    if writer is None:
+        torch.save(features, output_fname)
+
+    return num_features
 
 
 if __name__ == "__main__":
-    tokenizer = load_tokenizer(config.do_lower_case)
+    tokenizer = load_tokenizer(config.do_lower_case, fast=config.features_batch_size > 0)
 
     entity2idx = read_entities(config.entities_file)
     relation2idx = read_relations(config.relations_file, with_dir=config.expand_rels)
 
     files = [
-        (config.train_file, config.train_feats_file),
-        (config.dev_file, config.dev_feats_file),
-        (config.test_file, config.test_feats_file)
+        (config.train_file, config.train_feats_file, config.train_feats_dir),
+        (config.dev_file, config.dev_feats_file, config.dev_feats_dir),
+        (config.test_file, config.test_feats_file, config.test_feats_dir)
     ]
 
-    for input_fname, output_fname in files:
-        logger.info("Creating features for input `{}` ...".format(input_fname))
+    entity_start = not config.entity_pool
+
+    # Rows encoded by previous runs are reused, only new ones are encoded (feature stores, with the fast tokenizer)
+    row_cache = None
+    if config.row_cache and config.feature_store and config.features_batch_size > 0:
+        row_cache = RowCache(config.row_cache_dir, config.max_seq_length)
+
+    sentence_tokens = None
+    if config.features_batch_size > 0:
+        # Sentences shared by several entity pairs (and bags) are tokenized once, for all the splits
+        sentence_tokens = build_sentence_tokens(
+            [fname for input_fname, _, _ in files for fname in sharded_files(input_fname)], tokenizer,
+            config.sentence_tokens_dir, workers=config.features_workers, row_cache=row_cache,
+            signature=row_signature(tokenizer, config.max_seq_length, entity_start=entity_start)
+        )
+
+    for input_fname, output_fname, output_dir in files:
+        # Split files written as shards give one features file per shard, listed in a manifest
+        input_fnames = sharded_files(input_fname)
+
+        if config.feature_store:
+            # All the shards are appended to the same store
+            with FeatureStoreWriter(output_dir, config.max_seq_length) as writer:
+                for input_fname_i in input_fnames:
+                    logger.info("Creating features for input `{}` ...".format(input_fname_i))
+                    create_features(input_fname_i, tokenizer, None, entity2idx, relation2idx, config.max_seq_length,
+                                    entity_start=entity_start, batch_size=config.features_batch_size,
+                                    writer=writer, workers=config.features_workers,
+                                    sentence_tokens=sentence_tokens, row_cache=row_cache)
+            logger.info("Saved features at `{}` ...".format(output_dir))
+            continue
+
+        if len(input_fnames) > 1:
+            output_fnames = [shard_fname(output_fname, idx, len(input_fnames)) for idx in range(len(input_fnames))]
+        else:
+            output_fnames = [output_fname]
+            if os.path.exists(manifest_fname(output_fname)):
+                os.remove(manifest_fname(output_fname))
+
+        num_features = list()
+        for input_fname_i, output_fname_i in zip(input_fnames, output_fnames):
+            logger.info("Creating features for input `{}` ...".format(input_fname_i))
+
+            num_features.append(create_features(input_fname_i, tokenizer, output_fname_i, entity2idx, relation2idx,
+                                                config.max_seq_length, entity_start=entity_start,
+                                                batch_size=config.features_batch_size,
+                                                workers=config.features_workers,
+                                                sentence_tokens=sentence_tokens))
+
+            logger.info("Saved features at `{}` ...".format(output_fname_i))
 
-        create_features(input_fname, tokenizer, output_fname, entity2idx, relation2idx, config.max_seq_length,
-                        entity_start=not config.entity_pool)
+        if len(input_fnames) > 1:
+            write_manifest(output_fname, output_fnames, num_features)
 
-        logger.info("Saved features at `{}` ...".format(output_fname))
+    if row_cache is not None:
+        row_cache.close()
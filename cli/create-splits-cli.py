@@ -6,9 +6,14 @@ import os
 
 from clarify.utils import JsonlReader
 from clarify.ds.umls import UMLSVocab
-from clarify.ds.splits import get_groups_texts_from_umls_vocab, align_groups_to_sentences, pruned_triples, \
-    filter_triples_with_evidence, split_lines, report_data_stats, remove_overlapping_sents, write_final_jsonl_file, \
-    create_data_split
+from clarify.ds.pairs import load_or_build_group_pair_index
+from clarify.ds.evidence import load_or_build_evidence_index
+from clarify.ds.negatives import NegativeSampler, GroupSet
+from clarify.ds.pruning import PruningIndex
+from clarify.ds.splits import align_groups_to_sentences, \
+    collect_group_evidence, build_bags, group_triples, split_lines, SplitStats, heldout_sentence_ids, remove_overlapping_sents, write_final_jsonl_file, \
+    create_data_split, hash_data_split, write_canonical_dataset, load_canonical_dataset, write_sharded_jsonl_file, \
+    canonical_params, canonical_dataset_is_current, alignment_options, check_alignment_options
 
 import logging
 
@@ -17,43 +22,97 @@ logger = logging.getLogger(__name__)
 
 
 if __name__ == "__main__":
-    # Load UMLS vocab object
-    logger.info("Loading UMLS vocab object `{}` ...".format(config.umls_vocab_file))
-    uv = UMLSVocab.load(config.umls_vocab_file)
-
-    # See if the file was created before, read it
+    # The aligned file is reused as long as it exists, it must have been written with the current alignment options
     if os.path.exists(config.groups_linked_sents_file):
-        pos_groups = set()
-        neg_groups = set()
-
-        logger.info("Reading groups linked file `{}` ...".format(config.groups_linked_sents_file))
-        for jdata in JsonlReader(config.groups_linked_sents_file):
-            pos_groups.update(jdata["groups"]["p"])
-            neg_groups.update(jdata["groups"]["n"])
+        check_alignment_options(config.groups_linked_sents_file,
+                                alignment_options(config.negative_strategy, config.max_matches_per_sentence))
+
+    # Steps 1-5 do not depend on the tagging scheme: their output is written once to `config.canonical_dir`,
+    # and the k-tag, s-tag and expand_rels datasets are all derived from it. It is rebuilt when the configuration of
+    # these steps, the aligned file or the UMLS vocab change
+    params = canonical_params(config.groups_linked_sents_file, config.umls_vocab_file)
+    if canonical_dataset_is_current(config.canonical_dir, params):
+        logger.info("Loading canonical dataset `{}` ...".format(config.canonical_dir))
+        canonical = load_canonical_dataset(config.canonical_dir)
+        group_to_relation_texts = canonical["group_to_relation_texts"]
+        group_to_evidence = canonical["group_to_evidence"]
+        train_triples = canonical["splits"]["train"]
+        dev_triples = canonical["splits"]["dev"]
+        test_triples = canonical["splits"]["test"]
 
     else:
-        # 1. Collect all possible group texts from their CUIs
-        groups_texts = get_groups_texts_from_umls_vocab(uv)
-
-        # group_texts is a set of tab-separated surface form pairs,
-        # corresponding to CUI pairs appearing in the values of uv.relation_text_to_groups
-
-        # 2. Search for text alignment of groups (this can take up to 80~90 mins)
-
-        # config.medline_linked_sents_file -> umls_linked_sentences.jsonl (list of {"sent": sentence, "matches": ..})
-        pos_groups, neg_groups = align_groups_to_sentences(groups_texts, config.medline_linked_sents_file,
-                                                           config.groups_linked_sents_file)
-        # config.groups_linked_sents_file -> linked_sentences_to_groups.jsonl
-        #   {"sent": .., "matches": .., "groups": {"p": ["a\tb", "c\td", ..], "n": ..}}
-
-    # 3. From collected groups and pruning relations criteria, get final triples
-    triples = pruned_triples(uv, pos_groups, neg_groups, config.min_rel_group, config.max_rel_group)
-
-    # triples: list of (s, p, o) triples, where entities and relation types are represented by their surface forms
-
-    # 4. Collect evidences and filter triples based on sizes of collected bags
-    triples, group_to_data = filter_triples_with_evidence(triples, config.bag_size, k_tag=config.k_tag,
-                                                          expand_rels=config.expand_rels)
+        # Steps 1-2 and the mapping of relations to groups are only needed once (until the aligned file or the UMLS
+        # vocab change), the pruning thresholds can then be explored with tools/pruning-cli.py
+        pruning_sources = {"aligned": config.groups_linked_sents_file, "umls_vocab": config.umls_vocab_file}
+        if PruningIndex.is_current(config.pruning_index_dir, pruning_sources):
+            logger.info("Loading pruning index `{}` ...".format(config.pruning_index_dir))
+            pruning_index = PruningIndex.load(config.pruning_index_dir)
+
+        else:
+            # Load UMLS vocab object
+            logger.info("Loading UMLS vocab object `{}` ...".format(config.umls_vocab_file))
+            uv = UMLSVocab.load(config.umls_vocab_file)
+
+            # See if the file was created before, read it
+            if os.path.exists(config.groups_linked_sents_file):
+                pos_groups = set()
+                neg_groups = GroupSet()
+
+                logger.info("Reading groups linked file `{}` ...".format(config.groups_linked_sents_file))
+                for jdata in JsonlReader(config.groups_linked_sents_file):
+                    pos_groups.update(jdata["groups"]["p"])
+                    neg_groups.update(jdata["groups"]["n"])
+
+            else:
+                # 1. Collect all possible group texts from their CUIs
+                pair_index = load_or_build_group_pair_index(uv, config.group_pair_index_dir)
+
+                # pair_index is a compact set of surface form pairs (packed integer IDs),
+                # corresponding to CUI pairs appearing in the values of uv.relation_text_to_groups
+
+                # 2. Search for text alignment of groups (this can take up to 80~90 mins with a single worker)
+
+                # config.medline_linked_sents_file -> umls_linked_sentences.jsonl (list of {"sent": sentence, "matches": ..})
+                linked_sents = config.medline_linked_sents_dir if config.linked_sents_binary else config.medline_linked_sents_file
+                sampler = NegativeSampler(config.negative_strategy, pair_index)
+                pos_groups, neg_groups = align_groups_to_sentences(pair_index, linked_sents, config.groups_linked_sents_file,
+                                                                   workers=config.alignment_workers, seed=config.SEED,
+                                                                   max_matches=config.max_matches_per_sentence,
+                                                                   sampler=sampler)
+                # config.groups_linked_sents_file -> linked_sentences_to_groups.jsonl
+                #   {"sent": .., "matches": .., "groups": {"p": ["a\tb", "c\td", ..], "n": ..}}
+
+            pruning_index = PruningIndex.build(uv, pos_groups, neg_groups)
+            logger.info("Saving pruning index at `{}` ...".format(config.pruning_index_dir))
+            pruning_index.save(config.pruning_index_dir, sources=pruning_sources)
+
+        # 3. From collected groups and pruning relations criteria, get final triples
+        triples = pruning_index.triples(config.min_rel_group, config.max_rel_group, na_ratio=config.na_ratio,
+                                        seed=config.SEED)
+
+        # triples: list of (s, p, o) triples, where entities and relation types are represented by their surface forms
+
+        # 4. Collect evidences and filter triples without any
+        evidence_index = load_or_build_evidence_index(config.groups_linked_sents_file, config.evidence_index_dir)
+        group_to_relation_texts, group_to_evidence = collect_group_evidence(triples, evidence_index)
+
+        # 5. Split into train, dev and test at triple level to keep zero triples overlap
+        if config.split_mode == "hash":
+            train_triples, dev_triples, test_triples = hash_data_split(group_triples(group_to_relation_texts),
+                                                                       seed=config.SEED)
+        else:
+            train_triples, dev_triples, test_triples = create_data_split(group_triples(group_to_relation_texts))
+
+        logger.info("Saving canonical dataset at `{}` ...".format(config.canonical_dir))
+        write_canonical_dataset(config.canonical_dir, {"train": train_triples, "dev": dev_triples, "test": test_triples},
+                                group_to_relation_texts, group_to_evidence, config.evidence_index_dir,
+                                params=canonical_params(config.groups_linked_sents_file,
+                                                       config.umls_vocab_file))
+
+    # 6. Build the bags of the current tagging scheme and filter triples based on sizes of collected bags
+    group_to_data = build_bags(group_to_relation_texts, group_to_evidence, config.bag_size,
+                               k_tag=config.k_tag, expand_rels=config.expand_rels)
+    triples = group_triples(group_to_relation_texts)
 
     logger.info(" *** No. of triples (after filtering) *** : {}".format(len(triples)))
 
@@ -77,45 +136,47 @@ if __name__ == "__main__":
     logger.info(" *** No. of entities *** : {}".format(len(E)))
     logger.info(" *** No. of relations *** : {}".format(len(R)))
 
-    # 5. Split into train, dev and test at triple level to keep zero triples overlap
-    train_triples, dev_triples, test_triples = create_data_split(triples)
-    train_lines = split_lines(train_triples, group_to_data)
-    dev_lines = split_lines(dev_triples, group_to_data)
-    test_lines = split_lines(test_triples, group_to_data)
+    def write_split_file(lines, fname):
+        logger.info("Creating file at `{}` ...".format(fname))
+        if config.split_shards > 1:
+            write_sharded_jsonl_file(lines, fname, config.split_shards, seed=config.SEED)
+        else:
+            write_final_jsonl_file(lines, fname)
+
+    # 7. Write actual train, dev, test files with sentence, group and relation. Lines are streamed split by split
+    # into their files, only the sentence IDs of the dev and test bags are collected first, to remove any overlapping
+    # test and dev sentences from training
+    heldout_ids = heldout_sentence_ids(split_lines(dev_triples, group_to_data), split_lines(test_triples, group_to_data))
+
+    train_stats_before, train_stats = SplitStats(), SplitStats()
+    train_lines = train_stats_before.track(split_lines(train_triples, group_to_data))
+    train_lines = remove_overlapping_sents(train_lines, heldout_ids, bag_size=config.bag_size, seed=config.SEED)
+    write_split_file(train_stats.track(train_lines), config.train_file)
+
+    dev_stats, test_stats = SplitStats(), SplitStats()
+    write_split_file(dev_stats.track(split_lines(dev_triples, group_to_data)), config.dev_file)
+    write_split_file(test_stats.track(split_lines(test_triples, group_to_data)), config.test_file)
 
-    # Remove any overlapping test and dev sentences from training
     logger.info("Train stats before removing overlapping sentences ...")
-    report_data_stats(train_lines, train_triples)
-    train_lines, train_triples = remove_overlapping_sents(train_lines, test_lines)
-    train_lines, train_triples = remove_overlapping_sents(train_lines, dev_lines)
+    train_stats_before.report(train_triples)
+    train_triples = train_stats.triples
 
     logger.info("Train stats after removing dev + test overlapping sentences ...")
-    report_data_stats(train_lines, train_triples)
+    train_stats.report(train_triples)
 
     # Triples should be of form (e1, r(e1,e2)/r(e2,e1), e2) when relation class is expanded
     if config.expand_rels:
-        temp = set()
-        for line in train_lines:
-            temp.add((line["e1"], line["relation"], line["e2"]))
-        train_triples = set(temp)
-        # dev
-        temp = set()
-        for line in dev_lines:
-            temp.add((line["e1"], line["relation"], line["e2"]))
-        dev_triples = set(temp)
-        # test
-        temp = set()
-        for line in test_lines:
-            temp.add((line["e1"], line["relation"], line["e2"]))
-        test_triples = set(temp)
+        train_triples = train_stats.entity_triples
+        dev_triples = dev_stats.entity_triples
+        test_triples = test_stats.entity_triples
 
     logger.info("Final stats ...")
     print("TRAIN")
-    report_data_stats(train_lines, train_triples)
+    train_stats.report(train_triples)
     print("DEV")
-    report_data_stats(dev_lines, dev_triples)
+    dev_stats.report(dev_triples)
     print("TEST")
-    report_data_stats(test_lines, test_triples)
+    test_stats.report(test_triples)
 
     with open(config.train_triples_file, "w") as wf:
         for ei, rj, ek in train_triples:
@@ -128,11 +189,3 @@ if __name__ == "__main__":
     with open(config.test_triples_file, "w") as wf:
         for ei, rj, ek in test_triples:
             wf.write("{}\t{}\t{}\n".format(ei, rj, ek))
-
-    # 6. Write actual train, dev, test files with sentence, group and relation
-    logger.info("Creating training file at `{}` ...".format(config.train_file))
-    write_final_jsonl_file(train_lines, config.train_file)
-    logger.info("Creating development file at `{}` ...".format(config.dev_file))
-    write_final_jsonl_file(dev_lines, config.dev_file)
-    logger.info("Creating testing file at `{}` ...".format(config.test_file))
-    write_final_jsonl_file(test_lines, config.test_file)
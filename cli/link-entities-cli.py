@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import config
+
+from clarify.ds.linking import MultiSourceEntityLinking, link_sentences_multi
+
+from clarify.ds.umls import UMLSVocab
+from clarify.ds.drugbank import DrugBankVocab
+
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Source name -> (vocab class, vocab file, JSONL output, columnar output)
+SOURCES = {
+    "umls": (UMLSVocab, config.umls_vocab_file,
+             config.medline_linked_sents_file, config.medline_linked_sents_dir),
+    "drugbank": (DrugBankVocab, config.drugbank_vocab_file,
+                 config.drugbank_medline_linked_sents_file, config.drugbank_medline_linked_sents_dir)
+}
+
+
+if __name__ == "__main__":
+    source_to_entities = dict()
+    output_fnames = dict()
+
+    for source in config.linking_sources:
+        vocab_cls, vocab_file, jsonl_fname, binary_dir = SOURCES[source]
+
+        logger.info("Loading {} vocab object `{}` ...".format(source, vocab_file))
+        uv = vocab_cls.load(vocab_file)
+
+        source_to_entities[source] = list(uv.entity_text_to_cuis.keys())
+        output_fnames[source] = binary_dir if config.linked_sents_binary else jsonl_fname
+
+    linker = MultiSourceEntityLinking(source_to_entities, config.case_sensitive_linker)
+
+    link_sentences_multi(linker, config.medline_unique_sents_file, output_fnames, config.combined_linked_sents_file,
+                         config.min_sent_char_len_linker, config.max_sent_char_len_linker,
+                         binary=config.linked_sents_binary)
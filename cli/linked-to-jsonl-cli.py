@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import logging
+import config
+
+from clarify.ds.linked import linked_sentences_to_jsonl
+
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+    files = [
+        (config.medline_linked_sents_dir, config.medline_linked_sents_file),
+        (config.drugbank_medline_linked_sents_dir, config.drugbank_medline_linked_sents_file)
+    ]
+
+    for input_dir, output_fname in files:
+        # e.g. DrugBank is not linked in the UMLS-only setup
+        if not os.path.exists(input_dir):
+            logger.info("Skipping `{}`, which does not exist".format(input_dir))
+            continue
+        logger.info("Converting linked sentences `{}` to `{}` ...".format(input_dir, output_fname))
+        n = linked_sentences_to_jsonl(input_dir, output_fname)
+        logger.info("Converted {} linked sentences".format(n))
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import logging
+import config
+
+from clarify.ds.linking import relink_sentences_delta
+
+from clarify.ds.umls import UMLSVocab
+
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+    logger.info("Loading previous UMLS vocab object `{}` ...".format(config.previous_umls_vocab_file))
+    old_uv = UMLSVocab.load(config.previous_umls_vocab_file)
+    logger.info("Loading UMLS vocab object `{}` ...".format(config.umls_vocab_file))
+    new_uv = UMLSVocab.load(config.umls_vocab_file)
+
+    linked_fname = config.medline_linked_sents_dir if config.linked_sents_binary else config.medline_linked_sents_file
+    delta_fname = linked_fname + ".delta"
+
+    relink_sentences_delta(old_uv.entity_text_to_cuis.keys(), new_uv.entity_text_to_cuis.keys(), linked_fname,
+                           config.medline_unique_sents_file, delta_fname,
+                           config.min_sent_char_len_linker, config.max_sent_char_len_linker,
+                           case_sensitive=config.case_sensitive_linker, binary=config.linked_sents_binary)
+
+    # Patch the linked sentences in place
+    logger.info("Replacing `{}` with the re-linked sentences ...".format(linked_fname))
+    if os.path.isdir(linked_fname):
+        shutil.rmtree(linked_fname)
+    os.replace(delta_fname, linked_fname)
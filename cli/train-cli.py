@@ -18,7 +18,8 @@ import numpy as np
 import torch
 import config
 
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
+from torch.utils.data import ConcatDataset, DataLoader, RandomSampler, SequentialSampler, TensorDataset
+from torch.utils.data.dataloader import default_collate
 from tqdm import tqdm, trange
 
 from transformers import AdamW, get_linear_schedule_with_warmup
@@ -26,9 +27,10 @@ from transformers import AdamW, get_linear_schedule_with_warmup
 from transformers import BertConfig
 from tensorboardX import SummaryWriter
 from clarify.model import BertForDistantRE
+from clarify.features import FeatureStore, BucketBatchSampler, entity_spans, trim_padding
 from sklearn import metrics
 
-from clarify.utils import read_entities, read_relations
+from clarify.utils import read_entities, read_relations, sharded_files
 from clarify.utils import TriplesReader as read_triples
 
 logging.basicConfig(
@@ -38,6 +40,10 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Datasets and evaluation metadata of each split, loaded once per process and reused by every evaluation
+_datasets = dict()
+_eval_metadata = dict()
+
 
 def set_seed():
     seed = config.SEED
@@ -94,8 +100,13 @@ def train(train_dataset, model):
     tb_writer = SummaryWriter()
     train_batch_size = config.per_gpu_train_batch_size * max(1, config.n_gpu)
     
-    train_sampler = RandomSampler(train_dataset)
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=train_batch_size)
+    if config.bucket_sampler:
+        train_sampler = BucketBatchSampler(bag_lengths(train_dataset), train_batch_size, config.bucket_size)
+        train_dataloader = DataLoader(train_dataset, batch_sampler=train_sampler, collate_fn=collate_fn(train_dataset))
+    else:
+        train_sampler = RandomSampler(train_dataset)
+        train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=train_batch_size,
+                                      collate_fn=collate_fn(train_dataset))
     
     t_total = min(len(train_dataloader) // config.gradient_accumulation_steps * config.num_train_epochs, 75000)
     
@@ -163,6 +174,8 @@ def train(train_dataset, model):
                 "entity_ids": batch[1],
                 "attention_mask": batch[2],
                 "labels": batch[4],
+                "entity_spans": batch_entity_spans(batch),
+                "packed_index": batch_packed_index(batch),
                 "is_train": True
             }
             outputs = model(**inputs)
@@ -288,14 +301,21 @@ def evaluate(model, set_type="dev", prefix=""):
     results = {}
     
     eval_output_dir = config.output_dir
-    eval_dataset = load_dataset(set_type)
+    eval_dataset = get_dataset(set_type)
     
     if not os.path.exists(eval_output_dir):
         os.makedirs(eval_output_dir)
     
     config.eval_batch_size = config.per_gpu_eval_batch_size * max(1, config.n_gpu)
-    eval_sampler = SequentialSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=config.eval_batch_size)
+    if config.dynamic_padding:
+        # Bags sorted by length leave little padding in each batch, metrics do not depend on their order
+        eval_sampler = BucketBatchSampler(bag_lengths(eval_dataset), config.eval_batch_size, bucket_size=0,
+                                          shuffle=False)
+        eval_dataloader = DataLoader(eval_dataset, batch_sampler=eval_sampler, collate_fn=collate_fn(eval_dataset))
+    else:
+        eval_sampler = SequentialSampler(eval_dataset)
+        eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=config.eval_batch_size,
+                                     collate_fn=collate_fn(eval_dataset))
     
     # multi-gpu eval
     if config.n_gpu > 1 and not isinstance(model, torch.nn.DataParallel):
@@ -323,6 +343,8 @@ def evaluate(model, set_type="dev", prefix=""):
                 "entity_ids": batch[1],
                 "attention_mask": batch[2],
                 "labels": batch[4],
+                "entity_spans": batch_entity_spans(batch),
+                "packed_index": batch_packed_index(batch),
                 "is_train": False
             }
             outputs = model(**inputs)
@@ -367,29 +389,97 @@ def save_eval_results(results, eval_dir, set_type, prefix=""):
             wf.write("%s = %s\n" % (key, str(results[key])))
 
 
+def batch_entity_spans(batch):
+    """Returns the (e1 start, e1 end, e2 start, e2 end) entity spans of a batch, which come after the other tensors,
+    or None if the features have none (the model then pools the entities with the entity IDs).
+
+    """
+    num_tensors = 6 if config.expand_rels or not config.k_tag else 5
+    return batch[num_tensors] if len(batch) > num_tensors else None
+
+
+def batch_packed_index(batch):
+    """Returns the (packed row, offset) of each sentence of a batch of packed sentences, which comes after the entity
+    spans, or None if the sentences are not packed.
+
+    """
+    num_tensors = 7 if config.expand_rels or not config.k_tag else 6
+    return batch[num_tensors] if len(batch) > num_tensors else None
+
+
+def collate_trimmed(items):
+    return trim_padding(default_collate(items))
+
+
+def collate_fn(dataset):
+    """Collate function of the DataLoader of `dataset`, padding each batch to its longest sentence with
+    `config.dynamic_padding` (done by the feature store itself).
+
+    """
+    if isinstance(dataset, FeatureStore):
+        return dataset.collate
+    return collate_trimmed if config.dynamic_padding else None
+
+
+def bag_lengths(dataset):
+    """Length of the longest sentence of each bag of `dataset`."""
+    if isinstance(dataset, FeatureStore):
+        return dataset.bag_lengths()
+    # Attention masks of the `TensorDataset` of each shard, B x G x L
+    datasets = dataset.datasets if isinstance(dataset, ConcatDataset) else [dataset]
+    return np.concatenate([d.tensors[2].sum(-1).max(-1)[0].numpy() for d in datasets])
+
+
+def get_dataset(set_type):
+    """Returns the dataset of `set_type`, loaded on first use and then reused, so that the periodic evaluations
+    during training do not load the features again (feature stores are memory-mapped, and only opened once).
+
+    """
+    if set_type not in _datasets:
+        _datasets[set_type] = load_dataset(set_type)
+    return _datasets[set_type]
+
+
 def load_dataset(set_type):
     if set_type == "train":
-        features_file = config.train_feats_file
+        features_file, features_dir = config.train_feats_file, config.train_feats_dir
     elif set_type == "dev":
-        features_file = config.dev_feats_file
-    else:
-        features_file = config.test_feats_file
-    
-    logger.info("Loading features from cached file %s", features_file)
-    features = torch.load(features_file)
-    
-    all_input_ids = torch.cat([f["input_ids"].unsqueeze(0) for f in features]).long()
-    all_entity_ids = torch.cat([f["entity_ids"].unsqueeze(0) for f in features]).long()
-    all_attention_mask = torch.cat([f["attention_mask"].unsqueeze(0) for f in features]).long()
-    all_groups = torch.cat([torch.tensor(f["group"]).unsqueeze(0) for f in features]).long()
-    all_labels = torch.tensor([f["label"] for f in features]).long()
-    if config.expand_rels or not config.k_tag:
-        all_dirs = torch.tensor([f["rel_dir"] for f in features]).long()
-        dataset = TensorDataset(all_input_ids, all_entity_ids, all_attention_mask, all_groups, all_labels, all_dirs) 
+        features_file, features_dir = config.dev_feats_file, config.dev_feats_dir
     else:
-        dataset = TensorDataset(all_input_ids, all_entity_ids, all_attention_mask, all_groups, all_labels) 
+        features_file, features_dir = config.test_feats_file, config.test_feats_dir
+    
+    if config.feature_store:
+        # Memory-mapped, the sentences of the bags of each batch are gathered by `FeatureStore.collate`
+        logger.info("Loading features from store %s", features_dir)
+        return FeatureStore(features_dir, dynamic_padding=config.dynamic_padding, packing=config.packing_length)
+    
+    # Features of split files written as shards are loaded one shard at a time, each shard as its own dataset so that
+    # they are not copied again into a single one
+    datasets = list()
+    for features_file_i in sharded_files(features_file):
+        logger.info("Loading features from cached file %s", features_file_i)
+        features = torch.load(features_file_i)
+        if not features:
+            continue
+
+        shard_tensors = [
+            torch.cat([f["input_ids"].unsqueeze(0) for f in features]).long(),
+            torch.cat([f["entity_ids"].unsqueeze(0) for f in features]).long(),
+            torch.cat([f["attention_mask"].unsqueeze(0) for f in features]).long(),
+            torch.cat([torch.tensor(f["group"]).unsqueeze(0) for f in features]).long(),
+            torch.tensor([f["label"] for f in features]).long()
+        ]
+        if config.expand_rels or not config.k_tag:
+            shard_tensors.append(torch.tensor([f["rel_dir"] for f in features]).long())
+        # Entity spans, last as in `FeatureStore.collate`
+        shard_tensors.append(torch.from_numpy(entity_spans(shard_tensors[1].numpy())))
+        datasets.append(TensorDataset(*shard_tensors))
+        del features
+
+    if not datasets:
+        raise ValueError("No features in {}".format(features_file))
     
-    return dataset
+    return datasets[0] if len(datasets) == 1 else ConcatDataset(datasets)
 
 
 # cf. https://stackoverflow.com/a/480227
@@ -406,21 +496,32 @@ def non_dup_ordered_seq(seq):
     return non_dup_seq
 
 
+def get_eval_metadata(set_type):
+    """Returns the relation mapping and the (src, relation, tgt) triples of `set_type` (entities as IDs, without NA
+    triples), read on first use and then reused.
+
+    """
+    if set_type not in _eval_metadata:
+        # Read relation mappings 
+        rel2idx = read_relations(config.relations_file, config.expand_rels)
+        entity2idx = read_entities(config.entities_file)
+        
+        # Read triples
+        triples = set()
+        if set_type == "dev":
+            triples_file = config.dev_triples_file
+        else:
+            triples_file = config.test_triples_file
+        for src, rel, tgt in read_triples(triples_file):
+            if rel != "NA":
+                triples.add((entity2idx[src], rel, entity2idx[tgt]))
+        
+        _eval_metadata[set_type] = (rel2idx, triples)
+    return _eval_metadata[set_type]
+
+
 def compute_metrics(logits, labels, groups, set_type, rel_dirs=None):
-    # Read relation mappings 
-    rel2idx = read_relations(config.relations_file, config.expand_rels)
-    idx2rel = {v:k for k, v in rel2idx.items()}
-    entity2idx = read_entities(config.entities_file)
-    
-    # Read triples
-    triples = set()
-    if set_type == "dev":
-        triples_file = config.dev_triples_file
-    else:
-        triples_file = config.test_triples_file
-    for src, rel, tgt in read_triples(triples_file):
-        if rel != "NA":
-            triples.add((entity2idx[src], rel, entity2idx[tgt]))
+    rel2idx, triples = get_eval_metadata(set_type)
     
     # RE predictions
     probas = torch.nn.Softmax(-1)(logits)
@@ -479,6 +580,10 @@ def compute_metrics(logits, labels, groups, set_type, rel_dirs=None):
 
 
 def main():
+    if config.packing_length and config.n_gpu > 1:
+        # DataParallel splits batches along their first dimension, i.e. the packed rows instead of the bags
+        raise ValueError("Packing sentences (`packing_length`) is not supported with several GPUs")
+
     num_labels = len(read_relations(config.relations_file, config.expand_rels))
     num_ents = len(read_entities(config.entities_file))
 
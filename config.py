@@ -16,10 +16,37 @@ medline_unique_sents_file = os.path.join(MEDLINE_DIR, "medline_unique_sentences.
 medline_linked_sents_file = os.path.join(MEDLINE_DIR, "umls_linked_sentences.jsonl")
 drugbank_medline_linked_sents_file = os.path.join(MEDLINE_DIR, "drugbank_linked_sentences.jsonl")
 
+# Compact columnar alternative to the linked sentences JSONL files (see clarify/ds/linked.py)
+linked_sents_binary = False
+medline_linked_sents_dir = os.path.join(MEDLINE_DIR, "umls_linked_sentences")
+drugbank_medline_linked_sents_dir = os.path.join(MEDLINE_DIR, "drugbank_linked_sentences")
+
+# Single-pass linking against several vocabularies (cli/link-entities-cli.py)
+linking_sources = ["umls", "drugbank"]
+combined_linked_sents_file = os.path.join(MEDLINE_DIR, "linked_sentences.jsonl")
+
+# Align linked sentences to KG groups while linking (writes `groups_linked_sents_file` directly)
+fuse_linking_alignment = False
+linking_workers = 8
+
+# Alignment of linked sentences to KG groups (output does not depend on the number of workers)
+alignment_workers = 8
+max_matches_per_sentence = None # Only pair the first N matches of a sentence (None = no cap)
+
 groups_linked_sents_file = os.path.join(MEDLINE_DIR, "linked_sentences_to_groups.jsonl")
+# Inverted index from groups to their evidence sentences in `groups_linked_sents_file` (see clarify/ds/evidence.py)
+evidence_index_dir = os.path.join(MEDLINE_DIR, "evidence_index")
+# Compact index of all the textual groups of UMLS CUI groups (see clarify/ds/pairs.py)
+group_pair_index_dir = os.path.join("data", "umls_group_pairs")
+# Relations and groups before pruning, to explore `min_rel_group`, `max_rel_group` and `na_ratio` (tools/pruning-cli.py)
+pruning_index_dir = os.path.join(MEDLINE_DIR, "pruning_index")
+# Tag-agnostic output of cli/create-splits-cli.py (split triples and evidence spans), shared by all configurations
+canonical_dir = os.path.join("data", "canonical")
 
 umls_vocab_file = os.path.join("data", "umls_vocab.pkl")
 drugbank_vocab_file = os.path.join("data", "drugbank_vocab.pkl")
+# Previous UMLS vocab, used by cli/relink-umls-entities-cli.py to only re-link sentences affected by vocab changes
+previous_umls_vocab_file = os.path.join("data", "umls_vocab.prev.pkl")
 
 # Main configurations
 entity_pool = True # True to use average of sub-words, False for only first sub-token (can only be used with special tokens)
@@ -58,20 +85,40 @@ min_sent_char_len_linker = 32
 max_sent_char_len_linker = 256
 min_rel_group = 10
 max_rel_group = 1500
+na_ratio = 0.7 # No. of NA groups as a fraction of the no. of positive groups
+negative_strategy = "corrupt" # Negative groups of a sentence: "corrupt", "typed" or "all" (see clarify/ds/negatives.py)
 
 bag_size = 16
 max_seq_length = 128
 
 SEED = 2019
 
+# "stratified" (sklearn, on the full set of triples) or "hash" (stable assignment of each group from its hash)
+split_mode = "stratified"
+
+# Write the split (and features) files as N shuffled shards with a manifest, instead of a single file
+split_shards = 1
+
 # Models
 pretrained_model_dir = "monologg/biobert_v1.1_pubmed" # OR any other BERT like model
 do_lower_case = False
+features_batch_size = 256 # Bags per call of the fast tokenizer when creating features (0 = slow tokenizer, per sentence)
+features_workers = 8
+# Tokens of the sentences of the split files, each sentence tokenized once (see `clarify.features.SentenceTokens`)
+sentence_tokens_dir = os.path.join(FEATURES_DIR, "sentence_tokens")
+# Encoded rows kept across runs, so that only the rows of new bag entries are encoded (see `clarify.features.RowCache`)
+row_cache = True
+row_cache_dir = os.path.join(FEATURES_DIR, "row_cache")
 
 # Features files
 train_feats_file = os.path.join(FEATURES_DIR, "train.pt")
 dev_feats_file = os.path.join(FEATURES_DIR, "dev.pt")
 test_feats_file = os.path.join(FEATURES_DIR, "test.pt")
+# Memory-mapped feature stores with compact dtypes (see `clarify.features`), used instead of the `.pt` files above
+feature_store = True
+train_feats_dir = os.path.join(FEATURES_DIR, "train")
+dev_feats_dir = os.path.join(FEATURES_DIR, "dev")
+test_feats_dir = os.path.join(FEATURES_DIR, "test")
 
 # Training args
 cuda = True
@@ -90,6 +137,15 @@ train_batch_size = 1
 per_gpu_eval_batch_size = 16 # 24
 eval_batch_size = 1
 gradient_accumulation_steps = 1
+# Sentences of each batch are padded to the longest one instead of `max_seq_length`
+dynamic_padding = True
+# Training batches of bags of similar lengths, shuffled within buckets of `bucket_size` batches
+# (see `clarify.features.BucketBatchSampler`)
+bucket_sampler = False
+bucket_size = 100
+# Sentences of each batch packed in rows of `packing_length` tokens (>= `max_seq_length`, 0 = no packing), attending
+# only to their own tokens; requires `feature_store` and a single device (see `clarify.features.FeatureStore`)
+packing_length = 0
 
 num_train_epochs = 3
 learning_rate = 2e-5
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import argparse
+import time
+
+from clarify.ds.evidence import EvidenceIndex
+
+import logging
+
+logger = logging.getLogger(os.path.basename(sys.argv[0]))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser('Evidence', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('src', type=str, help='Source entity text')
+    parser.add_argument('tgt', type=str, help='Target entity text')
+    parser.add_argument('--index', '-i', type=str, default='data/MEDLINE/evidence_index', help='Evidence index')
+    parser.add_argument('--limit', '-n', type=int, default=None, help='Maximum number of sentences')
+    parser.add_argument('--both', '-b', action='store_true', help='Also show evidence for (tgt, src)')
+
+    args = parser.parse_args(argv)
+
+    t = time.time()
+    index = EvidenceIndex(args.index)
+
+    groups = [(args.src, args.tgt)]
+    if args.both:
+        groups += [(args.tgt, args.src)]
+
+    for src, tgt in groups:
+        sent_ids, spans = index.postings(src, tgt)
+        logger.info(f'{len(sent_ids)} sentences for ({src}, {tgt})')
+
+        for sent_id, (src_start, src_end, tgt_start, tgt_end) in list(zip(sent_ids, spans))[:args.limit]:
+            sent = index.sentences[sent_id]
+            print(f'{sent_id}\t[{src_start}, {src_end}]\t[{tgt_start}, {tgt_end}]\t{sent}')
+
+    logger.info(f'Took {(time.time() - t) * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    main(sys.argv[1:])
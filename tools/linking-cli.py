@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import argparse
+import filecmp
+import itertools
+import tempfile
+
+import config
+
+from clarify.ds.linking import ExactEntityLinking, MultiSourceEntityLinking, link_sentences, link_sentences_multi
+from clarify.ds.umls import UMLSVocab
+from clarify.ds.drugbank import DrugBankVocab
+
+import logging
+
+logger = logging.getLogger(os.path.basename(sys.argv[0]))
+
+VOCABS = {"umls": (UMLSVocab, config.umls_vocab_file), "drugbank": (DrugBankVocab, config.drugbank_vocab_file)}
+
+
+def same_output(fname1: str, fname2: str) -> bool:
+    """Whether two linked sentences outputs (JSONL files or columnar directories) are byte-identical."""
+    if not os.path.isdir(fname1):
+        return filecmp.cmp(fname1, fname2, shallow=False)
+    cmp = filecmp.dircmp(fname1, fname2)
+    if cmp.left_only or cmp.right_only:
+        return False
+    return all(filecmp.cmp(os.path.join(fname1, f), os.path.join(fname2, f), shallow=False) for f in cmp.common_files)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser('Linking', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--sents', '-s', type=str, default=config.medline_unique_sents_file, help='Sentences file')
+    parser.add_argument('--lines', '-n', type=int, default=100000, help='No. of sentences to link (0 = all)')
+    parser.add_argument('--sources', type=str, nargs='+', default=config.linking_sources, help='Vocabularies')
+    parser.add_argument('--binary', action='store_true', help='Compare the columnar format instead of JSONL')
+
+    args = parser.parse_args(argv)
+
+    source_to_entities = dict()
+    for source in args.sources:
+        vocab_cls, vocab_file = VOCABS[source]
+        source_to_entities[source] = list(vocab_cls.load(vocab_file).entity_text_to_cuis.keys())
+
+    # Checks that each per-source output of cli/link-entities-cli.py is the same as linking that source alone
+    output_dir = tempfile.mkdtemp()
+    sents_fname = os.path.join(output_dir, "sentences.txt")
+    with open(args.sents, "rb") as rf, open(sents_fname, "wb") as wf:
+        wf.writelines(itertools.islice(rf, args.lines or None))
+
+    linking_args = (config.min_sent_char_len_linker, config.max_sent_char_len_linker)
+    ext = "" if args.binary else ".jsonl"
+    multi_fnames = {source: os.path.join(output_dir, f"multi_{source}{ext}") for source in args.sources}
+    link_sentences_multi(MultiSourceEntityLinking(source_to_entities, config.case_sensitive_linker), sents_fname,
+                         multi_fnames, None, *linking_args, binary=args.binary)
+
+    mismatches = 0
+    for source in args.sources:
+        single_fname = os.path.join(output_dir, f"single_{source}{ext}")
+        link_sentences(ExactEntityLinking(source_to_entities[source], config.case_sensitive_linker), sents_fname,
+                       single_fname, *linking_args, binary=args.binary)
+        same = same_output(single_fname, multi_fnames[source])
+        mismatches += not same
+        print(f'{source}\t{"identical" if same else "different"}')
+
+    logger.info(f'Outputs are in {output_dir}')
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    main(sys.argv[1:])
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from transformers import BertConfig
+
+import config
+
+from clarify.model import BertForDistantRE
+from clarify.features import FeatureStore
+
+import logging
+
+logger = logging.getLogger(os.path.basename(sys.argv[0]))
+
+
+def iter_batches(store: FeatureStore, batch_size: int, max_batches: int):
+    """Yields the rows of the sentences of the bags of each batch, and the batch."""
+    for idx, lo in enumerate(range(0, len(store), batch_size)):
+        if max_batches and idx == max_batches:
+            break
+        items = [store[i] for i in range(lo, min(lo + batch_size, len(store)))]
+        yield torch.stack([item[0] for item in items]).numpy(), store.collate(items)
+
+
+def layout_stats(store: FeatureStore, args):
+    """Returns the no. of tokens of the sentences of the bags of the batches of `store` (bags repeat sentences to
+    reach their size), of the distinct sentences of each batch, of real tokens encoded (packed rows hold each
+    distinct sentence of a batch once) and of tokens encoded (rows x row length).
+
+    """
+    tokens, distinct, real, cells = 0, 0, 0, 0
+    for rows, batch in iter_batches(store, args.batch, args.max_batches):
+        tokens += int(store.columns["lengths"][rows].sum())
+        distinct += int(store.columns["lengths"][np.unique(rows)].sum())
+        # Attention masks, or segment IDs of packed rows
+        real += int((batch[2] > 0).sum())
+        cells += batch[0].numel()
+    return tokens, distinct, real, cells
+
+
+def encode_time(store: FeatureStore, model: BertForDistantRE, args) -> float:
+    """Seconds taken by the forward passes over the batches of `store`, collation excluded."""
+    num_tensors = 6 if store.meta["has_rel_dir"] else 5
+    seconds = 0.
+    with torch.no_grad():
+        for _, batch in iter_batches(store, args.batch, args.max_batches):
+            t = time.time()
+            model(batch[0], batch[1], batch[2], is_train=False, entity_spans=batch[num_tensors],
+                  packed_index=batch[num_tensors + 1] if store.packing else None)
+            seconds += time.time() - t
+    return seconds
+
+
+def main(argv):
+    parser = argparse.ArgumentParser('Packing', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--store', '-s', type=str, default=config.dev_feats_dir, help='Feature store')
+    parser.add_argument('--packing', '-p', type=int, nargs='+', default=[128, 256], help='Lengths of packed rows')
+    parser.add_argument('--batch', '-b', type=int, default=16, help='Bags per batch')
+    parser.add_argument('--max-batches', '-n', type=int, default=20, help='No. of batches (0 = all)')
+    parser.add_argument('--time', '-t', action='store_true', help='Also time the forward passes of a random BERT')
+    parser.add_argument('--hidden', type=int, default=768, help='Hidden size')
+    parser.add_argument('--layers', type=int, default=2, help='No. of hidden layers')
+    parser.add_argument('--threads', type=int, default=1, help='Torch threads')
+
+    args = parser.parse_args(argv)
+
+    layouts = [('fixed', FeatureStore(args.store)), ('dynamic', FeatureStore(args.store, dynamic_padding=True))]
+    layouts += [(f'packed{p}', FeatureStore(args.store, packing=p)) for p in args.packing]
+
+    model = None
+    if args.time:
+        torch.set_num_threads(args.threads)
+        torch.manual_seed(42)
+        bert_config = BertConfig(hidden_size=args.hidden, num_hidden_layers=args.layers,
+                                 num_attention_heads=max(1, args.hidden // 64), intermediate_size=4 * args.hidden,
+                                 max_position_embeddings=max([512] + args.packing))
+        model = BertForDistantRE(bert_config, 2)
+        model.eval()
+
+    # Packed rows hold each distinct sentence of a batch once, the other layouts encode each sentence of the bags,
+    # repeats included: `dedup` is the ratio of the two. Real tokens/s are the tokens actually encoded per second
+    # (the gain of packing alone), tokens/s are the tokens of the bags per second (the gain of packing and dedup)
+    print('\t'.join(['layout', 'tokens', 'distinct', 'dedup', 'encoded', 'efficiency'] +
+                    (['s', 'real tokens/s', 'tokens/s'] if model else [])))
+    for name, store in layouts:
+        tokens, distinct, real, cells = layout_stats(store, args)
+        values = [name, tokens, distinct, f'{tokens / max(distinct, 1):.2f}', cells, f'{real / max(cells, 1):.3f}']
+        if model:
+            seconds = encode_time(store, model, args)
+            values += [f'{seconds:.2f}', f'{real / seconds:.0f}', f'{tokens / seconds:.0f}']
+        print('\t'.join(str(v) for v in values))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    main(sys.argv[1:])
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import argparse
+import time
+
+import torch
+
+from transformers import BertConfig
+
+import config
+
+from clarify.model import BertForDistantRE
+from clarify.features import FeatureStore, BucketBatchSampler
+
+import logging
+
+logger = logging.getLogger(os.path.basename(sys.argv[0]))
+
+
+def eval_batches(store: FeatureStore, batch_size: int, sort: bool):
+    """Batches of bag indices of `store` in order, or sorted by bag length as in the evaluation of train-cli."""
+    if sort:
+        return list(BucketBatchSampler(store.bag_lengths(), batch_size, bucket_size=0, shuffle=False))
+    return [list(range(lo, min(lo + batch_size, len(store)))) for lo in range(0, len(store), batch_size)]
+
+
+def eval_time(store: FeatureStore, batches, model: BertForDistantRE):
+    """Seconds taken by the collation and forward passes of `batches`, and the no. of tokens encoded."""
+    num_tensors = 6 if store.meta["has_rel_dir"] else 5
+    seconds, cells = 0., 0
+    with torch.no_grad():
+        for indices in batches:
+            t = time.time()
+            batch = store.collate([store[i] for i in indices])
+            model(batch[0], batch[1], batch[2], is_train=False, entity_spans=batch[num_tensors])
+            seconds += time.time() - t
+            cells += batch[0].numel()
+    return seconds, cells
+
+
+def main(argv):
+    parser = argparse.ArgumentParser('Padding', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--store', '-s', type=str, default=config.dev_feats_dir, help='Feature store')
+    parser.add_argument('--batch', '-b', type=int, default=16, help='Bags per batch')
+    parser.add_argument('--hidden', type=int, default=768, help='Hidden size')
+    parser.add_argument('--layers', type=int, default=2, help='No. of hidden layers')
+    parser.add_argument('--threads', type=int, default=1, help='Torch threads')
+
+    args = parser.parse_args(argv)
+
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(42)
+    bert_config = BertConfig(hidden_size=args.hidden, num_hidden_layers=args.layers,
+                             num_attention_heads=max(1, args.hidden // 64), intermediate_size=4 * args.hidden)
+    model = BertForDistantRE(bert_config, 2)
+    model.eval()
+
+    fixed, dynamic = FeatureStore(args.store), FeatureStore(args.store, dynamic_padding=True)
+    layouts = [('fixed', fixed, eval_batches(fixed, args.batch, False)),
+               ('dynamic', dynamic, eval_batches(dynamic, args.batch, False)),
+               ('sorted', dynamic, eval_batches(dynamic, args.batch, True))]
+
+    # Time of a pass over the whole store, as in `evaluate` of train-cli
+    print('\t'.join(['layout', 'encoded', 's']))
+    for name, store, batches in layouts:
+        seconds, cells = eval_time(store, batches, model)
+        print(f'{name}\t{cells}\t{seconds:.2f}')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    main(sys.argv[1:])
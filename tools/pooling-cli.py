@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import argparse
+import resource
+import multiprocessing
+import time
+
+import numpy as np
+import torch
+
+from transformers import BertConfig
+
+from clarify.model import BertForDistantRE
+from clarify.features import entity_spans
+
+import logging
+
+logger = logging.getLogger(os.path.basename(sys.argv[0]))
+
+
+def random_batch(args):
+    """Random input IDs and entity IDs with an entity of 1 to 4 tokens on each side of each sentence."""
+    rng = np.random.RandomState(args.seed)
+    B, G, L = args.batch, args.bag, args.seq
+    input_ids = rng.randint(1000, 30000, size=(B, G, L))
+    lengths = rng.randint(L // 2, L + 1, size=(B, G))
+    entity_ids = np.zeros((B, G, L), dtype=np.int64)
+    for idx in np.ndindex(B, G):
+        half = lengths[idx] // 2
+        e1_start, e2_start = rng.randint(1, half - 4), rng.randint(half, lengths[idx] - 4)
+        entity_ids[idx][e1_start:e1_start + rng.randint(1, 5)] = 1
+        entity_ids[idx][e2_start:e2_start + rng.randint(1, 5)] = 2
+    attention_mask = (np.arange(L)[None, None, :] < lengths[..., None]).astype(np.int64)
+    return dict(
+        input_ids=torch.from_numpy(input_ids),
+        entity_ids=torch.from_numpy(entity_ids),
+        attention_mask=torch.from_numpy(attention_mask),
+        labels=torch.from_numpy(rng.randint(0, args.labels, size=B)),
+    )
+
+
+def build_model(args) -> BertForDistantRE:
+    torch.manual_seed(args.seed)
+    bert_config = BertConfig(hidden_size=args.hidden, num_hidden_layers=args.layers,
+                             num_attention_heads=max(1, args.hidden // 64), intermediate_size=4 * args.hidden)
+    model = BertForDistantRE(bert_config, args.labels)
+    model.eval()
+    return model
+
+
+def pool(spans: bool, sequence_output, entity_ids, entity_spans_):
+    """Returns the e1 and e2 representations, as in `BertForDistantRE.forward`."""
+    if spans:
+        return tuple(BertForDistantRE.span_mean(sequence_output, entity_spans_[..., i], entity_spans_[..., i + 1])
+                     for i in (0, 2))
+    return tuple(BertForDistantRE.mask_mean(sequence_output, entity_ids, entity) for entity in (1, 2))
+
+
+def pooling_forward(args, spans: bool):
+    """Returns a function pooling the entities of a batch of random hidden states."""
+    inputs = random_batch(args)
+    N = args.batch * args.bag
+    entity_ids = inputs["entity_ids"].view(N, -1)
+    entity_spans_ = torch.from_numpy(entity_spans(entity_ids.numpy()))
+    sequence_output = torch.randn(N, args.seq, args.hidden, requires_grad=args.backward)
+
+    def forward():
+        with torch.set_grad_enabled(args.backward):
+            e1, e2 = pool(spans, sequence_output, entity_ids, entity_spans_)
+            if args.backward:
+                (e1.sum() + e2.sum()).backward()
+                sequence_output.grad = None
+
+    return forward
+
+
+def model_forward(args, spans: bool):
+    """Returns a function running the model of `compare_logits` on a random batch, with or without entity spans."""
+    model = build_model(args)
+    inputs = random_batch(args)
+    if spans:
+        inputs["entity_spans"] = torch.from_numpy(entity_spans(inputs["entity_ids"].numpy()))
+
+    def forward():
+        with torch.set_grad_enabled(args.backward):
+            loss = model(**inputs)[0]
+            if args.backward:
+                loss.backward()
+                model.zero_grad(set_to_none=True)
+
+    return forward
+
+
+def run(args, spans: bool, full: bool, queue):
+    """Times the entity pooling alone, or the forward pass of the whole model if `full`, and measures the peak memory
+    it takes.
+
+    """
+    torch.set_num_threads(args.threads)
+    forward = model_forward(args, spans) if full else pooling_forward(args, spans)
+
+    def rss():
+        # Current resident set size, in KB as `ru_maxrss` on Linux
+        with open("/proc/self/statm") as rf:
+            return int(rf.read().split()[1]) * resource.getpagesize() // 1024
+
+    base_rss = rss()
+    times = list()
+    for _ in range(args.runs):
+        t = time.time()
+        forward()
+        times.append(time.time() - t)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((float(np.median(times)), peak_rss - base_rss))
+
+
+def compare_logits(args) -> float:
+    """Max. abs. difference of the logits of the model with the two poolings."""
+    model = build_model(args)
+    inputs = random_batch(args)
+    with torch.no_grad():
+        mask_logits = model(**inputs)[1]
+        inputs["entity_spans"] = torch.from_numpy(entity_spans(inputs["entity_ids"].numpy()))
+        span_logits = model(**inputs)[1]
+    return float((mask_logits - span_logits).abs().max())
+
+
+def main(argv):
+    parser = argparse.ArgumentParser('Pooling', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--batch', '-b', type=int, default=2, help='Bags per batch')
+    parser.add_argument('--bag', '-g', type=int, default=16, help='Sentences per bag')
+    parser.add_argument('--seq', '-l', type=int, default=128, help='Max. sequence length')
+    parser.add_argument('--hidden', type=int, default=768, help='Hidden size')
+    parser.add_argument('--layers', type=int, default=2, help='No. of hidden layers')
+    parser.add_argument('--labels', type=int, default=100, help='No. of relations')
+    parser.add_argument('--runs', '-n', type=int, default=10, help='Timed runs')
+    parser.add_argument('--threads', type=int, default=1, help='Torch threads')
+    parser.add_argument('--backward', action='store_true', help='Also run the backward pass of the pooling')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed')
+
+    args = parser.parse_args(argv)
+
+    # Each variant runs in its own process, so that their peak memory does not add up
+    context = multiprocessing.get_context('fork')
+    results = dict()
+    for name, spans in (('mask', False), ('span', True)):
+        for full in (False, True):
+            queue = context.Queue()
+            process = context.Process(target=run, args=(args, spans, full, queue))
+            process.start()
+            results[name, full] = queue.get()
+            process.join()
+
+    # Pooling columns time the entity pooling alone, model columns the forward pass of the whole model
+    print('\t'.join(['pooling', 'pooling_ms', 'pooling_peak_mb', 'model_ms', 'model_peak_mb']))
+    for name in ('mask', 'span'):
+        values = [name]
+        for full in (False, True):
+            seconds, peak_rss = results[name, full]
+            values += [f'{seconds * 1000:.2f}', f'{peak_rss / 1024:.1f}']
+        print('\t'.join(values))
+
+    logger.info(f'Max. abs. difference of the logits of {args.layers}-layer BERT: {compare_logits(args):.2e}')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    main(sys.argv[1:])
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import argparse
+import itertools
+import time
+
+from clarify.ds.pruning import PruningIndex
+
+import logging
+
+logger = logging.getLogger(os.path.basename(sys.argv[0]))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser('Pruning', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--index', '-i', type=str, default='data/MEDLINE/pruning_index', help='Pruning index')
+    parser.add_argument('--min', type=int, nargs='+', default=[10], help='Values of min_rel_group')
+    parser.add_argument('--max', type=int, nargs='+', default=[1500], help='Values of max_rel_group')
+    parser.add_argument('--na-ratio', type=float, nargs='+', default=[0.7], help='Values of na_ratio')
+    parser.add_argument('--bag-size', type=int, default=16, help='Bag size')
+    parser.add_argument('--relations', '-r', action='store_true', help='Also list relations and their no. of groups')
+
+    args = parser.parse_args(argv)
+
+    t = time.time()
+    index = PruningIndex.load(args.index)
+    logger.info(f'Loaded {len(index.relations)} relations in {(time.time() - t) * 1000:.1f} ms')
+
+    if args.relations:
+        for relation, count in sorted(index.relation_counts().items(), key=lambda x: -x[1]):
+            print(f'{count}\t{relation}')
+
+    keys = None
+    for min_rel_group, max_rel_group, na_ratio in itertools.product(args.min, args.max, args.na_ratio):
+        t = time.time()
+        report = index.report(min_rel_group, max_rel_group, na_ratio, args.bag_size)
+        if keys is None:
+            keys = list(report.keys())
+            print('\t'.join(['min', 'max', 'na_ratio'] + keys + ['ms']))
+        values = [min_rel_group, max_rel_group, na_ratio] + [report[k] for k in keys]
+        print('\t'.join(str(v) for v in values) + f'\t{(time.time() - t) * 1000:.1f}')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    main(sys.argv[1:])